@@ -19,10 +19,9 @@ The D80 module provides a single camera manager class for controlling a Nikon
 D80 camera.
 """
 
-import pickle
-
 from pysces_asi import PASKIL_jpg_plugin #import the plugin needed to open the image files in PASKIL
 from pysces_asi.camera import GphotoCameraManager, register
+from pysces_asi.data_storage_classes import ImageBuffer, CAPTURE_TIME_FORMAT
 
 ##############################################################################################  
 
@@ -30,6 +29,8 @@ class D80CameraManager(GphotoCameraManager):
     """
     Class for controlling a Nikon D80 camera. 
     """
+    required_configs = ['capturetarget', 'imgquality']
+    
     def __init__(self, settings_manager):
         GphotoCameraManager.__init__(self, settings_manager)
         
@@ -42,15 +43,13 @@ class D80CameraManager(GphotoCameraManager):
     def _set_capture_mode(self, capture_mode):
         """
         Sets the camera configs to those specified in the CaptureMode object
-        passed as the argument. Note that the _set_config() method (which is
-        inherited from the GphotoCameraManager class) takes care of updating
-        the camera_configs attribute (which is inherited from the 
-        CameraManagerBase class).
+        passed as the argument. Note that the _set_configs() method (which is
+        inherited from the GphotoCameraManager class) only changes the configs
+        that need changing, and takes care of updating the camera_configs 
+        attribute (which is inherited from the CameraManagerBase class).
         """
         #set camera configs based on capture mode settings
-        for name, value in list(capture_mode.camera_settings.items()):
-            if self.camera_configs[name].current != value:
-                self._set_config(name, value)
+        configs = dict(capture_mode.camera_settings)
 
         #work out what the imgquality config should be set to based on the image types in the outputs
         files=[]
@@ -67,14 +66,17 @@ class D80CameraManager(GphotoCameraManager):
             get_jpeg = True
         
         if get_jpeg and get_raw:
-            if self.camera_configs["imgquality"].current != "NEF+Normal":
-                self._set_config("imgquality", "NEF+Normal")
+            configs["imgquality"] = "NEF+Normal"
         elif get_raw:
-            if self.camera_configs["imgquality"].current != "NEF (Raw)":
-                self._set_config("imgquality", "NEF (Raw)")
+            configs["imgquality"] = "NEF (Raw)"
         else:
-            if self.camera_configs["imgquality"].current != "JPEG Normal":
-                self._set_config("imgquality", "JPEG Normal")
+            configs["imgquality"] = "JPEG Normal"
+        
+        #use the camera's continuous shooting for burst capture modes (if it has it)
+        if self._has_config('burstnumber'):
+            configs['burstnumber'] = str(capture_mode.burst)
+        
+        self._set_configs(configs)
         
         self.capture_mode = capture_mode
         
@@ -85,34 +87,55 @@ class D80CameraManager(GphotoCameraManager):
         Captures the images and creates the site info files needed to open them with 
         PASKIL.
         """
-        glob_vars = self._settings_manager.get(['tmp dir', 'camera_rotation', 'fov_angle', 'lens_projection', 'latitude', 'longitude', 'magnetic_bearing'])
-
-        get_raw = False
-        get_jpeg = False
+        #capture the image and copy it from the camera into the current tmp dir (or into memory)
+        time_of_capture, images = self._capture_photos(self._number_of_images())
         
-        number_of_images = 0
+        if time_of_capture == None:
+            #the capture pipeline is still filling up, so there are no images yet
+            return None
         
-        #see if we need to download a raw file
+        return self._create_images(time_of_capture, images)
+    
+    ##############################################################################################         
+    
+    def _capture_burst(self, number_of_frames):
+        """
+        Captures a burst of images using the camera's continuous shooting, if it
+        has been set up for it by _set_capture_mode(), otherwise one at a time.
+        """
+        if (not self._has_config('burstnumber') or
+                self.camera_configs['burstnumber'].current != str(number_of_frames)):
+            return GphotoCameraManager._capture_burst(self, number_of_frames)
+        
+        frames = self._capture_burst_photos(self._number_of_images(), number_of_frames)
+        return [self._create_images(time_of_capture, images) for time_of_capture, images in frames]
+    
+    ##############################################################################################         
+    
+    def _number_of_images(self):
+        """
+        Returns the number of files that the camera stores for each image.
+        """
+        number_of_images = 0
         if self.camera_configs["imgquality"].current.count("NEF") != 0:
-            get_raw = True
             number_of_images += 1
-            
         if self.camera_configs["imgquality"].current.count("Normal") != 0:
-            get_jpeg = True
-            number_of_images += 1 
-                
-        #capture the image and find which folder the camera puts it in    
-        active_folder, time_of_capture = self._take_photo(number_of_images)
-        
-        if active_folder == None:
-            #the folder wasn't empty to start with so we need to empty it first
-            return None
-        
-        #otherwise copy the images from the camera into the current tmp dir
-        self._copy_photos(active_folder, time_of_capture)       
-        
-        #delete images from camera card
-        self._delete_photos(active_folder)
+            number_of_images += 1
+        return number_of_images
+    
+    ##############################################################################################         
+    
+    def _create_images(self, time_of_capture, images):
+        """
+        Creates the site info files needed to open the images captured at 
+        time_of_capture with PASKIL, and returns the dict of images. The images 
+        argument should be as returned by _capture_photos().
+        """
+        glob_vars = self._settings_manager.get(['tmp dir', 'camera_rotation', 'fov_angle', 'lens_projection', 'latitude', 'longitude', 'magnetic_bearing'])
+
+        #see which types of image the camera is storing
+        get_raw = self.camera_configs["imgquality"].current.count("NEF") != 0
+        get_jpeg = self.camera_configs["imgquality"].current.count("Normal") != 0
         
         new_images = {}
         
@@ -121,26 +144,32 @@ class D80CameraManager(GphotoCameraManager):
         if get_raw:
             info = self._build_PASKIL_info("NEF", time_of_capture, glob_vars)
             
-            info_filename = glob_vars['tmp dir'] +"/"+time_of_capture.strftime("%Y%m%d_%H%M%S")+"_NEF.info"
-            image_filename = glob_vars['tmp dir'] +"/"+time_of_capture.strftime("%Y%m%d_%H%M%S")+".NEF"
+            info_filename = glob_vars['tmp dir'] +"/"+self._timestamp(time_of_capture)+"_NEF.info"
+            image_filename = glob_vars['tmp dir'] +"/"+self._timestamp(time_of_capture)+".NEF"
             
-            #open file to pickle info dict into 
-            with open(info_filename, "wb") as fp:
-                pickle.dump(info, fp)
+            if self._capture_to_memory:
+                #no need to write anything to the tmp dir
+                new_images["NEF"] = ImageBuffer(images[".nef"], info, image_filename)
+            else:
+                #pickle the info dict into the info file
+                self._write_info_file(info, info_filename)
 
-            new_images["NEF"] = (image_filename, info_filename)
+                new_images["NEF"] = (image_filename, info_filename)
         
         if get_jpeg:
             info = self._build_PASKIL_info("jpeg", time_of_capture, glob_vars)
             
-            info_filename = glob_vars['tmp dir'] +"/"+time_of_capture.strftime("%Y%m%d_%H%M%S")+"_JPG.info"
-            image_filename = glob_vars['tmp dir'] +"/"+time_of_capture.strftime("%Y%m%d_%H%M%S")+".JPG"
+            info_filename = glob_vars['tmp dir'] +"/"+self._timestamp(time_of_capture)+"_JPG.info"
+            image_filename = glob_vars['tmp dir'] +"/"+self._timestamp(time_of_capture)+".JPG"
             
-            #open file to pickle info dict into 
-            with open(info_filename, "wb") as fp:
-                pickle.dump(info, fp)
+            if self._capture_to_memory:
+                #no need to write anything to the tmp dir
+                new_images["jpeg"] = ImageBuffer(images[".jpg"], info, image_filename)
+            else:
+                #pickle the info dict into the info file
+                self._write_info_file(info, info_filename)
 
-            new_images["jpeg"] = (image_filename, info_filename)
+                new_images["jpeg"] = (image_filename, info_filename)
             
         return new_images
     
@@ -166,6 +195,7 @@ class D80CameraManager(GphotoCameraManager):
         info['camera']['Radius'] = image.Radius
         info['header']['Wavelength'] = image.Wavelength
         info['header']['Creation Time'] = capture_time.strftime("%d %b %Y %H:%M:%S")+" GMT"
+        info['header']['Capture Time'] = capture_time.strftime(CAPTURE_TIME_FORMAT)
         
         info['camera']['lat'] = glob_vars['latitude']
         info['camera']['lon'] = glob_vars['longitude']
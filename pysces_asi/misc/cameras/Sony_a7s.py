@@ -21,11 +21,10 @@ The Sony_a7s module provides a single camera manager class for controlling a Nik
 Sony alpha 7s camera.
 """
 
-import pickle
-
 # import the plugin needed to open the image files in PASKIL
 from pysces_asi import PASKIL_jpg_plugin
 from pysces_asi.camera import GphotoCameraManager, register
+from pysces_asi.data_storage_classes import ImageBuffer, CAPTURE_TIME_FORMAT
 
 ##########################################################################
 
@@ -34,6 +33,7 @@ class A7SCameraManager(GphotoCameraManager):
     """
     Class for controlling a Sony Alpha 7S camera. 
     """
+    required_configs = ['imagequality']
 
     def __init__(self, settings_manager):
         GphotoCameraManager.__init__(self, settings_manager)
@@ -48,15 +48,13 @@ class A7SCameraManager(GphotoCameraManager):
     def _set_capture_mode(self, capture_mode):
         """
         Sets the camera configs to those specified in the CaptureMode object
-        passed as the argument. Note that the _set_config() method (which is
-        inherited from the GphotoCameraManager class) takes care of updating
-        the camera_configs attribute (which is inherited from the 
-        CameraManagerBase class).
+        passed as the argument. Note that the _set_configs() method (which is
+        inherited from the GphotoCameraManager class) only changes the configs
+        that need changing, and takes care of updating the camera_configs 
+        attribute (which is inherited from the CameraManagerBase class).
         """
         # set camera configs based on capture mode settings
-        for name, value in list(capture_mode.camera_settings.items()):
-            if self.camera_configs[name].current != value:
-                self._set_config(name, value)
+        configs = dict(capture_mode.camera_settings)
 
         # work out what the imagequality config should be set to based on the
         # image types in the outputs
@@ -74,14 +72,13 @@ class A7SCameraManager(GphotoCameraManager):
             get_jpeg = True
 
         if get_jpeg and get_raw:
-            if self.camera_configs["imagequality"].current != "RAW+JPEG":
-                self._set_config("imagequality", "RAW+JPEG")
+            configs["imagequality"] = "RAW+JPEG"
         elif get_raw:
-            if self.camera_configs["imagequality"].current != "RAW":
-                self._set_config("imagequality", "RAW")
+            configs["imagequality"] = "RAW"
         else:
-            if self.camera_configs["imagequality"].current != "Standard":
-                self._set_config("imagequality", "Standard")
+            configs["imagequality"] = "Standard"
+
+        self._set_configs(configs)
 
         self.capture_mode = capture_mode
 
@@ -110,8 +107,13 @@ class A7SCameraManager(GphotoCameraManager):
             get_jpeg = True
             number_of_images += 1
 
-        # capture the image and find which folder the camera puts it in
-        time_of_capture = self._take_photo_and_download()
+        # capture the image and download it. gphoto2 can only send a single
+        # image to its stdout, so RAW+JPEG images always go via the tmp dir
+        in_memory = self._capture_to_memory and number_of_images == 1
+        if in_memory:
+            time_of_capture, data = self._take_photo_and_read()
+        else:
+            time_of_capture = self._take_photo_and_download()
 
 #         if active_folder == None:
 #             # the folder wasn't empty to start with so we need to empty it
@@ -133,29 +135,35 @@ class A7SCameraManager(GphotoCameraManager):
             info = self._build_PASKIL_info("arw", time_of_capture, glob_vars)
 
             info_filename = glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + "_arw.info"
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + "_arw.info"
             image_filename = glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + ".arw"
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + ".arw"
 
-            # open file to pickle info dict into
-            with open(info_filename, "wb") as fp:
-                pickle.dump(info, fp)
+            if in_memory:
+                # no need to write anything to the tmp dir
+                new_images["arw"] = ImageBuffer(data, info, image_filename)
+            else:
+                # pickle the info dict into the info file
+                self._write_info_file(info, info_filename)
 
-            new_images["arw"] = (image_filename, info_filename)
+                new_images["arw"] = (image_filename, info_filename)
 
         if get_jpeg:
             info = self._build_PASKIL_info("jpeg", time_of_capture, glob_vars)
 
             info_filename = glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + "_jpg.info"
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + "_jpg.info"
             image_filename = glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + ".jpg"
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + ".jpg"
 
-            # open file to pickle info dict into
-            with open(info_filename, "wb") as fp:
-                pickle.dump(info, fp)
+            if in_memory:
+                # no need to write anything to the tmp dir
+                new_images["jpeg"] = ImageBuffer(data, info, image_filename)
+            else:
+                # pickle the info dict into the info file
+                self._write_info_file(info, info_filename)
 
-            new_images["jpeg"] = (image_filename, info_filename)
+                new_images["jpeg"] = (image_filename, info_filename)
 
         return new_images
 
@@ -183,6 +191,8 @@ class A7SCameraManager(GphotoCameraManager):
         info['header']['Wavelength'] = image.Wavelength
         info['header']['Creation Time'] = capture_time.strftime(
             "%d %b %Y %H:%M:%S") + " GMT"
+        info['header']['Capture Time'] = capture_time.strftime(
+            CAPTURE_TIME_FORMAT)
 
         info['camera']['lat'] = glob_vars['latitude']
         info['camera']['lon'] = glob_vars['longitude']
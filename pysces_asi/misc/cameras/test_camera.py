@@ -9,7 +9,7 @@ import pickle
 from pysces_asi import PASKIL_jpg_plugin
 
 from pysces_asi.camera import CameraManagerBase, GphotoError, register
-from pysces_asi.data_storage_classes import CaptureMode
+from pysces_asi.data_storage_classes import CaptureMode, CAPTURE_TIME_FORMAT
 
 
 class CameraSimulator(CameraManagerBase):
@@ -18,7 +18,7 @@ class CameraSimulator(CameraManagerBase):
         self.settings_manager = settings_manager
         CameraManagerBase.__init__(self, settings_manager)
 
-    def set_capture_mode(self, capture_mode):
+    def _set_capture_mode(self, capture_mode):
         self.files = []
         self.image_sizes = {}
         self.capture_mode = capture_mode
@@ -49,7 +49,7 @@ class CameraSimulator(CameraManagerBase):
     def _clear_camera(self):
         pass
 
-    def capture_images(self):
+    def _capture_images(self):
         self.settings_manager.set({'output': "CameraManager> Capturing Image"})
         glob_vars = self.settings_manager.get(
             ['tmp dir', 'camera_rotation', 'fov_angle', 'lens_projection', 'latitude', 'longitude', 'magnetic_bearing'])
@@ -69,9 +69,9 @@ class CameraSimulator(CameraManagerBase):
                 filetype, time_of_capture, glob_vars)
 
             info_filename = glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + "_" + filetype + ".info"
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + "_" + filetype + ".info"
             image_filename = glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + "." + filetype
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + "." + filetype
 
             # open file to pickle info dict into
             with open(info_filename, "wb") as fp:
@@ -147,6 +147,8 @@ class CameraSimulator(CameraManagerBase):
         info['header']['Wavelength'] = image.Wavelength
         info['header']['Creation Time'] = capture_time.strftime(
             "%d %b %Y %H:%M:%S") + " GMT"
+        info['header']['Capture Time'] = capture_time.strftime(
+            CAPTURE_TIME_FORMAT)
 
         info['camera']['lat'] = glob_vars['latitude']
         info['camera']['lon'] = glob_vars['longitude']
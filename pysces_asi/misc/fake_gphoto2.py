@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A stand-in for the gphoto2 executable, which emulates a camera described by a
+scenario file. It allows the GphotoCameraManager and the camera plugins to be
+run (and benchmarked) end-to-end without a camera. To use it, set
+gphoto2_executable in the settings file to the path of this script and set the
+FAKE_GPHOTO2_SCENARIO environment variable to the path of the scenario file
+(see fake_gphoto2_scenario.json for an example).
+
+The scenario file is a JSON dict, which may contain:
+
+    model, port - what --auto-detect reports.
+    connected - if false, --auto-detect finds no camera.
+    configs - dict of {name:{"label", "type", "current", "choices"}}.
+    quality_config - name of the config which decides which files a capture
+                     produces, and capture_files - dict of {value of the
+                     quality config:[file extensions]}.
+    folder - the folder on the card that captured images are stored in.
+    card - the initial contents of the card, {folder:[filenames]}.
+    file_size - size (in bytes) of the fake image files.
+    sample_files - dict of {extension:path}, real files whose contents are
+                   used for captured images with that extension.
+    storage_delay - seconds after a capture before its files appear on the card.
+    burst_interval - seconds between the frames of a burst. If there is a 
+                     burstnumber config, then each capture produces that many
+                     frames (like the Nikons' continuous shooting).
+    latency - dict of {operation:seconds or [min, max]}. The operations are
+              auto-detect, list-config, get-config, set-config, capture,
+              download, list, delete and reset, plus default.
+    failure_rate - dict of {operation:probability} that the operation fails.
+    seed - seed for the random number generator.
+
+The state of the card and the camera configs is kept in a state file (by
+default the scenario file name with ".state" appended, or the file named by
+FAKE_GPHOTO2_STATE), so it persists between calls. Delete the state file to
+reset the camera. Both the command line interface and the --shell interface
+(for the session backend) are emulated, but only for the options that
+pysces_asi uses.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+
+PROMPT = "gphoto2: {%s} %s> "
+
+DEFAULT_SCENARIO = {
+    "model": "Fake Camera",
+    "port": "usb:001,001",
+    "connected": True,
+    "configs": {},
+    "quality_config": None,
+    "capture_files": {},
+    "folder": "/store_00010001/DCIM/100FAKE",
+    "card": {},
+    "file_size": 100000,
+    "sample_files": {},
+    "storage_delay": 0.0,
+    "burst_interval": 0.333,
+    "latency": {},
+    "failure_rate": {},
+    "seed": None
+}
+
+
+class FakeGphotoError(Exception):
+    pass
+
+##########################################################################
+
+
+class FakeCamera:
+    """
+    The emulated camera. Holds the scenario and the state loaded from the
+    state file.
+    """
+
+    def __init__(self, scenario_file, state_file=None):
+        self.scenario = dict(DEFAULT_SCENARIO)
+        with open(scenario_file, "r") as fp:
+            self.scenario.update(json.load(fp))
+
+        if self.scenario["seed"] is not None:
+            random.seed(self.scenario["seed"])
+
+        if state_file is None:
+            state_file = scenario_file + ".state"
+        self.state_file = state_file
+        self._lock_fp = None
+
+    ##########################################################################
+
+    def load(self):
+        """
+        Locks and reads the state file (creating the state from the scenario
+        if it does not exist).
+        """
+        self._lock_fp = open(self.state_file + ".lock", "w")
+        fcntl.flock(self._lock_fp, fcntl.LOCK_EX)
+
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as fp:
+                self.state = json.load(fp)
+            return
+
+        card = {}
+        for folder, filenames in list(self.scenario["card"].items()):
+            card[folder] = [[f, 0.0] for f in filenames]
+        self.state = {
+            "card": card,
+            "configs": dict([(name, config["current"]) for name, config in list(self.scenario["configs"].items())]),
+            "counter": 0}
+
+    ##########################################################################
+
+    def save(self):
+        """
+        Writes the state file and releases the lock.
+        """
+        with open(self.state_file + "-temp", "w") as fp:
+            json.dump(self.state, fp)
+        os.rename(self.state_file + "-temp", self.state_file)
+        fcntl.flock(self._lock_fp, fcntl.LOCK_UN)
+        self._lock_fp.close()
+
+    ##########################################################################
+
+    def operation(self, name, wait=True):
+        """
+        Waits for the latency of the operation (unless wait is False) and
+        then raises a FakeGphotoError if the operation should fail. Returns
+        the latency.
+        """
+        latency = self.scenario["latency"].get(
+            name, self.scenario["latency"].get("default", 0.0))
+        if isinstance(latency, list):
+            latency = random.uniform(latency[0], latency[1])
+        if wait:
+            time.sleep(latency)
+
+        if random.random() < self.scenario["failure_rate"].get(name, 0.0):
+            raise FakeGphotoError("*** Error: An error occurred in the io-library ('I/O problem'): " +
+                                  name + " failed (scripted failure) ***")
+        return latency
+
+    ##########################################################################
+
+    def files(self, folder):
+        """
+        Returns the names of the files in the folder which have been stored.
+        """
+        now = time.time()
+        return [f for f, available in self.state["card"].get(folder, []) if available <= now]
+
+    ##########################################################################
+
+    def file_data(self, filename):
+        extension = os.path.splitext(filename)[1]
+        sample = self.scenario["sample_files"].get(
+            extension, self.scenario["sample_files"].get(extension.lower()))
+        if sample is not None:
+            with open(sample, "rb") as fp:
+                return fp.read()
+        return b"\0" * self.scenario["file_size"]
+
+    ##########################################################################
+
+    def capture(self, wait=True):
+        """
+        Stores new files on the card (after the storage delay) and returns
+        their (folder, filename). If wait is False (--trigger-capture), then
+        this returns as soon as the exposure has started, and the files are
+        stored after the capture latency plus the storage delay.
+        """
+        exposure = self.operation("capture", wait)
+
+        quality = self.state["configs"].get(self.scenario["quality_config"])
+        extensions = self.scenario["capture_files"].get(quality, [".JPG"])
+
+        available = time.time() + self.scenario["storage_delay"]
+        if not wait:
+            available += exposure
+        folder = self.scenario["folder"]
+        new_files = []
+        for frame in range(int(self.state["configs"].get("burstnumber", 1))):
+            self.state["counter"] += 1
+            for extension in extensions:
+                filename = "DSC_%04d%s" % (self.state["counter"], extension)
+                self.state["card"].setdefault(folder, []).append(
+                    [filename, available + frame * self.scenario["burst_interval"]])
+                new_files.append((folder, filename))
+        return new_files
+
+    ##########################################################################
+
+    def delete(self, folder, filename):
+        self.operation("delete")
+        entries = self.state["card"].get(folder, [])
+        for entry in entries:
+            if entry[0] == filename:
+                entries.remove(entry)
+                return
+        raise FakeGphotoError("*** Error: File '" + filename + "' does not exist ***")
+
+    ##########################################################################
+
+    def get_config(self, name):
+        self.operation("get-config")
+        try:
+            config = self.scenario["configs"][name]
+        except KeyError:
+            raise FakeGphotoError(
+                "*** Error: " + name + " not found in configuration tree. ***")
+
+        lines = ["Label: " + config.get("label", name), "Readonly: 0",
+                 "Type: " + config.get("type", "RADIO"),
+                 "Current: " + str(self.state["configs"][name])]
+        for i, choice in enumerate(config.get("choices", [])):
+            lines.append("Choice: " + str(i) + " " + str(choice))
+        lines.append("END")
+        return "\n".join(lines)
+
+    ##########################################################################
+
+    def set_config(self, name, value):
+        self.operation("set-config")
+        try:
+            config = self.scenario["configs"][name]
+        except KeyError:
+            raise FakeGphotoError(
+                "*** Error: " + name + " not found in configuration tree. ***")
+
+        choices = [str(c) for c in config.get("choices", [])]
+        if len(choices) != 0 and value not in choices:
+            raise FakeGphotoError(
+                "*** Error: Choice " + value + " not found within list of choices. ***")
+        self.state["configs"][name] = value
+
+    ##########################################################################
+
+    def listing(self, folders):
+        self.operation("list")
+        lines = []
+        for folder in folders:
+            files = self.files(folder)
+            if len(files) == 0:
+                lines.append("There is no file in folder '" + folder + "'.")
+                continue
+            lines.append("There are " + str(len(files)) +
+                         " files in folder '" + folder + "'.")
+            for i, filename in enumerate(files):
+                lines.append("#" + str(i + 1) + "     " + filename.ljust(24) + " rd " +
+                             str(self.scenario["file_size"] // 1000) + " KB image/jpeg")
+        return "\n".join(lines)
+
+    ##########################################################################
+
+    def shell_listing(self, folder):
+        """
+        Output of the shell's "ls" command - the sub-folders (with a trailing
+        "/") and then the files, two to a line.
+        """
+        self.operation("list")
+        names = [os.path.basename(f) + "/" for f in self.folders()
+                 if f != folder and os.path.dirname(f) == folder]
+        names += self.files(folder)
+        lines = []
+        for i in range(0, len(names), 2):
+            lines.append(" ".join(["%-40s" % n for n in names[i:i + 2]]).rstrip())
+        return "\n".join(lines)
+
+    ##########################################################################
+
+    def stored_between(self, start, end):
+        """
+        Returns the (folder, filename) of the files which were stored on the
+        card between the start and end times, i.e. the files that a gphoto2
+        process listening for events during that time would hear about.
+        """
+        stored = []
+        for folder, entries in list(self.state["card"].items()):
+            for filename, available in entries:
+                if start < available <= end:
+                    stored.append((folder, filename))
+        return stored
+
+    ##########################################################################
+
+    def folders(self):
+        folders = set(["/"])
+        for folder in list(self.state["card"].keys()) + [self.scenario["folder"]]:
+            parts = folder.strip("/").split("/")
+            for i in range(len(parts)):
+                folders.add("/" + "/".join(parts[:i + 1]))
+        return sorted(folders)
+
+    ##########################################################################
+##########################################################################
+
+
+def filename_for(pattern, filename):
+    """
+    Expands the parts of a gphoto2 --filename pattern that pysces_asi uses.
+    """
+    if pattern is None:
+        return filename
+    name, extension = os.path.splitext(filename)
+    return pattern.replace("%C", extension.lstrip(".")).replace("%f", name)
+
+
+def write_file(camera, filename, destination, stdout):
+    camera.operation("download")
+    data = camera.file_data(filename)
+    if stdout:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        out.write(data)
+        out.flush()
+        return
+    with open(destination, "wb") as fp:
+        fp.write(data)
+    print("Saving file as " + destination)
+
+##########################################################################
+
+
+def run_command_line(camera, args):
+    """
+    Emulates a single (non-shell) gphoto2 call.
+    """
+    folder = "/"
+    pattern = None
+    stdout = False
+    recurse = True
+    wait_event = None
+    port = None
+    actions = []
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        name, sep, value = arg.partition("=")
+        if name in ("--get-config", "--set-config-value", "--filename") and not sep:
+            i += 1
+            value = args[i]
+
+        if name == "--folder":
+            folder = value
+        elif name == "--filename":
+            pattern = value
+        elif name == "--stdout":
+            stdout = True
+        elif name == "--no-recurse":
+            recurse = False
+        elif name == "--recurse":
+            recurse = True
+        elif name == "--wait-event":
+            wait_event = value
+        elif name == "--port":
+            port = value
+        elif name in ("--debug", "--quiet", "-q") or name.startswith("--debug-logfile"):
+            pass
+        else:
+            actions.append((name, value))
+        i += 1
+
+    for action, value in actions:
+        if action == "--auto-detect":
+            camera.operation("auto-detect")
+            print("Model".ljust(31) + "Port")
+            print("-" * 58)
+            if camera.scenario["connected"]:
+                print(camera.scenario["model"].ljust(31) + camera.scenario["port"])
+
+        elif not camera.scenario["connected"]:
+            raise FakeGphotoError("*** Error: No camera found. ***")
+
+        elif port is not None and port != camera.scenario["port"]:
+            raise FakeGphotoError(
+                "*** Error: Could not find the requested device on the USB bus ***")
+
+        elif action == "--list-config":
+            camera.operation("list-config")
+            for name in sorted(camera.scenario["configs"].keys()):
+                print("/main/settings/" + name)
+
+        elif action == "--get-config":
+            print(camera.get_config(value))
+
+        elif action == "--set-config-value":
+            name, sep, config_value = value.partition("=")
+            camera.set_config(name, config_value)
+
+        elif action in ("-L", "--list-files"):
+            if recurse:
+                folders = [f for f in camera.folders() if f == folder or
+                           f.startswith(folder.rstrip("/") + "/")]
+            else:
+                folders = [folder]
+            print(camera.listing(folders))
+
+        elif action in ("-l", "--list-folders"):
+            for f in camera.folders():
+                children = [c for c in camera.folders() if c != f and os.path.dirname(c) == f]
+                print("There are " + str(len(children)) + " folders in folder '" + f + "'.")
+                for child in children:
+                    print(" - " + os.path.basename(child))
+
+        elif action in ("-D", "--delete-all-files"):
+            for filename in camera.files(folder):
+                camera.delete(folder, filename)
+            print("Deleting all files in folder '" + folder + "'...")
+
+        elif action == "--delete-file":
+            filename = camera.files(folder)[int(value) - 1]
+            camera.delete(folder, filename)
+            print("Deleting file " + folder + "/" + filename + " on the camera")
+
+        elif action == "--get-file":
+            filename = camera.files(folder)[int(value) - 1]
+            write_file(camera, filename, filename_for(pattern, filename), stdout)
+
+        elif action in ("-P", "--get-all-files"):
+            for filename in camera.files(folder):
+                write_file(camera, filename, filename_for(pattern, filename), stdout)
+
+        elif action == "--capture-image":
+            for f, filename in camera.capture():
+                print("New file is in location " + f + "/" + filename + " on the camera")
+            sys.stdout.flush()
+
+        elif action == "--trigger-capture":
+            camera.capture(wait=False)
+
+        elif action == "--capture-image-and-download":
+            for f, filename in camera.capture():
+                print("New file is in location " + f + "/" + filename + " on the camera")
+                write_file(camera, filename, filename_for(pattern, filename), stdout)
+                camera.delete(f, filename)
+                print("Deleting file " + f + "/" + filename + " on the camera")
+
+        elif action == "--reset":
+            camera.operation("reset")
+
+        elif action == "--shell":
+            run_shell(camera)
+
+        else:
+            raise FakeGphotoError("*** Error: unsupported option " + action + " ***")
+
+    if wait_event is not None:
+        # like the real thing, report the files that are stored while we are
+        # waiting - pysces_asi stops us once it has seen the files it wants
+        wait_for_events(camera, parse_duration(wait_event))
+
+##########################################################################
+
+
+def wait_for_events(camera, duration):
+    """
+    Prints a FILEADDED event for each file stored on the card during the next
+    duration seconds.
+    """
+    start = time.time()
+    last_check = start
+    camera.save()
+    while True:
+        now = time.time()
+        camera.load()
+        stored = camera.stored_between(last_check, now)
+        camera.save()
+        for folder, filename in stored:
+            print("FILEADDED " + filename + " " + folder)
+        sys.stdout.flush()
+        last_check = now
+        if now - start >= duration:
+            break
+        time.sleep(min(0.05, duration))
+    camera.load()
+
+##########################################################################
+
+
+def parse_duration(value):
+    """
+    Converts a --wait-event duration (e.g. "5s" or "500ms") to seconds.
+    """
+    if value.endswith("ms"):
+        return float(value[:-2]) / 1000.0
+    return float(value.rstrip("s"))
+
+##########################################################################
+
+
+def run_shell(camera):
+    """
+    Emulates "gphoto2 --shell". The state is saved after each command, so
+    that other gphoto2 processes see the changes.
+    """
+    local_dir = os.getcwd()
+    folder = "/"
+    last_event_check = time.time()
+    camera.save()
+
+    while True:
+        sys.stdout.write(PROMPT % (local_dir, folder))
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if line == "":
+            return
+        words = line.strip().split(" ", 1)
+        command = words[0]
+        argument = words[1] if len(words) > 1 else ""
+
+        if command in ("exit", "quit", "q"):
+            return
+        if command == "":
+            continue
+
+        camera.load()
+        try:
+            if command == "lcd":
+                local_dir = argument
+            elif command == "cd":
+                folder = argument
+            elif command == "ls":
+                if argument == "":
+                    target = folder
+                else:
+                    target = os.path.normpath(os.path.join(folder, argument))
+                print(camera.shell_listing(target))
+            elif command == "get":
+                write_file(camera, argument, os.path.join(local_dir, argument), False)
+            elif command == "delete":
+                camera.delete(folder, argument)
+            elif command == "capture-image":
+                for f, filename in camera.capture():
+                    print("New file is in location " + f + "/" + filename + " on the camera")
+            elif command == "capture-image-and-download":
+                for f, filename in camera.capture():
+                    print("New file is in location " + f + "/" + filename + " on the camera")
+                    write_file(camera, filename, os.path.join(local_dir, filename), False)
+                    camera.delete(f, filename)
+            elif command == "trigger-capture":
+                camera.capture(wait=False)
+            elif command == "wait-event":
+                camera.save()
+                time.sleep(parse_duration(argument or "1s"))
+                camera.load()
+                now = time.time()
+                for f, filename in camera.stored_between(last_event_check, now):
+                    print("FILEADDED " + filename + " " + f)
+                last_event_check = now
+            elif command == "get-config":
+                print(camera.get_config(argument))
+            elif command == "set-config-value":
+                name, sep, value = argument.partition(" ")
+                camera.set_config(name, value)
+            else:
+                print("*** Error: Unknown command '" + command + "' ***")
+        except FakeGphotoError as ex:
+            print(ex.args[0])
+        finally:
+            camera.save()
+
+##########################################################################
+
+
+def main(args):
+    try:
+        scenario_file = os.environ["FAKE_GPHOTO2_SCENARIO"]
+    except KeyError:
+        sys.stderr.write("FAKE_GPHOTO2_SCENARIO is not set\n")
+        return 1
+
+    camera = FakeCamera(scenario_file, os.environ.get("FAKE_GPHOTO2_STATE"))
+    camera.load()
+    try:
+        run_command_line(camera, args)
+    except FakeGphotoError as ex:
+        sys.stdout.flush()
+        sys.stderr.write(ex.args[0] + "\n")
+        return 1
+    except KeyboardInterrupt:
+        # this is how pysces_asi stops --wait-event
+        return 130
+    finally:
+        if camera._lock_fp is not None and not camera._lock_fp.closed:
+            camera.save()
+    return 0
+
+##########################################################################
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
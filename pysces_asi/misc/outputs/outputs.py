@@ -34,11 +34,21 @@ log = logging.getLogger("outputs")
 
 
 def copy_image(image, output, settings_manager):
-    source_path = image.getFilename()
+    # images captured into memory have never been written to disk, so their
+    # raw data is written straight to the destination instead of copied
+    raw_buffer = getattr(image, "raw_buffer", None)
+    if raw_buffer is not None:
+        source_path = raw_buffer.filename
+    else:
+        source_path = image.getFilename()
     source_filename = os.path.basename(source_path)
     file_, extension = os.path.splitext(source_filename)
 
-    day_folder = settings_manager.get(["output folder"])["output folder"]
+    # the folder_on_host of the image is the camera's own folder if there are
+    # several cameras, otherwise it is the same as the output folder
+    day_folder = getattr(image, "folder_on_host", None)
+    if day_folder is None:
+        day_folder = settings_manager.get(["output folder"])["output folder"]
 
     dest_path = os.path.normpath(
         day_folder + "/" + output.folder_on_host + "/" + file_ + extension)
@@ -46,7 +56,10 @@ def copy_image(image, output, settings_manager):
     # copy the image
     settings_manager.set(
         {"output": "OutputTaskHandler> Copying " + source_path + " to " + dest_path})
-    shutil.copyfile(source_path, dest_path)
+    if raw_buffer is not None:
+        raw_buffer.save(dest_path)
+    else:
+        shutil.copyfile(source_path, dest_path)
 
     return None
 
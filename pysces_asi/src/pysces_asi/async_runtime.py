@@ -0,0 +1,311 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The async_runtime module provides an optional runtime in which the task
+queues of the managers (SettingsManager, NetworkManager, CameraManagers,
+CronManager, proxies etc.) share a single dispatcher thread, instead of each
+having its own worker threads which spend most of their time idle.
+
+When the runtime is enabled (see enable()), each ThreadQueueBase that is
+created afterwards becomes a QueueService of the runtime. The dispatcher 
+thread runs an event loop of callbacks: when a task is put into one of the
+queues, the service takes it out of the queue (at most 'workers' at a time,
+so queues with one worker still run their tasks one after another) and runs
+it in a shared executor, since the tasks themselves (gphoto calls, file I/O
+etc.) block. The executor only keeps threads while there is work for them (and
+never more than max_threads), so the number of threads follows the number of
+tasks actually running rather than the number of managers. Queues whose class
+defines its own _process_tasks() (such as the CaptureManager and the 
+OutputTaskHandler) keep their own threads.
+
+Code which needs to carry on once a task is done, without a thread of its own
+blocking on the result, can use ThreadQueueBase.submit_async() to have a 
+callback run in the dispatcher thread when the task finishes.
+
+The runtime only uses threads, so it works on all the versions of Python that
+pysces_asi does. Each process has its own runtime, which is started the first
+time that it is used (so worker processes forked after the runtime was 
+enabled get their own).
+"""
+import os
+import threading
+import logging
+
+from Queue import Queue, Empty
+
+log = logging.getLogger("async_runtime")
+
+# whether queues created from now on should use the runtime
+_enabled = False
+_idle_timeout = 60.0
+_max_threads = 16
+
+# the runtime of this process, and the pid it was created in
+_runtime = None
+_runtime_pid = None
+_runtime_lock = threading.Lock()
+
+##########################################################################
+
+
+def enable(idle_timeout=60.0, max_threads=16):
+    """
+    Makes ThreadQueueBase instances created from now on run on the runtime.
+    The executor runs at most max_threads tasks at once (None for no limit), 
+    and its threads are stopped once they have been idle for idle_timeout
+    seconds.
+    """
+    global _enabled, _idle_timeout, _max_threads
+    _idle_timeout = idle_timeout
+    _max_threads = max_threads
+    _enabled = True
+
+##########################################################################
+
+
+def enabled():
+    return _enabled
+
+##########################################################################
+
+
+def get_runtime():
+    """
+    Returns the Runtime of this process, starting it if necessary.
+    """
+    global _runtime, _runtime_pid
+    with _runtime_lock:
+        if _runtime is None or _runtime_pid != os.getpid():
+            _runtime = Runtime(_idle_timeout, _max_threads)
+            _runtime_pid = os.getpid()
+        return _runtime
+
+##########################################################################
+
+
+def shutdown():
+    """
+    Stops the runtime of this process (if it was started). All the queues
+    using it should have exited first.
+    """
+    global _runtime
+    with _runtime_lock:
+        runtime = _runtime
+        _runtime = None
+    if runtime is not None and _runtime_pid == os.getpid():
+        runtime.stop()
+
+##########################################################################
+
+
+class ElasticExecutor:
+    """
+    Runs functions in a pool of threads which grows whenever all of its
+    threads are busy (up to max_threads, None for no limit), and shrinks as
+    threads are left idle for idle_timeout seconds. Once there are max_threads
+    threads, functions wait in a queue for one of them to become free. Note
+    that a function which waits for another function submitted to the same
+    executor can then hold up the pool, so max_threads should be at least the
+    number of functions that can be waiting like this at once.
+    """
+
+    def __init__(self, idle_timeout=60.0, max_threads=None, name="Runtime executor"):
+        self.idle_timeout = idle_timeout
+        self.max_threads = max_threads
+        self.name = name
+        self._work = Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+        self._backlog = 0
+
+    ##########################################################################
+
+    def submit(self, function, *args):
+        """
+        Runs function(*args) in one of the threads, without waiting for it.
+        """
+        with self._lock:
+            self._backlog += 1
+            if self._backlog > self._idle and (self.max_threads is None or
+                                               self._threads < self.max_threads):
+                # all the threads are busy
+                self._threads += 1
+                self._idle += 1
+                thread = threading.Thread(target=self._worker)
+                thread.setName(self.name + " thread")
+                thread.daemon = True
+                thread.start()
+            self._work.put((function, args))
+
+    ##########################################################################
+
+    def _worker(self):
+        while True:
+            try:
+                function, args = self._work.get(timeout=self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    # work may have been put in the queue for us just as we
+                    # timed out
+                    if self._backlog > 0:
+                        continue
+                    self._idle -= 1
+                    self._threads -= 1
+                    return
+
+            if function is None:
+                return
+
+            with self._lock:
+                self._backlog -= 1
+                self._idle -= 1
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Exception in " + self.name)
+
+            with self._lock:
+                self._idle += 1
+
+    ##########################################################################
+
+    def thread_count(self):
+        with self._lock:
+            return self._threads
+
+    ##########################################################################
+
+    def stop(self):
+        """
+        Stops the threads once they have finished their current work.
+        """
+        with self._lock:
+            for i in range(self._threads):
+                self._work.put((None, ()))
+            self._threads = 0
+            self._idle = 0
+            self._backlog = 0
+
+    ##########################################################################
+##########################################################################
+
+
+class Runtime:
+    """
+    A dispatcher thread which runs the callbacks given to call_soon() one 
+    after another, with an ElasticExecutor for blocking work.
+    """
+
+    def __init__(self, idle_timeout=60.0, max_threads=None):
+        self.executor = ElasticExecutor(idle_timeout, max_threads)
+        self._callbacks = Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setName("Runtime dispatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    ##########################################################################
+
+    def _run(self):
+        while True:
+            callback, args = self._callbacks.get()
+            if callback is None:
+                return
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("Exception in runtime callback")
+
+    ##########################################################################
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules callback(*args) to be run by the dispatcher thread (from any
+        thread).
+        """
+        self._callbacks.put((callback, args))
+
+    ##########################################################################
+
+    def stop(self):
+        """
+        Stops the dispatcher once it has run the callbacks already scheduled,
+        and then the executor.
+        """
+        self._callbacks.put((None, ()))
+        self._thread.join()
+        self.executor.stop()
+
+    ##########################################################################
+##########################################################################
+
+
+class QueueService:
+    """
+    Runs the tasks put into a ThreadQueueBase's task queue in the runtime's
+    executor, with at most 'workers' of them running at once. The queue calls
+    notify() each time it is given a task. All the other methods run in the
+    runtime's dispatcher thread.
+    """
+
+    def __init__(self, runtime, task_queue, workers, name):
+        self.runtime = runtime
+        self.name = name
+        self._task_queue = task_queue
+        self._workers = workers
+        self._running = 0
+
+    ##########################################################################
+
+    def notify(self):
+        """
+        Tells the service that there is a new task in the queue.
+        """
+        self.runtime.call_soon(self._dispatch)
+
+    ##########################################################################
+
+    def _dispatch(self):
+        while self._running < self._workers:
+            try:
+                task = self._task_queue.get_nowait()
+            except Empty:
+                return
+            self._running += 1
+            self.runtime.executor.submit(self._execute, task)
+
+    ##########################################################################
+
+    def _execute(self, task):
+        """
+        Run by the executor.
+        """
+        try:
+            task.execute()
+        finally:
+            self._task_queue.task_done()
+            self.runtime.call_soon(self._task_finished)
+
+    ##########################################################################
+
+    def _task_finished(self):
+        self._running -= 1
+        self._dispatch()
+
+    ##########################################################################
+##########################################################################
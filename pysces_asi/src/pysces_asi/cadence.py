@@ -0,0 +1,185 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The cadence module provides the CadenceScheduler class, which the
+CaptureManager uses to decide when each frame should be captured. Frames are
+scheduled in "slots" a fixed period (the delay of the capture mode) apart. The
+slot times are calculated from the start of the grid rather than from the
+time the previous frame was actually captured, so that small delays do not
+add up into drift.
+
+Capture modes with phase_lock set use a grid fixed to UTC (e.g. every 10 s on
+:00, :10, :20 ...), so that stations with synchronised clocks capture their
+frames at the same time. If a frame is too late for its slot, then the slot is
+skipped rather than shifting the grid. Other capture modes use a grid that
+starts with their first frame, and which is timed with the monotonic clock
+(where available), so that it is not upset by the system clock being
+adjusted. If one of their frames is late, then the next one is captured
+straight away and the grid restarts from there.
+
+The scheduler also records how late each frame was started relative to its
+slot (the jitter), and how many slots were missed.
+"""
+import math
+import time
+import datetime
+
+# the monotonic clock is only available in Python >= 3.3
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class CadenceScheduler:
+    """
+    Works out when the frames of a capture mode should be captured. Call
+    wait_time() to find out how long to wait before the next frame, and
+    start_frame() when it is captured.
+
+    The period is the time between slots in seconds. If phase_lock is True,
+    then the slots are at offset + n * period seconds past midnight UTC on 1st
+    Jan 1970 (i.e. a period of 10 puts them on :00, :10, :20 ...). If
+    top_of_min is True, then the first frame of a grid that isn't phase
+    locked is captured at the start of the next minute. A frame may be up to
+    late_tolerance of a period late for its slot, after that the slot is
+    missed.
+    """
+
+    def __init__(self, period, phase_lock=False, offset=0.0, top_of_min=False,
+                 late_tolerance=0.1, clock=time.time, monotonic_clock=monotonic):
+        self.period = float(period)
+        self.phase_lock = phase_lock
+        self.offset = float(offset)
+        self.top_of_min = top_of_min
+        self.late_tolerance = late_tolerance
+
+        # phase locked grids are defined in terms of UTC, so they have to use
+        # the system clock
+        self._wall_clock = clock
+        if phase_lock:
+            self._clock = clock
+        else:
+            self._clock = monotonic_clock
+
+        self._next_slot = None
+
+        self.frames = 0
+        self.missed_slots = 0
+        self._jitter_total = 0.0
+        self._jitter_squares = 0.0
+        self._jitter_min = None
+        self._jitter_max = None
+        self._jitter_last = None
+
+    ##########################################################################
+
+    @classmethod
+    def for_capture_mode(cls, capture_mode):
+        """
+        Returns a CadenceScheduler for the capture mode, using its delay,
+        phase_lock, phase_offset and top_of_min settings.
+        """
+        return cls(capture_mode.delay,
+                   phase_lock=getattr(capture_mode, "phase_lock", False),
+                   offset=getattr(capture_mode, "phase_offset", 0.0),
+                   top_of_min=getattr(capture_mode, "top_of_min", False))
+
+    ##########################################################################
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the slot of the next frame, or 0
+        if it should be captured now. If the slot has already passed (by more
+        than the late tolerance), then the next slot is chosen instead, or for
+        grids that aren't phase locked the grid is restarted now.
+        """
+        now = self._clock()
+
+        if self._next_slot is None:
+            self._next_slot = self._first_slot(now)
+
+        elif now - self._next_slot > self.late_tolerance * self.period:
+            if self.phase_lock:
+                missed = int(math.ceil((now - self._next_slot) / self.period))
+                self.missed_slots += missed
+                self._next_slot += missed * self.period
+            else:
+                self._next_slot = now
+
+        return max(0.0, self._next_slot - now)
+
+    ##########################################################################
+
+    def start_frame(self):
+        """
+        Records that the frame for the current slot is being captured now,
+        and moves on to the next slot. Returns the jitter of the frame, i.e.
+        how many seconds after its slot it was started.
+        """
+        now = self._clock()
+        if self._next_slot is None:
+            self._next_slot = now
+
+        jitter = now - self._next_slot
+        self._next_slot += self.period
+
+        self.frames += 1
+        self._jitter_total += jitter
+        self._jitter_squares += jitter * jitter
+        self._jitter_last = jitter
+        if self._jitter_min is None or jitter < self._jitter_min:
+            self._jitter_min = jitter
+        if self._jitter_max is None or jitter > self._jitter_max:
+            self._jitter_max = jitter
+        return jitter
+
+    ##########################################################################
+
+    def stats(self):
+        """
+        Returns a dict of {'frames', 'missed_slots', 'jitter_mean',
+        'jitter_rms', 'jitter_min', 'jitter_max', 'jitter_last'}, where the
+        jitters are in seconds (None if no frames have been captured).
+        """
+        stats = {'frames': self.frames, 'missed_slots': self.missed_slots,
+                 'jitter_mean': None, 'jitter_rms': None,
+                 'jitter_min': self._jitter_min, 'jitter_max': self._jitter_max,
+                 'jitter_last': self._jitter_last}
+        if self.frames > 0:
+            stats['jitter_mean'] = self._jitter_total / self.frames
+            stats['jitter_rms'] = math.sqrt(self._jitter_squares / self.frames)
+        return stats
+
+    ##########################################################################
+
+    def _first_slot(self, now):
+        """
+        Returns the time (on our clock) of the first slot after now.
+        """
+        if self.phase_lock:
+            return (math.floor((now - self.offset) / self.period) + 1) * self.period + self.offset
+
+        if self.top_of_min:
+            # the wait is worked out using the system clock, then converted to
+            # our clock
+            utc_now = datetime.datetime.utcfromtimestamp(self._wall_clock())
+            top_of_min = utc_now.replace(second=0, microsecond=0) + \
+                datetime.timedelta(minutes=1)
+            return now + (top_of_min - utc_now).total_seconds()
+
+        return now
+
+    ##########################################################################
+##########################################################################
@@ -31,13 +31,26 @@ import time
 import glob
 import os.path
 import imp
+import pickle
+import re
+import logging
+import threading
 # Import backport of the python 3.2 subprocess that contains timeout
-from subprocess32 import STDOUT, check_output as qx, TimeoutExpired, Popen
+from subprocess32 import STDOUT, PIPE, check_output as qx, TimeoutExpired, Popen
 from subprocess32 import CalledProcessError
 
 from pysces_asi.multitask import ThreadQueueBase, ThreadTask
+from pysces_asi.gphoto_session import GphotoSession, GphotoSessionError
+from pysces_asi.card_index import CardIndex, parse_listing
+from pysces_asi.camera_metrics import CameraMetrics, timed
+from pysces_asi.camera_recovery import RecoveryController, RETRY, RESET, REENUMERATE
+from pysces_asi import usb_device
+from pysces_asi.data_storage_classes import CaptureMode, FILENAME_TIME_FORMAT
+from pysces_asi.settings_manager import get_optional
 
 
+log = logging.getLogger("camera")
+
 cameras = {}  # dict to hold all camera plugins
 
 
@@ -76,21 +89,26 @@ def clear_plugins_list():
     cameras.clear()
 
 def _timeout_call(command,timeout,stderr=STDOUT):
-    " For making sure the process dies after timeout"
+    """ 
+    For making sure the process dies after timeout. Returns the output of the
+    command, or raises TimeoutExpired once the process has been killed.
+    """
     if stderr is None:
-        with Popen(command, shell=True, preexec_fn=os.setsid) as process:
+        with Popen(command, shell=True, stdout=PIPE, preexec_fn=os.setsid) as process:
             try:
                 output,_ = process.communicate(timeout=timeout)
             except TimeoutExpired:
                 os.killpg(process.pid, signal.SIGINT) # send signal to the process group
-                output,_ = process.communicate()
+                process.communicate()
+                raise
     else:
-        with Popen(command, shell=True, stderr=stderr, preexec_fn=os.setsid) as process:
+        with Popen(command, shell=True, stdout=PIPE, stderr=stderr, preexec_fn=os.setsid) as process:
             try:
                 output,_ = process.communicate(timeout=timeout)
             except TimeoutExpired:
                 os.killpg(process.pid, signal.SIGINT) # send signal to the process group
-                output,_ = process.communicate()
+                process.communicate()
+                raise
     return output
 
 def call_shell(command, timeout, error_text, output_stderr=False):
@@ -140,6 +158,68 @@ class GphotoError(Exception):
     pass
 
 
+class CameraRecoveryError(GphotoError):
+    """
+    Raised instead of using the camera while it is backing off after a run of
+    failures (see the camera_recovery module). The failure that caused the 
+    backoff has already been reported, so these can be ignored.
+    """
+    pass
+
+
+class CameraSettings:
+    """
+    Wraps the SettingsManager for one of several cameras that are driven by
+    the same CaptureManager. The camera's own values of 'camera_name', 
+    'camera_port' and 'tmp dir' (a sub-folder of the global tmp dir named 
+    after the camera) are returned in place of the global ones, and the
+    camera's name is added to its output messages. Everything else is passed
+    straight through to the SettingsManager.
+    """
+
+    def __init__(self, settings_manager, name, port):
+        self._settings_manager = settings_manager
+        self.name = name
+        self.port = port
+
+    ##########################################################################
+
+    def get(self, names):
+        own_values = {'camera_name': self.name, 'camera_port': self.port}
+
+        global_names = [n for n in names if n not in own_values]
+        if len(global_names) > 0:
+            values = self._settings_manager.get(global_names)
+        else:
+            values = {}
+
+        for name in names:
+            if name in own_values:
+                values[name] = own_values[name]
+
+        if 'tmp dir' in values:
+            values['tmp dir'] = os.path.normpath(
+                values['tmp dir'] + "/" + self.name)
+        return values
+
+    ##########################################################################
+
+    def set(self, values):
+        if 'output' in values:
+            values = dict(values)
+            values['output'] = values['output'].replace(
+                "CameraManager>", "CameraManager(" + self.name + ")>", 1)
+        return self._settings_manager.set(values)
+
+    ##########################################################################
+
+    def __getattr__(self, name):
+        return getattr(self._settings_manager, name)
+
+    ##########################################################################
+##########################################################################
+
+
 class CameraManagerBase(ThreadQueueBase):
     """
     Base class for camera managers. Classes inheriting from this base class 
@@ -150,7 +230,41 @@ class CameraManagerBase(ThreadQueueBase):
     """
 
     def __init__(self, settings_manager):
-        ThreadQueueBase.__init__(self, name="CameraManager")
+        self._settings_manager = settings_manager
+
+        # the name of the camera, if it is one of several (see CameraSettings)
+        self.camera_name = get_optional(settings_manager, "camera_name", None)
+
+        if self.camera_name is None:
+            ThreadQueueBase.__init__(self, name="CameraManager")
+        else:
+            ThreadQueueBase.__init__(
+                self, name="CameraManager(" + self.camera_name + ")")
+
+        # timings of the different phases of the capture cycle, written to the
+        # metrics file (if there is one) every camera_metrics_interval seconds
+        metrics_file = get_optional(settings_manager, "camera_metrics_file", "")
+        if metrics_file:
+            metrics_file = os.path.expanduser(metrics_file)
+        self._metrics = CameraMetrics(
+            metrics_file, get_optional(settings_manager, "camera_metrics_interval", 300))
+
+        # whether the camera is plugged in, as far as we know (see 
+        # _presence_changed()), and the functions to tell when it changes
+        self._camera_present = True
+        self._presence_listeners = []
+
+        # decides how to recover from capture failures, and how long to leave
+        # the camera alone for afterwards
+        self._recovery = RecoveryController(
+            get_optional(settings_manager, "camera_backoff_initial", 5),
+            get_optional(settings_manager, "camera_backoff_max", 300),
+            get_optional(settings_manager, "camera_breaker_threshold", 6))
+
+        # set when a call run by _run_with_recovery() has captured an image,
+        # since only that shows that the camera is working again (configs can
+        # usually still be set on a camera that fails every capture)
+        self._camera_worked = False
 
         try:
             # check that camera is connected
@@ -167,6 +281,7 @@ class CameraManagerBase(ThreadQueueBase):
 
             self.camera_configs = self.download_configs()
             self.capture_mode = None
+            self._capture_mode_hash = None
         except Exception as ex:
             self.exit()
             raise ex
@@ -176,26 +291,67 @@ class CameraManagerBase(ThreadQueueBase):
     # define public methods - these just queue protected methods for exectuion by
     # the internal worker thread.
     def set_capture_mode(self, capture_mode):
+        return self.start_set_capture_mode(capture_mode).result()
+
+    ##########################################################################
+
+    def capture_images(self):
+        return self.start_capture_images().result()
+
+    ##########################################################################
+
+    def capture_burst(self, number_of_frames):
+        return self.start_capture_burst(number_of_frames).result()
+
+    ##########################################################################
+
+    def start_set_capture_mode(self, capture_mode):
+        """
+        Queues setting the capture mode and returns the task without waiting
+        for it to complete. Call result() on the returned task to wait for it.
+        This allows several cameras to be set up at the same time.
+        """
         # create task
-        task = ThreadTask(self._set_capture_mode, capture_mode)
+        task = ThreadTask(self._run_with_recovery,
+                          self._apply_capture_mode, capture_mode)
 
         # submit task
         self.commit_task(task)
 
-        # return result when task has been completed
-        return task.result()
+        return task
 
     ##########################################################################
 
-    def capture_images(self):
+    def start_capture_images(self):
+        """
+        Queues capturing images and returns the task without waiting for it to
+        complete. Call result() on the returned task to get the images. This
+        allows several cameras to capture at the same time.
+        """
         # create task
-        task = ThreadTask(self._capture_images)
+        task = ThreadTask(self._run_with_recovery, self._run_capture)
 
         # submit task
         self.commit_task(task)
 
-        # return result when task has been completed
-        return task.result()
+        return task
+
+    ##########################################################################
+
+    def start_capture_burst(self, number_of_frames):
+        """
+        As start_capture_images(), but captures a burst of number_of_frames 
+        images as quickly as possible (see _capture_burst()). The result of 
+        the returned task is a list of the dicts of images of each frame.
+        """
+        # create task
+        task = ThreadTask(self._run_with_recovery,
+                          self._run_burst, number_of_frames)
+
+        # submit task
+        self.commit_task(task)
+
+        return task
 
     ##########################################################################
 
@@ -249,6 +405,232 @@ class CameraManagerBase(ThreadQueueBase):
 
     ##########################################################################
 
+    def exit(self):
+        """
+        Writes the metrics file (if there is one) and kills the internal 
+        worker thread.
+        """
+        if self._metrics.filename:
+            try:
+                self._metrics.write()
+            except (IOError, OSError) as ex:
+                log.warning("Failed to write camera metrics file: " + str(ex))
+
+        ThreadQueueBase.exit(self)
+
+    ##########################################################################
+
+    def get_metrics(self):
+        """
+        Returns a summary of the time taken by each phase of the capture 
+        cycle and of the retry, timeout and failure counters (see 
+        CameraMetrics.summary()). This can be called while the camera is busy.
+        """
+        return self._metrics.summary()
+
+    ##########################################################################
+
+    def is_present(self):
+        """
+        Returns False if the camera is known to have been unplugged, True 
+        otherwise. Unlike is_connected(), this doesn't need to talk to the 
+        camera, so it returns straight away even if the camera is busy.
+        """
+        return self._camera_present
+
+    ##########################################################################
+
+    def add_presence_listener(self, listener):
+        """
+        Registers a function to be called as listener(camera_name, present)
+        when the camera is plugged in (present=True) or unplugged 
+        (present=False). The listener is called from a monitoring thread, so
+        it should return quickly.
+        """
+        self._presence_listeners.append(listener)
+
+    ##########################################################################
+
+    def get_recovery_state(self):
+        """
+        Returns a dict describing whether the camera is working normally, 
+        recovering from failures or degraded (see 
+        RecoveryController.state()). This can be called while the camera is 
+        busy.
+        """
+        return self._recovery.state()
+
+    ##########################################################################
+
+    def _run_with_recovery(self, method, *args):
+        """
+        Runs method(*args), unless the camera is still backing off after a
+        failure, in which case a CameraRecoveryError is raised straight away
+        rather than wasting time on a camera which is known to be failing. If 
+        the method raises a GphotoError, then the recovery action chosen by 
+        the recovery controller is carried out before the error is re-raised.
+        The run of failures is only ended by a completed capture (see
+        _camera_worked), so setting the capture mode doesn't count as a 
+        success, even if the camera's configs had to be changed.
+        """
+        if not self._camera_present:
+            raise CameraRecoveryError("Camera is disconnected")
+
+        wait_time = self._recovery.wait_time()
+        if wait_time > 0:
+            raise CameraRecoveryError(
+                "Camera is " + self._recovery.state()['state'] + ", next attempt in " + str(int(wait_time) + 1) + "s")
+
+        self._camera_worked = False
+        try:
+            result = method(*args)
+        except CameraRecoveryError:
+            raise
+        except GphotoError as ex:
+            self._handle_failure(ex)
+            raise
+
+        if self._camera_worked and self._recovery.success():
+            self._settings_manager.set(
+                {"output": "CameraManager> Camera has recovered"})
+        return result
+
+    ##########################################################################
+
+    def _presence_changed(self, present):
+        """
+        Records that the camera has been plugged in or unplugged and tells 
+        the presence listeners. Sub-classes which can detect this should call
+        it (from any thread). While the camera is unplugged, capturing images 
+        and setting the capture mode fail straight away with a 
+        CameraRecoveryError.
+        """
+        if present == self._camera_present:
+            return
+        self._camera_present = present
+
+        if present:
+            self._settings_manager.set(
+                {"output": "CameraManager> Camera connected"})
+        else:
+            self._settings_manager.set(
+                {"output": "CameraManager> Camera disconnected"})
+
+        for listener in self._presence_listeners:
+            try:
+                listener(self.camera_name, present)
+            except Exception:
+                log.exception("Error in camera presence listener")
+
+    ##########################################################################
+
+    def _handle_failure(self, error):
+        """
+        Records a failure with the recovery controller and carries out the
+        recovery action that it chooses.
+        """
+        was_degraded = self._recovery.degraded
+        failure_class, action = self._recovery.failure(error)
+        self._metrics.count("failures_" + failure_class)
+
+        if action != RETRY:
+            self._settings_manager.set(
+                {"output": "CameraManager> Recovering from " + failure_class + " failure: " + action})
+            try:
+                with self._metrics.timer(action):
+                    self._recover(action)
+            except GphotoError as ex:
+                log.warning("CameraManager> Recovery (" + action + ") failed: " + ex.args[0])
+            self._recovery.start_backoff()
+
+        if self._recovery.degraded and not was_degraded:
+            self._settings_manager.set(
+                {"output": "CameraManager> ** Camera degraded ** after " + str(self._recovery.consecutive_failures) +
+                 " failures, retrying every " + str(self._recovery.backoff_max) + "s"})
+
+    ##########################################################################
+
+    def _run_capture(self):
+        """
+        Runs _capture_images(), recording the time taken by the complete 
+        capture cycle and writing the metrics file if it is due.
+        """
+        try:
+            with self._metrics.timer("capture_cycle"):
+                images = self._capture_images()
+            self._camera_worked = True
+            return images
+        finally:
+            try:
+                self._metrics.write_if_due()
+            except (IOError, OSError) as ex:
+                log.warning("Failed to write camera metrics file: " + str(ex))
+
+    ##########################################################################
+
+    def _run_burst(self, number_of_frames):
+        """
+        Runs _capture_burst(), recording the time taken by the complete burst
+        and writing the metrics file if it is due.
+        """
+        try:
+            with self._metrics.timer("burst"):
+                frames = self._capture_burst(number_of_frames)
+            self._camera_worked = True
+            return frames
+        finally:
+            try:
+                self._metrics.write_if_due()
+            except (IOError, OSError) as ex:
+                log.warning("Failed to write camera metrics file: " + str(ex))
+
+    ##########################################################################
+
+    def _timestamp(self, time_of_capture):
+        """
+        Returns the string used to name the image files captured at 
+        time_of_capture, which includes the milliseconds if the current 
+        capture mode is a burst mode (see CaptureMode.timestamp()).
+        """
+        if self.capture_mode is None:
+            return time_of_capture.strftime(FILENAME_TIME_FORMAT)
+        return self.capture_mode.timestamp(time_of_capture)
+
+    ##########################################################################
+
+    def _write_info_file(self, info, info_filename):
+        """
+        Pickles the PASKIL info dict into info_filename (see the PASKIL plugin
+        in PASKIL_jpg_plugin), recording the time taken.
+        """
+        with self._metrics.timer("info_file"):
+            with open(info_filename, "wb") as fp:
+                pickle.dump(info, fp)
+
+    ##########################################################################
+
+    def _apply_capture_mode(self, capture_mode):
+        """
+        Runs _set_capture_mode(), unless the camera has already been set up 
+        for a capture mode with the same camera_hash(), in which case only the
+        capture_mode attribute is updated. This makes setting the capture mode
+        before every image (as the CaptureManager does) free once the camera 
+        is set up.
+        """
+        mode_hash = capture_mode.camera_hash()
+        if self.capture_mode is not None and mode_hash == self._capture_mode_hash:
+            self.capture_mode = capture_mode
+            return
+
+        # if setting the mode fails, then we don't know what state the camera
+        # is in, so we must not skip the next attempt
+        self._capture_mode_hash = None
+        with self._metrics.timer("set_config"):
+            self._set_capture_mode(capture_mode)
+        self._capture_mode_hash = mode_hash
+
+    ##########################################################################
+
     def _set_capture_mode(self, capture_mode):
         """
         Given a CaptureMode object (see the data_storage_classes module) this method
@@ -275,6 +657,40 @@ class CameraManagerBase(ThreadQueueBase):
 
     ##########################################################################
 
+    def _recover(self, action):
+        """
+        This method should try to bring a failing camera back into a working
+        state. The action argument is either RESET or REENUMERATE (see the 
+        camera_recovery module). If the camera cannot be recovered in this 
+        way, then it should just return without error.
+        """
+        pass
+
+    ##########################################################################
+
+    def _capture_burst(self, number_of_frames):
+        """
+        This method should capture number_of_frames images as quickly as 
+        possible and return a list of dicts (one for each frame) in the same 
+        format as those returned by _capture_images(). Cameras which support
+        continuous shooting should override it. This default implementation
+        calls _capture_images() repeatedly, starting a frame every 
+        capture_mode.delay seconds (to the millisecond).
+        """
+        frames = []
+        start_time = time.time()
+        for i in range(number_of_frames):
+            wait = start_time + i * self.capture_mode.delay - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            images = self._capture_images()
+            if images is not None:
+                frames.append(images)
+        return frames
+
+    ##########################################################################
+
     def _clear_camera(self):
         """
         This method should clear all images from the camera. If it is not possible with
@@ -308,43 +724,442 @@ class GphotoCameraManager(CameraManagerBase):
     """
     The GphotoCameraManager class must also be sub-classed in order to be used.
     It provides methods that are general to gphoto2 compatible cameras.
+
+    Sub-classes should list any configs that they use internally (i.e. that
+    are not set in the capture modes in the settings file) in the
+    required_configs attribute, so that they are downloaded from the camera
+    during initialisation.
     """
 
+    required_configs = []
+
     def __init__(self, settings_manager):
         self._settings_manager = settings_manager
+        self._camera_model = None
+        self._camera_port = None
+        self._card_index = CardIndex()
+        self._new_files = []
+        self._missing_configs = set()
+
+        # set when the camera has been reset or reconnected, so that the 
+        # configs in camera_configs may no longer match the camera
+        self._configs_stale = False
+
+        # the gphoto2 executable can be replaced by a stand-in (see
+        # misc/fake_gphoto2.py) for testing without a camera. If several
+        # cameras are connected, then each one is bound to its own USB port
+        self._gphoto2_executable = get_optional(
+            settings_manager, "gphoto2_executable", "gphoto2")
+        self._port = get_optional(settings_manager, "camera_port", None)
+        if self._port:
+            self._gphoto2_executable += " --port=" + self._port
+
+        # where to find the camera in the USB device tree, for re-enumerating
+        # it when nothing else will bring it back
+        self._usb_sysfs_root = get_optional(
+            settings_manager, "usb_sysfs_root", usb_device.DEFAULT_SYSFS_ROOT)
+
+        # if requested, run the gphoto2 commands through a single persistent
+        # gphoto2 shell rather than starting a new process for each one
+        if get_optional(settings_manager, "gphoto2_session", False):
+            self._session = GphotoSession(executable=self._gphoto2_executable)
+        else:
+            self._session = None
+
+        # how to find out when images captured to the camera card have been
+        # stored - either "events" or "poll"
+        self._capture_completion = get_optional(
+            settings_manager, "capture_completion", "events")
+
+        # whether images should be downloaded straight into memory rather
+        # than into the tmp dir
+        self._capture_to_memory = get_optional(
+            settings_manager, "capture_to_memory", False)
+
+        # whether the next image should be exposed while the previous one is
+        # downloaded (see _capture_photos())
+        self._pipelined_capture = get_optional(
+            settings_manager, "pipelined_capture", False)
+        self._pending_frame = None
+
+        # if the camera's USB vendor and product IDs are given (e.g. 
+        # "04b0:0412"), then the USB device tree is watched so that we find out
+        # straight away when the camera is unplugged or plugged back in
+        usb_id = get_optional(settings_manager, "camera_usb_id", "")
+        if usb_id:
+            vendor_id, product_id = usb_id.split(":")
+            self._presence_monitor = usb_device.PresenceMonitor(
+                vendor_id, product_id, self._usb_devices_changed,
+                self._usb_sysfs_root,
+                get_optional(settings_manager, "usb_presence_interval", 1.0))
+
+            # if we are bound to a port, then we follow the device plugged
+            # into the same physical USB socket, since the port changes each 
+            # time the camera is plugged in
+            self._usb_device_name = None
+            if self._port:
+                device_path = usb_device.find_device(
+                    self._port, self._usb_sysfs_root)
+                if device_path is not None:
+                    self._usb_device_name = os.path.basename(device_path)
+        else:
+            self._presence_monitor = None
+
         CameraManagerBase.__init__(self, settings_manager)
 
+        if self._presence_monitor is not None:
+            self._usb_devices_changed(self._presence_monitor.devices)
+            self._presence_monitor.start()
+
     ##########################################################################
 
-    def _clear_camera(self):
-        # get a list of the folders on the camera
-        p = call_shell("gphoto2 -l", 30,
-                       error_text="Gphoto2 Error: Unable to download the list of folders")
-        # read output lines from pipe
-        lines = p.splitlines()
-
-        # get the current and possible values for all the different configs
-        for folder in lines:
-            folder = folder.lstrip().rstrip()
-            # skip blank lines
-            if folder.isspace() or folder == "":
-                continue
-            # skip lines not describing folders
-            if not folder.startswith("There"):
-                continue
+    def exit(self):
+        """
+        Kills the internal worker thread and closes the gphoto2 shell session
+        (if there is one).
+        """
+        if getattr(self, "_presence_monitor", None) is not None:
+            self._presence_monitor.stop()
+
+        CameraManagerBase.exit(self)
+
+        if self._session is not None:
+            self._session.close()
+
+        # store any configs that were downloaded while we were running
+        try:
+            self._save_config_cache(self.camera_configs)
+        except AttributeError:
+            # the configs were never downloaded
+            pass
+
+    ##########################################################################
+
+    def _apply_capture_mode(self, capture_mode):
+        """
+        As CameraManagerBase._apply_capture_mode(), but if the camera set up 
+        is going to change, then any image still waiting to be downloaded by
+        the capture pipeline is discarded first.
+        """
+        if (self._pending_frame is not None and
+                capture_mode.camera_hash() != self._capture_mode_hash):
+            self._discard_pending_frame()
+
+        CameraManagerBase._apply_capture_mode(self, capture_mode)
+
+    ##########################################################################
+
+    def get_metrics(self):
+        """
+        Returns the metrics recorded by CameraManagerBase.get_metrics(), with
+        the number of times that the gphoto2 shell session has had to be 
+        restarted added to the counters.
+        """
+        metrics = CameraManagerBase.get_metrics(self)
+        if self._session is not None:
+            metrics['counters']['session_reconnects'] = self._session.reconnects
+        return metrics
+
+    ##########################################################################
+
+    def get_session_latencies(self):
+        """
+        Returns the per-command latencies recorded by the gphoto2 shell
+        session (see GphotoSession.get_latencies()), or an empty dict if the
+        session backend is not being used.
+        """
+        if self._session is None:
+            return {}
+        task = ThreadTask(self._session.get_latencies)
+
+        # submit task
+        self.commit_task(task)
+
+        # return result when task has been completed
+        return task.result()
 
-            # skip root folder and special folder
-            if folder.endswith(["\'/\'.", "\'/special\'."]):
+    ##########################################################################
+
+    def _gphoto(self, args, timeout, error_text, shell_command=None,
+                output_stderr=False, opens_camera=True):
+        """
+        Runs a gphoto2 command and returns its output. The args argument
+        should be the command line arguments for gphoto2 e.g. "--capture-image".
+        If the session backend is in use and an equivalent gphoto2 shell
+        command is given as shell_command (e.g. "capture-image"), then the
+        command is sent to the persistent shell. Otherwise the shell session
+        is closed (releasing the camera) and a new gphoto2 process is run,
+        unless opens_camera is False (e.g. for --auto-detect, which only looks
+        at the USB bus).
+        """
+        try:
+            if self._session is not None and opens_camera:
+                if shell_command is not None:
+                    try:
+                        return self._session.run(shell_command, timeout=timeout)
+                    except GphotoSessionError as ex:
+                        raise GphotoError(error_text + " \n " + ex.args[0])
+
+                # the shell holds the camera open, so it has to be closed
+                # before another gphoto2 process can talk to the camera
+                self._session.close()
+
+            return call_shell(self._gphoto2_executable + " " + args, timeout, error_text=error_text,
+                              output_stderr=output_stderr)
+        except GphotoError as ex:
+            if ex.args[0].count("Timeout") != 0:
+                self._metrics.count("timeouts")
+            raise
+
+    ##########################################################################
+
+    def _list_files(self, folder=None, timeout=30):
+        """
+        Lists the files on the camera card, or only those in folder (not 
+        including its sub-folders), and returns a dict of {folder:[filenames]}
+        (see card_index.parse_listing()). The shell's "ls" command is used if
+        the session backend is in use, and gphoto2 --list-files otherwise.
+        """
+        error_text = "Gphoto2 Error: Unable to list of files on camera card"
+        if self._session is not None:
+            try:
+                if folder is None:
+                    return self._session.list_files("/", recurse=True, timeout=timeout)
+                return self._session.list_files(folder, recurse=False, timeout=timeout)
+            except GphotoSessionError as ex:
+                if ex.args[0].count("Timeout") != 0:
+                    self._metrics.count("timeouts")
+                raise GphotoError(error_text + " \n " + ex.args[0])
+
+        if folder is None:
+            args = "-L "
+        else:
+            args = "-L --no-recurse --folder=" + folder
+        return parse_listing(self._gphoto(args, timeout=timeout, error_text=error_text).splitlines())
+
+    ##########################################################################
+
+    def _gphoto_stdout(self, args, timeout, error_text):
+        """
+        Runs a gphoto2 command with the --stdout option and returns the raw
+        bytes that it writes to stdout (i.e. the contents of the file(s) it has
+        downloaded). This cannot be done using the shell session, so the 
+        session is closed first.
+        """
+        if self._session is not None:
+            self._session.close()
+
+        command = self._gphoto2_executable + " " + args + " --stdout"
+        with Popen(command, shell=True, stdout=PIPE, stderr=PIPE, preexec_fn=os.setsid) as process:
+            try:
+                data, errors = process.communicate(timeout=timeout)
+            except TimeoutExpired:
+                os.killpg(process.pid, signal.SIGINT)
+                process.communicate()
+                self._metrics.count("timeouts")
+                raise GphotoError(error_text + " \n Timeout \n Command:" + command)
+
+        if process.returncode != 0 or len(data) == 0:
+            raise GphotoError(error_text + " \n " + errors.decode("utf-8", "replace") +
+                              " \n Command:" + command)
+        return data
+
+    ##########################################################################
+
+    @timed("download")
+    def _read_photos(self, folder_on_camera):
+        """
+        Downloads the images found by the last call to _take_photo() that are
+        in folder_on_camera straight into memory. Returns a dict of 
+        {extension:bytes}, where extension is the lower case file extension 
+        of the image on the camera e.g. ".jpg".
+        """
+        self._settings_manager.set(
+            {"output": "CameraManager> Downloading image(s) into memory"})
+
+        # refresh the folder so that the file numbers are correct
+        self._refresh_folder_index(folder_on_camera, [filename for folder, filename in self._new_files
+                                                      if folder == folder_on_camera])
+
+        images = {}
+        for folder, filename in self._new_files:
+            if folder != folder_on_camera:
                 continue
+            number = self._card_index.file_number(folder, filename)
+            images[os.path.splitext(filename)[1].lower()] = self._gphoto_stdout(
+                "--folder=" + folder + " --get-file=" + str(number), timeout=30,
+                error_text="Gphoto2 Error: Unable to copy the photos from the camera card")
+        return images
+
+    ##########################################################################
+
+    @timed("capture_and_download")
+    def _take_photo_and_read(self):
+        """
+        Memory version of _take_photo_and_download() for cameras that cannot 
+        capture to their card. Captures a single image and returns a tuple 
+        (capture time, image bytes). Only one image can be returned, since 
+        gphoto2 writes all the files it downloads one after another to its 
+        stdout.
+        """
+        time_of_capture = datetime.datetime.utcnow()
+        self._settings_manager.set(
+            {"output": "CameraManager> Capturing image and downloading into memory."})
+
+        data = self._gphoto_stdout("--capture-image-and-download", timeout=120,
+                                   error_text="Gphoto2 Error: Failed to capture and download image")
+        return time_of_capture, data
+
+    ##########################################################################
+
+    def _recover(self, action):
+        """
+        Resets the camera using gphoto2 --reset (RESET), or disconnects and
+        reconnects it on the USB bus (REENUMERATE). Either way, anything that
+        we knew about the state of the camera is thrown away.
+        """
+        self._forget_camera_state()
+
+        if action == RESET:
+            self._gphoto("--reset", timeout=30,
+                         error_text="Gphoto2 Error: Failed to reset the camera")
+        elif action == REENUMERATE:
+            self._reenumerate_camera()
+
+    ##########################################################################
+
+    def _forget_camera_state(self):
+        """
+        Throws away everything we know about the state of the camera, after it
+        has been reset or reconnected.
+        """
+        if self._session is not None:
+            self._session.close()
+
+        # any image waiting in the capture pipeline is lost (it is left on the
+        # card), and the card and configs will be re-read before they are used
+        # (see _refresh_stale_configs())
+        self._pending_frame = None
+        self._card_index = CardIndex()
+        self._new_files = []
+        self._capture_mode_hash = None
+        self._configs_stale = True
+
+    ##########################################################################
+
+    def _refresh_stale_configs(self):
+        """
+        Re-reads the configs used by the capture modes from the camera if it
+        has been reset or reconnected since they were last read, so that 
+        _set_configs() does not skip changes that the camera needs. Any other
+        configs are dropped from camera_configs, so that they are downloaded
+        again when they are next used.
+        """
+        if not self._configs_stale or not hasattr(self, "camera_configs"):
+            return
+        needed_configs = self._needed_configs()
+        for name in list(self.camera_configs.keys()):
+            if name not in needed_configs:
+                del self.camera_configs[name]
+        self.camera_configs.update(self._get_configs(needed_configs))
+        self._configs_stale = False
+
+    ##########################################################################
+
+    def _usb_devices_changed(self, devices):
+        """
+        Called by the presence monitor (from its own thread) with the dict of
+        {sysfs name:port} of the cameras with our USB ID that are plugged in.
+        """
+        if self._usb_device_name is not None:
+            port = devices.get(self._usb_device_name)
+        elif self._port and self._port in devices.values():
+            port = self._port
+        elif len(devices) > 0 and not self._port:
+            port = devices[sorted(devices.keys())[0]]
+        else:
+            port = None
+
+        if port is None:
+            self._presence_changed(False)
+            return
 
-            # skip empty folders
-            if folder.startswith("There is no file"):
+        if not self._camera_present or port != (self._port or self._camera_port):
+            # the camera has been plugged back in (or re-enumerated), so 
+            # start again from scratch on its new port. This must be done by
+            # the worker thread, before it next uses the camera.
+            self.commit_task(ThreadTask(self._camera_reconnected, port,
+                                        not self._camera_present))
+        self._presence_changed(True)
+
+    ##########################################################################
+
+    def _camera_reconnected(self, port, replugged):
+        """
+        Prepares to use a camera which has just appeared on the given port. If
+        it has been replugged (rather than just moved to a new port), then 
+        any backoff after earlier failures is cancelled.
+        """
+        if self._port and port != self._port:
+            self._set_port(port)
+        self._camera_port = port
+        self._forget_camera_state()
+        if replugged:
+            self._recovery.success()
+
+    ##########################################################################
+
+    def _reenumerate_camera(self):
+        """
+        Re-enumerates the camera on the USB bus (see the usb_device module)
+        and updates the port that it is used on.
+        """
+        port = self._port or self._camera_port
+        device_path = usb_device.find_device(port, self._usb_sysfs_root)
+        if device_path is None:
+            raise GphotoError(
+                "Gphoto2 Error: Could not find the camera (" + str(port) + ") in " + self._usb_sysfs_root)
+
+        try:
+            new_port = usb_device.reenumerate(device_path)
+        except usb_device.USBDeviceError as ex:
+            raise GphotoError("Gphoto2 Error: " + ex.args[0])
+
+        self._settings_manager.set(
+            {"output": "CameraManager> Camera re-enumerated on " + new_port})
+        if self._port:
+            # we are bound to the camera's port, which has now changed
+            self._set_port(new_port)
+        self._camera_port = new_port
+
+    ##########################################################################
+
+    def _set_port(self, port):
+        """
+        Binds the camera manager to a different USB port.
+        """
+        self._port = port
+        self._gphoto2_executable = self._gphoto2_executable.partition(
+            " --port=")[0] + " --port=" + port
+        if self._session is not None:
+            self._session.close()
+            self._session.executable = self._gphoto2_executable
+
+    ##########################################################################
+
+    def _clear_camera(self):
+        # delete the files in every folder on the camera, apart from the
+        # special folder
+        for folder, filenames in sorted(self._list_files().items()):
+            if folder in ("/", "/special") or len(filenames) == 0:
                 continue
+            self._delete_photos(folder, filenames)
 
-            # get folder name from string
-            folder = folder.partition("\'")[2].rstrip("\'.")
+        # the card will be listed again before the next capture
+        self._card_index = CardIndex()
+        self._new_files = []
 
-            self._delete_photos(folder)
+    ##########################################################################
 
     def _set_config(self, name, value):
         """
@@ -362,7 +1177,7 @@ class GphotoCameraManager(CameraManagerBase):
             config = self.camera_configs[name]
         except KeyError:
             raise GphotoError(
-                "\'" + name + "\'" + " is not a valid config name for this camera. (Although it is possible that it was simply not downloaded from the camera during initialisation). Use \'gphoto2 --list-config\' to check that the requested config actually exists.")
+                "\'" + name + "\'" + " is not a valid config name for this camera. (It could not be downloaded from the camera). Use \'gphoto2 --list-config\' to check that the requested config actually exists.")
 
         # Since some of the keys on the new Sony alpha 7s are ranges or
         # fractions they are not in the dictionary
@@ -372,32 +1187,117 @@ class GphotoCameraManager(CameraManagerBase):
         value_index = value
 
         # run gphoto function in separate process
-        s_cmd = "gphoto2 --set-config-value " + \
-            str(name) + "=" + str(value_index)
-        p = call_shell(
-            s_cmd, timeout=30, error_text="GPhoto2 Error: failed to set config" + name)
+        p = self._gphoto("--set-config-value " + str(name) + "=" + str(value_index),
+                         timeout=30, error_text="GPhoto2 Error: failed to set config" + name,
+                         shell_command="set-config-value " + str(name) + " " + str(value_index))
 
         # update the camera_configs attribute to reflect the change.
         self.camera_configs[name].current = value
 
     ##########################################################################
 
+    def _set_configs(self, configs):
+        """
+        Sets a group of camera configs. The configs argument should be a dict
+        of {short name:descriptive value}. Only the configs whose current value
+        (as recorded in the camera_configs attribute, which is re-read first if
+        the camera has been reset or reconnected) differs from the 
+        requested value are changed, and they are all changed using a single
+        gphoto2 call. If the call fails, then the changed configs are 
+        re-downloaded from the camera (so that camera_configs stays correct)
+        before a GphotoError is raised.
+        """
+        self._refresh_stale_configs()
+
+        changes = []
+        for name, value in sorted(configs.items()):
+            try:
+                config = self.camera_configs[name]
+            except KeyError:
+                raise GphotoError(
+                    "\'" + name + "\'" + " is not a valid config name for this camera. (It could not be downloaded from the camera). Use \'gphoto2 --list-config\' to check that the requested config actually exists.")
+
+            if config.current != value:
+                changes.append((name, value))
+
+        if len(changes) == 0:
+            return
+
+        self._settings_manager.set(
+            {"output": "CameraManager> Setting " + ", ".join([name + " to " + str(value) for name, value in changes])})
+
+        try:
+            if self._session is not None:
+                # the shell is already open, so there is nothing to gain by
+                # batching
+                for name, value in changes:
+                    self._gphoto("--set-config-value \"" + str(name) + "=" + str(value) + "\"", timeout=30, error_text="GPhoto2 Error: failed to set config" + name,
+                                 shell_command="set-config-value " + str(name) + " " + str(value))
+            else:
+                args = " ".join(["--set-config-value \"" + str(name) + "=" + str(value) + "\""
+                                 for name, value in changes])
+                self._gphoto(args, timeout=30 + 5 * len(changes),
+                             error_text="GPhoto2 Error: failed to set configs " + ", ".join([name for name, value in changes]))
+        except GphotoError:
+            with self._metrics.timer("recovery"):
+                self.camera_configs.update(
+                    self._get_configs([name for name, value in changes]))
+            raise
+
+        # update the camera_configs attribute to reflect the changes.
+        for name, value in changes:
+            self.camera_configs[name].current = value
+
+    ##########################################################################
+
     def _is_connected(self):
         """
         Returns True if the camera is connected, False otherwise. This method
         works by reading the length of the output from the gphoto2 auto-detect
         function. This makes it somewhat unreliable since USB devices other
         than the camera often appear in the list and this method cannot tell them
-        apart.
+        apart. If camera_usb_id is set, then the USB device tree is used 
+        instead (see usb_device.PresenceMonitor).
         """
 
+        if self._presence_monitor is not None:
+            # the USB device tree says whether the camera is there, gphoto2 is
+            # only needed to find out what model it is
+            if not self._camera_present:
+                return False
+            if self._camera_model is not None:
+                return True
+
         # run gphoto function in separate process and record any output
-        p = call_shell(
-            "gphoto2 --auto-detect", 60, error_text="GPhoto2 Error: failed to auto detect")
+        p = self._gphoto("--auto-detect", 60, error_text="GPhoto2 Error: failed to auto detect",
+                         opens_camera=False)
 
         # read the output from the pipes
         out = p.splitlines()
 
+        # record the model and port of the first camera in the list (below the
+        # "-----" line), or of the camera on our port if we have one, these are
+        # used to identify the camera's config cache
+        for i in range(len(out) - 1):
+            if out[i].lstrip().startswith("---"):
+                for line in out[i + 1:]:
+                    words = re.split(r"\s{2,}", line.strip())
+                    if len(words) < 2:
+                        continue
+                    if self._port and words[-1] != self._port:
+                        continue
+                    self._camera_model = words[0]
+                    self._camera_port = words[-1]
+                    break
+                break
+
+        if self._presence_monitor is not None:
+            return True
+
+        if self._port:
+            # other cameras may be connected, so only our port counts
+            return self._camera_port == self._port
+
         # split output into lines and see how many lines there were in the list
         # to determine if the camera was present or not.
         if len(out) < 3:
@@ -407,18 +1307,33 @@ class GphotoCameraManager(CameraManagerBase):
 
     ##########################################################################
 
-    def _delete_photos(self, active_folder):
+    @timed("delete")
+    def _delete_photos(self, active_folder, filenames=None):
         """
-        Removes all the images from the specified folder on the camera.
+        Removes all the images from the specified folder on the camera. The
+        session's shell can only delete files by name, so if the session 
+        backend is in use then filenames should be the files in the folder
+        (the folder is listed if it isn't).
         """
-        # run gphoto command in separate process
-
-        g_cmd = "gphoto2 -D --folder=" + active_folder
-        call_shell(
-            g_cmd, timeout=30, error_text="Gphoto2 Error: Unable to delete the image(s) from camera card")
+        if self._session is not None:
+            if filenames is None:
+                filenames = self._list_files(active_folder).get(active_folder, [])
+            try:
+                self._session.run("cd " + active_folder, timeout=10)
+                for filename in filenames:
+                    self._session.run("delete " + filename, timeout=30)
+            except GphotoSessionError as ex:
+                raise GphotoError(
+                    "Gphoto2 Error: Unable to delete the image(s) from camera card \n " + ex.args[0])
+        else:
+            # run gphoto command in separate process
+            self._gphoto("-D --folder=" + active_folder, timeout=30,
+                         error_text="Gphoto2 Error: Unable to delete the image(s) from camera card")
+        self._card_index.clear_folder(active_folder)
 
     ##########################################################################
 
+    @timed("capture_and_download")
     def _take_photo_and_download(self):
         """
         Captures an image and downloads all the images into the temporary folder
@@ -443,26 +1358,276 @@ class GphotoCameraManager(CameraManagerBase):
             {"output": "CameraManager> Capturing image and downloading."})
 
         glob_vars = self._settings_manager.get(['tmp dir'])
+
+        if self._session is not None:
+            self._session_capture_and_download(
+                glob_vars['tmp dir'], time_of_capture)
+            return time_of_capture
+
 #         print(("gphoto2 --debug --debug-logfile=~/.gphoto2_log --capture-image-and-download --filename \"" + glob_vars[
 #             'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + ".%C\""))
-        g_cmd = "gphoto2 --capture-image-and-download --filename \"" + glob_vars[
-                'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + ".%C\""
+        g_cmd = self._gphoto2_executable + " --capture-image-and-download --filename \"" + glob_vars[
+                'tmp dir'] + "/" + self._timestamp(time_of_capture) + ".%C\""
         print(g_cmd)
         try:
             output=_timeout_call(g_cmd, timeout=120)
             # output = qx(g_cmd, shell=True, stderr=STDOUT, timeout=60)
             print(output)
-            if output is not None:
-                if  output.find("ERROR: Could not capture image.")!=-1:
-                    call_shell("gphoto2 --reset", timeout=30,error_text="Couldn't reset")
         except CalledProcessError:
             raise GphotoError(
                 "Gphoto2 Error: Failed to capture and download image + \n Command:" + g_cmd)
+        except TimeoutExpired:
+            self._metrics.count("timeouts")
+            raise GphotoError(
+                "Gphoto2 Error: Failed to capture and download image \n Timeout \n Command:" + g_cmd)
         
-        # Wait and print errors
+        # the camera is reset (if need be) by the recovery controller, see
+        # CameraManagerBase._run_with_recovery()
+        if output is not None and output.find(b"ERROR: Could not capture image.") != -1:
+            raise GphotoError(
+                "Gphoto2 Error: Could not capture image \n Command:" + g_cmd)
+
         return time_of_capture
+
+    ##########################################################################
+
+    def _session_capture_and_download(self, tmp_dir, time_of_capture):
+        """
+        Equivalent of "gphoto2 --capture-image-and-download --filename ..." for
+        the gphoto2 shell session. The shell cannot be given a filename format,
+        so the images are saved into the tmp dir using the names given to them
+        by the camera and then renamed using the time of capture.
+        """
+        try:
+            self._session.run("lcd " + tmp_dir, timeout=10)
+            output = self._session.run("capture-image-and-download", timeout=120)
+        except GphotoSessionError as ex:
+            raise GphotoError(
+                "Gphoto2 Error: Failed to capture and download image \n " + ex.args[0])
+
+        for line in output.splitlines():
+            line = line.strip()
+            if not line.startswith("Saving file as"):
+                continue
+            camera_filename = os.path.basename(
+                line.partition("Saving file as")[2].strip())
+            extension = os.path.splitext(camera_filename)[1]
+            os.rename(os.path.join(tmp_dir, camera_filename),
+                      os.path.join(tmp_dir, self._timestamp(time_of_capture) + extension))
+
     ##########################################################################
 
+    def _capture_photos(self, number_of_images):
+        """
+        Captures an image, downloads it and deletes it from the camera card. 
+        Returns a tuple (capture time, images). If capture_to_memory is set, 
+        then images is a dict of {extension:bytes} (see _read_photos()), 
+        otherwise the images are downloaded into the tmp dir (see 
+        _copy_photos()) and images is None.
+
+        If pipelined_capture is set, then the next image is exposed while the
+        previous one is downloaded (see _capture_photos_pipelined()). In this 
+        case the returned images are those of the previous call, and the 
+        capture time is the time that they were captured. The first call 
+        returns (None, None), since there are no images to return yet.
+        """
+        if self._pipelined_capture:
+            return self._capture_photos_pipelined(number_of_images)
+
+        active_folder, time_of_capture = self._take_photo(number_of_images)
+        return time_of_capture, self._download_new_photos(active_folder, time_of_capture)
+
+    ##########################################################################
+
+    def _download_new_photos(self, active_folder, time_of_capture):
+        """
+        Downloads the files found by the last call to _take_photo() (into 
+        memory or the tmp dir, see _capture_photos()) and then deletes them 
+        from the camera card.
+        """
+        if self._capture_to_memory:
+            images = self._read_photos(active_folder)
+        else:
+            self._copy_photos(active_folder, time_of_capture)
+            images = None
+
+        self._delete_downloaded_photos()
+        return images
+
+    ##########################################################################
+
+    def _capture_burst_photos(self, number_of_images, number_of_frames):
+        """
+        Captures a burst of number_of_frames images using the camera's own
+        continuous shooting (the burstnumber config, which must already be set
+        to number_of_frames, see _has_config()), downloads them and deletes 
+        them from the card. Each frame consists of number_of_images files. 
+        Returns a list of tuples (capture time, images) as returned by 
+        _capture_photos(). The camera doesn't tell us when each frame was 
+        exposed, so the capture times are spaced by capture_mode.delay from 
+        the time that the burst was started.
+        """
+        # the burst has to be captured in one go, so the capture pipeline 
+        # can't be used
+        self._discard_pending_frame()
+
+        active_folder, time_of_capture = self._take_photo(
+            number_of_images * number_of_frames)
+
+        # group the files into frames by name, e.g. DSC_0001.NEF and 
+        # DSC_0001.JPG are the same frame
+        frames = []
+        frame_names = {}
+        for folder, filename in self._new_files:
+            name = folder + "/" + os.path.splitext(filename)[0]
+            if name not in frame_names:
+                frame_names[name] = len(frames)
+                frames.append([])
+            frames[frame_names[name]].append((folder, filename))
+
+        results = []
+        for i, frame in enumerate(frames):
+            frame_time = time_of_capture + \
+                datetime.timedelta(seconds=i * self.capture_mode.delay)
+            self._new_files = frame
+            results.append((frame_time, self._download_new_photos(
+                frame[0][0], frame_time)))
+        return results
+
+    ##########################################################################
+
+    def _has_config(self, name):
+        """
+        Returns True if the camera has the named config (downloading it if it
+        hasn't been already), False otherwise.
+        """
+        if name in self._missing_configs:
+            return False
+        try:
+            self.camera_configs[name]
+            return True
+        except KeyError:
+            # don't keep asking the camera for it
+            self._missing_configs.add(name)
+            return False
+
+    ##########################################################################
+
+    def _capture_photos_pipelined(self, number_of_images, timeout=60):
+        """
+        Double buffered version of _capture_photos(). The capture of the next
+        image is triggered (gphoto2 --trigger-capture returns as soon as the 
+        exposure has started), then the image from the previous call is 
+        downloaded while the camera is exposing, and finally we wait for the 
+        new image to be stored on the card. The new image stays on the card 
+        until the next call, so the cadence approaches the exposure time 
+        rather than the exposure time plus the download time.
+        """
+        if not self._card_index.initialised:
+            self._card_index.load_listing(self._list_files())
+
+        # downloading the previous image re-lists its folder, which may pick
+        # up the new image before we have looked for it, so the new image is
+        # found by comparing the card with what was there before the trigger
+        known_files = self._card_index.copy()
+
+        time_of_capture = datetime.datetime.utcnow()
+        self._settings_manager.set(
+            {"output": "CameraManager> Capturing image."})
+        with self._metrics.timer("capture"):
+            self._gphoto("--trigger-capture", timeout=30,
+                         error_text="Gphoto2 Error: Failed to capture image",
+                         shell_command="trigger-capture")
+
+        # download the previous image while the camera is busy with this one
+        previous_frame = (None, None)
+        if self._pending_frame is not None:
+            previous_time, previous_files = self._pending_frame
+            self._pending_frame = None
+            self._new_files = previous_files
+            previous_frame = (previous_time, self._download_new_photos(
+                previous_files[-1][0], previous_time))
+
+        # wait for the new image to be stored
+        try:
+            with self._metrics.timer("capture_wait"):
+                new_files = self._wait_for_new_files(
+                    number_of_images, timeout, known_files)
+        except GphotoError:
+            # the image may still turn up later, make sure that it isn't
+            # mistaken for the next one
+            self._card_index = CardIndex()
+            if previous_frame[0] is None:
+                raise
+            log.warning("Failed to capture image at " + str(time_of_capture) +
+                        ", returning the previous image only")
+            return previous_frame
+
+        for folder, filename in new_files:
+            self._card_index.add(folder, filename)
+        self._pending_frame = (time_of_capture, new_files)
+
+        return previous_frame
+
+    ##########################################################################
+
+    def _wait_for_new_files(self, number_of_images, timeout, known_files):
+        """
+        Waits for a capture that has already been triggered to store 
+        number_of_images files on the card, and returns a list of their
+        (folder, filename). known_files should be a CardIndex of the files 
+        that were on the card before the capture was triggered. Camera events
+        are used if the session backend is in use. A separate gphoto2 process
+        only receives the events that happen while it is running, and would
+        miss files stored before it started, so otherwise the card is listed.
+        """
+        deadline = time.time() + timeout
+        new_files = []
+        if self._session is None:
+            new_files = known_files.new_files(self._list_files())
+
+        if len(new_files) < number_of_images and self._capture_completion == "events" and \
+                self._session is not None:
+            events = self._capture_and_wait_for_files(
+                number_of_images - len(new_files), timeout, capture=False)
+            for new_file in events:
+                if new_files.count(new_file) == 0:
+                    new_files.append(new_file)
+
+        if len(new_files) < number_of_images:
+            # fall back to listing the files on the card. The capture has
+            # already been triggered, so the card is listed often until the
+            # files appear or the timeout is reached
+            self._poll_for_photos(number_of_images, datetime.datetime.utcnow(),
+                                  known_files, interval=0.25,
+                                  timeout=max(deadline - time.time(), 0))
+            new_files = self._new_files
+
+        return new_files
+
+    ##########################################################################
+
+    def _discard_pending_frame(self):
+        """
+        Deletes the image captured by the last call to 
+        _capture_photos_pipelined() from the camera card without downloading
+        it. This is used when the capture mode changes, since the image was
+        captured using the old mode.
+        """
+        if self._pending_frame is None:
+            return
+
+        previous_time, previous_files = self._pending_frame
+        self._pending_frame = None
+        self._settings_manager.set(
+            {"output": "CameraManager> Discarding image captured at " + str(previous_time) +
+             " using the previous capture mode"})
+        self._new_files = previous_files
+        self._delete_downloaded_photos()
+
+    ##########################################################################
+
+    @timed("capture")
     def _take_photo(self, number_of_images):
         """
         Captures an image and returns a tuple (active folder, capture time), where
@@ -473,98 +1638,235 @@ class GphotoCameraManager(CameraManagerBase):
         the camera is expected to produce. For example if the camera is capturing
         both a jpeg and a raw image, then it will be 2. This method works by reading
         the output from the gphoto2 --list-files function both before and after image
-        capture. It compares the two to work out what folder on the camera the image 
-        has been stored in. However, since the gphoto2 --capture-image function 
-        returns before the image has been stored on the camera card, it also has to use
-        the list function to work out if the camera has finished storing the image(s) or
-        not. To do this it needs to know how many images to expect.
-
-        To be able to download the correct images, the camera card needs to be blank.
-        If it is not, then this method deletes all the photos on it and returns a
-        (None, None) tuple.
+        capture. It compares the listing to the card index to work out which files are
+        new and what folder on the camera they have been stored in. However, since the
+        gphoto2 --capture-image function returns before the image has been stored on 
+        the camera card, it also has to use the list function to work out if the camera
+        has finished storing the image(s) or not. To do this it needs to know how many
+        images to expect. The new files are remembered, so that _copy_photos() and
+        _delete_downloaded_photos() only touch those files. Files that were already on
+        the card are left alone.
 
         Note: The time of capture recorded and used to name the files is the time
         just before the shutter is opened, i.e. before the call to gphoto2 --capture-image.
         """
-        # get list of files on camera before capture
-        # run gphoto function in separate process and wait for it to finish
-        p = call_shell("gphoto2 -L ", timeout=30,
-                       error_text="Gphoto2 Error: Unable to list of files on camera card")
+        if self._capture_completion == "events":
+            return self._take_photo_and_wait_for_events(number_of_images)
 
-        # read the lines of output from the gphoto command
-        pre_image_list = p.splitlines()
+        # get list of files on camera before capture and read it into the card
+        # index
+        self._card_index.load_listing(self._list_files())
+        self._new_files = []
 
         # take the picture!
         time_of_capture = datetime.datetime.utcnow()
         self._settings_manager.set(
             {"output": "CameraManager> Capturing image."})
 
-        p = call_shell("gphoto2 --capture-image ", timeout=60,
-                       error_text="Gphoto2 Error: Failed to capture image")
+        p = self._gphoto("--capture-image ", timeout=60,
+                         error_text="Gphoto2 Error: Failed to capture image",
+                         shell_command="capture-image")
+
+        return self._poll_for_photos(number_of_images, time_of_capture)
+
+    ##########################################################################
+
+    def _take_photo_and_wait_for_events(self, number_of_images, timeout=60):
+        """
+        Event driven version of _take_photo(). Captures an image and waits for
+        the camera to report (via gphoto2 camera events) that the expected 
+        number of image files have been added to the card, rather than 
+        repeatedly listing the files on the card. Returns a tuple 
+        (active folder, capture time) just like _take_photo(). If the camera
+        does not report all the files within the timeout (in seconds), then 
+        this falls back to polling the list of files on the card.
+        """
+        # the card only needs to be listed once - after that the index is kept
+        # up to date from the capture events and deletions
+        if not self._card_index.initialised:
+            self._card_index.load_listing(self._list_files())
+        self._new_files = []
+
+        time_of_capture = datetime.datetime.utcnow()
+        self._settings_manager.set(
+            {"output": "CameraManager> Capturing image."})
+
+        new_files = self._capture_and_wait_for_files(number_of_images, timeout)
 
-        # wait for the image to be stored for up to one minute
-        flag = False
-        while (time_of_capture + datetime.timedelta(minutes=1) > datetime.datetime.utcnow()) and (not flag):
+        if len(new_files) >= number_of_images:
+            for folder, filename in new_files:
+                self._card_index.add(folder, filename)
+            self._new_files = new_files
+            return new_files[-1][0], time_of_capture
+
+        log.warning("Only " + str(len(new_files)) + " of " + str(number_of_images) +
+                    " file added events received - falling back to polling")
+        self._metrics.count("retries")
+        self._settings_manager.set(
+            {"output": "CameraManager> No capture events from camera, checking card instead."})
+
+        return self._poll_for_photos(number_of_images, time_of_capture)
+
+    ##########################################################################
+
+    def _capture_and_wait_for_files(self, number_of_images, timeout, capture=True):
+        """
+        Triggers a capture and returns a list of (folder, filename) tuples for
+        the files that the camera reports being added to its card. Returns as
+        soon as number_of_images files have been reported, or after timeout 
+        seconds. If capture is False, then no capture is triggered and this 
+        just waits for the files of a capture which has already been started.
+        """
+        new_files = []
+
+        if self._session is not None:
+            if capture:
+                p = self._gphoto("--capture-image", timeout=timeout,
+                                 error_text="Gphoto2 Error: Failed to capture image",
+                                 shell_command="capture-image")
+                self._parse_file_events(p.splitlines(), new_files)
+            deadline = time.time() + timeout
+            while len(new_files) < number_of_images and time.time() < deadline:
+                p = self._gphoto("--wait-event=500ms", timeout=10,
+                                 error_text="Gphoto2 Error: Failed to wait for camera events",
+                                 shell_command="wait-event 500ms")
+                self._parse_file_events(p.splitlines(), new_files)
+            return new_files
+
+        if capture:
+            command = self._gphoto2_executable + " --capture-image --wait-event=" + \
+                str(int(timeout)) + "s"
+        else:
+            command = self._gphoto2_executable + " --wait-event=" + \
+                str(int(timeout)) + "s"
+        process = Popen(command, shell=True, stdout=PIPE,
+                        stderr=STDOUT, preexec_fn=os.setsid)
+
+        # gphoto2 should exit by itself once the wait-event time is up, but if
+        # it hangs (so that nothing more is written to its stdout) then it is
+        # killed, which ends the loop below
+        expired = threading.Event()
+
+        def kill():
+            expired.set()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        killer = threading.Timer(timeout + 10, kill)
+        killer.daemon = True
+        killer.start()
+        try:
+            output = []
+            for line in iter(process.stdout.readline, b""):
+                if not isinstance(line, str):
+                    line = line.decode("utf-8", "replace")
+                output.append(line)
+                self._parse_file_events([line], new_files)
+                if len(new_files) >= number_of_images:
+                    break
+        finally:
+            if process.poll() is None and not expired.is_set():
+                # we have what we came for, stop waiting for more events
+                try:
+                    os.killpg(process.pid, signal.SIGINT)
+                except OSError:
+                    pass
+            process.communicate()
+            killer.cancel()
+
+        if expired.is_set() and len(new_files) < number_of_images:
+            raise GphotoError(
+                "Gphoto2 Error: Killed gphoto2 after " + str(timeout + 10) +
+                " seconds waiting for the camera \n Command:" + command + "\n" + "".join(output))
+
+        if len(new_files) == 0 and "".join(output).count("*** Error") != 0:
+            raise GphotoError(
+                "Gphoto2 Error: Failed to capture image \n Command:" + command + "\n" + "".join(output))
+
+        return new_files
+
+    ##########################################################################
+
+    def _parse_file_events(self, lines, new_files):
+        """
+        Appends a (folder, filename) tuple to the new_files list for each new
+        file reported in the lines of gphoto2 output. Both FILEADDED events and
+        the "New file is in location ..." message printed by --capture-image 
+        are recognised. Files which are already in the list are ignored.
+        """
+        for line in lines:
+            line = line.strip()
+            if line.startswith("FILEADDED"):
+                words = line.split()
+                if len(words) < 3:
+                    continue
+                new_file = (words[-1], " ".join(words[1:-1]))
+
+            elif line.startswith("New file is in location"):
+                path = line.partition("New file is in location")[2]
+                path = path.rpartition("on the camera")[0].strip()
+                new_file = (os.path.dirname(path), os.path.basename(path))
+            else:
+                continue
+
+            if new_files.count(new_file) == 0:
+                new_files.append(new_file)
+
+    ##########################################################################
+
+    def _poll_for_photos(self, number_of_images, time_of_capture, known_files=None,
+                         interval=3.0, timeout=60.0):
+        """
+        Waits (for up to timeout seconds after the time of capture) for the 
+        images to be stored on the camera card, by listing the files on the
+        card every interval seconds and looking for files which are not in the
+        card index (or in known_files, if it is given). The card is always 
+        listed at least once. Returns a tuple (active folder, capture time), 
+        see _take_photo().
+        """
+        if known_files is None:
+            known_files = self._card_index
+
+        # wait for the image to be stored for up to timeout seconds
+        deadline = time_of_capture + datetime.timedelta(seconds=timeout)
+        new_files = []
+        while True:
             # give the camera some time to store the image before we start
             # pestering it
-            time.sleep(3)
+            time.sleep(interval)
 
-            # get list of files on camera
-            p = call_shell(
-                "gphoto2 -L ", timeout=10, error_text="Gphoto2 Error: Unable to list of files on camera card")
+            # get list of files on camera, and work out how many new files
+            # have appeared and what folder they have appeared in
+            new_files = known_files.new_files(self._list_files(timeout=10))
 
-            post_image_list = p.splitlines()
-            # compare the new list of files to the one recorded before taking a picture
-            # and work out how many new files have appeared and what folder they have
-            # appeared in
-            if post_image_list == pre_image_list:
-                continue
-            else:
-                # remove entries which existed before the image
-                for line in pre_image_list:
-                    try:
-                        post_image_list.remove(line)
-                    except ValueError:
-                        continue
+            if len(new_files) >= number_of_images or \
+                    datetime.datetime.utcnow() > deadline:
+                # the image(s) have been stored (or we have given up)
+                break
 
-                # get number of files in active folder
-                folder_filecount = 0
-                for line in post_image_list:
-                    if line.lstrip().startswith("There"):
-                        words = line.split()
-                        active_folder = eval(words[len(words) - 1].rstrip("."))
-                        try:
-                            folder_filecount = eval(words[2])
-                        except NameError:
-                            pass
-
-                if folder_filecount < number_of_images:
-                    # if image has not been stored yet, then wait longer
-                    continue
-                elif folder_filecount == number_of_images:
-                    # the image(s) have been stored, so break out of the loop
-                    flag = True
-                    continue
-                elif folder_filecount > number_of_images:
-                    # this means that the camera card probably wasn't blank to start with - which is a tricky problem!
-                    # The easiest way around this is to wipe the card and accept that we will lose the photo(s)
-                    # that have just been taken
-                    self._settings_manager.set(
-                        {"output": "CameraManager> Error! Camera card was not blank!"})
-                    self._settings_manager.set(
-                        {"output": "CameraManager> Deleting all images from camera."})
-                    self._delete_photos(active_folder)
-                    return None, None
-
-        if not flag:
-            # it has taken more than one minute to store the image - something
-            # has probably gone wrong!
+        if len(new_files) < number_of_images:
+            # it has taken too long to store the image - something has 
+            # probably gone wrong!
             raise GphotoError("Gphoto2 Error: Unable to download image(s)")
-        else:
-            return active_folder, time_of_capture
+
+        if len(new_files) > number_of_images:
+            # files we didn't expect have appeared (e.g. someone has been
+            # taking pictures by hand) - there is no way to tell them apart, so
+            # they are all downloaded with this image
+            self._settings_manager.set(
+                {"output": "CameraManager> Warning! " + str(len(new_files)) + " new files on camera card, expected " + str(number_of_images)})
+
+        for folder, filename in new_files:
+            self._card_index.add(folder, filename)
+        self._new_files = new_files
+
+        return new_files[-1][0], time_of_capture
 
     ##########################################################################
 
+    @timed("download")
     def _copy_photos(self, folder_on_camera, time_of_capture):
         """
         Downloads all the images in the folder_on_camera into the temporary folder on
@@ -576,44 +1878,215 @@ class GphotoCameraManager(CameraManagerBase):
 
         self._settings_manager.set(
             {"output": "CameraManager> Downloading image(s)"})
-        g_cmd = "gphoto2 -P --folder=" + folder_on_camera + " --filename=\"" + glob_vars[
-            'tmp dir'] + "/" + time_of_capture.strftime("%Y%m%d_%H%M%S") + ".%C\""
-        p = call_shell(
+
+        new_files = [f for f in self._new_files if f[0] == folder_on_camera]
+        if len(new_files) > 0:
+            self._copy_files(new_files, glob_vars['tmp dir'], time_of_capture)
+            return
+
+        g_cmd = "-P --folder=" + folder_on_camera + " --filename=\"" + glob_vars[
+            'tmp dir'] + "/" + self._timestamp(time_of_capture) + ".%C\""
+        p = self._gphoto(
             g_cmd, timeout=30, error_text="Gphoto2 Error: Unable to copy the photos from the camera card")
 
     ##########################################################################
 
-    def _download_configs(self):
+    def _copy_files(self, files, tmp_dir, time_of_capture):
         """
-        Returns a dictionary containing CameraConfig objects for all of the possible camera configs.
-        The keys are the short names of the configs.
+        Downloads the (folder, filename) files from the camera into the tmp_dir,
+        naming them using the time of capture. All the files must be in the 
+        same folder.
         """
-        current_configs = {}
+        folder = files[0][0]
+        basename = self._timestamp(time_of_capture)
 
-        # get list of possible configs for camera
-        # run gphoto function in separate process
-        p = call_shell("gphoto2 --list-config", timeout=20,
-                       error_text="Gphoto2 Error: Unable to download the list of configs")
+        if self._session is not None:
+            # the shell can fetch files by name
+            try:
+                self._session.run("cd " + folder, timeout=10)
+                self._session.run("lcd " + tmp_dir, timeout=10)
+                for f, filename in files:
+                    self._session.run("get " + filename, timeout=30)
+                    os.rename(os.path.join(tmp_dir, filename),
+                              os.path.join(tmp_dir, basename + os.path.splitext(filename)[1]))
+            except GphotoSessionError as ex:
+                raise GphotoError(
+                    "Gphoto2 Error: Unable to copy the photos from the camera card \n " + ex.args[0])
+            return
+
+        # gphoto2 refers to files by their number in the folder, so make sure
+        # that the index of this folder is up to date (this only lists the
+        # one folder)
+        self._refresh_folder_index(folder, [filename for f, filename in files])
+
+        numbers = [str(self._card_index.file_number(folder, filename))
+                   for f, filename in files]
+        g_cmd = "--folder=" + folder + " --filename=\"" + tmp_dir + "/" + basename + ".%C\" --get-file=" + \
+            " --get-file=".join(numbers)
+        self._gphoto(g_cmd, timeout=30,
+                     error_text="Gphoto2 Error: Unable to copy the photos from the camera card")
+
+    ##########################################################################
 
-        # read output lines from pipe
-        lines = p.splitlines()
+    def _refresh_folder_index(self, folder, filenames=[], timeout=30):
+        """
+        Re-lists a single folder on the camera and updates the card index. 
+        Some cameras report new files before they appear in the listing, so 
+        if a list of filenames is given, then the folder is re-listed until
+        they are all there (for up to timeout seconds).
+        """
+        deadline = time.time() + timeout
+        while True:
+            listed = self._list_files(folder, timeout=10).get(folder, [])
+            self._card_index.load_folder(folder, listed)
+
+            missing = set(filenames) - set(listed)
+            if len(missing) == 0:
+                return
+            if time.time() > deadline:
+                raise GphotoError("Gphoto2 Error: Unable to find " + ", ".join(sorted(missing)) +
+                                  " in " + folder + " on camera card")
+            time.sleep(0.5)
 
-        # get the current and possible values for all the different configs
-        for config in lines:
-            # skip blank lines
-            if config.isspace() or config == "":
-                continue
+    ##########################################################################
+
+    @timed("delete")
+    def _delete_downloaded_photos(self):
+        """
+        Removes the files found by the last call to _take_photo() from the
+        camera, leaving any other files on the card alone.
+        """
+        if len(self._new_files) == 0:
+            return
+
+        folders = sorted(set([folder for folder, filename in self._new_files]))
+        for folder in folders:
+            filenames = [f[1] for f in self._new_files if f[0] == folder]
+
+            if self._session is not None:
+                try:
+                    self._session.run("cd " + folder, timeout=10)
+                    for filename in filenames:
+                        self._session.run("delete " + filename, timeout=30)
+                except GphotoSessionError as ex:
+                    raise GphotoError(
+                        "Gphoto2 Error: Unable to delete the image(s) from camera card \n " + ex.args[0])
+            else:
+                self._refresh_folder_index(folder, filenames)
+
+                # delete from the highest number down, so that deleting one
+                # file does not change the numbers of the others
+                numbers = sorted([self._card_index.file_number(folder, filename)
+                                  for filename in filenames], reverse=True)
+                self._gphoto("--folder=" + folder + " --delete-file=" + " --delete-file=".join([str(n) for n in numbers]),
+                             timeout=30, error_text="Gphoto2 Error: Unable to delete the image(s) from camera card")
+
+            for filename in filenames:
+                self._card_index.remove(folder, filename)
+
+        self._new_files = []
 
-            # get short name of config
-            split = config.split("/")
-            name = split[len(split) - 1].lstrip().rstrip()
+    ##########################################################################
 
-            current_configs[name] = self._get_config(config)
+    def _download_configs(self):
+        """
+        Returns a CameraConfigs dictionary of CameraConfig objects. The keys are 
+        the short names of the configs. Configs are cached on disk (per camera
+        model and port) between runs. Only the configs used by the capture modes
+        in the settings file (and those listed in required_configs) are 
+        downloaded from the camera here, in a single batch. Any other config is
+        loaded from the cache, or downloaded the first time it is requested.
+        """
+        current_configs = CameraConfigs(
+            self._get_config, self._load_config_cache())
+
+        if len(current_configs) > 0:
+            self._settings_manager.set(
+                {"output": "CameraManager> Loaded " + str(len(current_configs)) + " configs from cache"})
+
+        # re-validate the configs that we know we are going to need
+        current_configs.update(self._get_configs(self._needed_configs()))
+
+        self._save_config_cache(current_configs)
 
         return current_configs
 
     ##########################################################################
 
+    def _needed_configs(self):
+        """
+        Returns a list of the names of the configs used by the capture modes in
+        the settings file, plus those listed in required_configs.
+        """
+        needed_configs = list(self.required_configs)
+
+        glob_vars = self._settings_manager.get(
+            ['capture modes', "image types", "output types"])
+
+        for mode_name in list(glob_vars["capture modes"].keys()):
+            capture_mode = CaptureMode(glob_vars["capture modes"][mode_name], glob_vars[
+                                       "image types"], glob_vars["output types"])
+            needed_configs += list(capture_mode.camera_settings.keys())
+
+        return sorted(set(needed_configs))
+
+    ##########################################################################
+
+    def _config_cache_file(self):
+        """
+        Returns the path to the config cache file for the connected camera, or
+        None if the camera model and port are not known.
+        """
+        if self._camera_model is None or self._camera_port is None:
+            return None
+
+        home = os.path.expanduser("~")
+        key = re.sub(r"[^A-Za-z0-9]+", "_",
+                     self._camera_model + "_" + self._camera_port)
+        return os.path.normpath(home + "/.pysces_asi/camera_configs/" + key)
+
+    ##########################################################################
+
+    def _load_config_cache(self):
+        """
+        Returns the dict of cached CameraConfig objects for the connected
+        camera, or an empty dict if there is no (readable) cache.
+        """
+        filename = self._config_cache_file()
+        if filename is None:
+            return {}
+
+        try:
+            with open(filename, "rb") as fp:
+                return pickle.load(fp)
+        except Exception:
+            # a missing or corrupt cache just means we have to ask the camera
+            return {}
+
+    ##########################################################################
+
+    def _save_config_cache(self, configs):
+        """
+        Writes the configs to the cache file for the connected camera.
+        """
+        filename = self._config_cache_file()
+        if filename is None:
+            return
+
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+
+        # write to a temporary file first so that a crash can't leave a
+        # half-written cache behind
+        with open(filename + "-temp", "wb") as fp:
+            pickle.dump(dict(configs), fp)
+        os.rename(filename + "-temp", filename)
+
+    ##########################################################################
+
     def _set_capture_mode(self, capture_mode):
         raise AttributeError("gphotoCameraManager must be sub-classed")
 
@@ -629,17 +2102,75 @@ class GphotoCameraManager(CameraManagerBase):
         Wrapper function for gphoto2's --get-config function. Returns a CameraConfig object.
         The name argument should be a string specifying the name of the config, e.g. "exptime"
         """
-
-        values = {}
-
         # get values for particular config
 
         # run gphoto function in separate process
-        p = call_shell("gphoto2 --get-config " + name, timeout=20,
-                       error_text="GPhoto2 Error: failed to download config" + name)
+        p = self._gphoto("--get-config " + name, timeout=20,
+                         error_text="GPhoto2 Error: failed to download config" + name,
+                         shell_command="get-config " + name)
 
         # read config value lines from pipe
-        config_lines = p.splitlines()
+        return self._parse_config(p.splitlines())
+
+    ##########################################################################
+
+    def _get_configs(self, names):
+        """
+        Downloads several configs at once and returns a dict of {name:CameraConfig}.
+        Without the session backend this is a single gphoto2 call with one 
+        --get-config argument per config. If the batched call fails (e.g.
+        because one of the configs does not exist on this camera) then the 
+        configs are downloaded one by one, and any that cannot be downloaded
+        are left out of the dict.
+        """
+        configs = {}
+        if len(names) == 0:
+            return configs
+
+        if self._session is not None:
+            # the shell is already open, so there is nothing to gain by
+            # batching
+            for name in names:
+                try:
+                    configs[name] = self._get_config(name)
+                except GphotoError:
+                    continue
+            return configs
+
+        try:
+            p = self._gphoto("--get-config " + " --get-config ".join(names), timeout=20 + 5 * len(names),
+                             error_text="GPhoto2 Error: failed to download configs")
+        except GphotoError:
+            self._metrics.count("retries")
+            for name in names:
+                try:
+                    configs[name] = self._get_config(name)
+                except GphotoError:
+                    continue
+            return configs
+
+        # gphoto2 prints the configs in the order they were asked for, each
+        # starting with a "Label:" line
+        blocks = []
+        for line in p.splitlines():
+            if line.lstrip().startswith("Label:"):
+                blocks.append([])
+            if len(blocks) > 0:
+                blocks[-1].append(line)
+
+        for name, lines in zip(names, blocks):
+            configs[name] = self._parse_config(lines)
+
+        return configs
+
+    ##########################################################################
+
+    def _parse_config(self, config_lines):
+        """
+        Builds a CameraConfig object from the lines of output produced by 
+        gphoto2 --get-config.
+        """
+        values = {}
 
         # read the values of the config from the output of the gphoto function
         for line in config_lines:
@@ -673,6 +2204,37 @@ class GphotoCameraManager(CameraManagerBase):
 ##########################################################################
 
 
+class CameraConfigs(dict):
+    """
+    Dictionary of {short name:CameraConfig}. If a config is requested that is
+    not in the dictionary, then it is downloaded from the camera using the 
+    fetch function (which should take the name of the config and return a 
+    CameraConfig object) and added to the dictionary. A KeyError is raised if
+    the config cannot be downloaded. Since the fetch function talks to the 
+    camera, missing configs should only be requested by the camera manager's
+    worker thread.
+    """
+
+    def __init__(self, fetch, configs):
+        dict.__init__(self, configs)
+        self._fetch = fetch
+
+    def __missing__(self, name):
+        try:
+            config = self._fetch(name)
+        except GphotoError:
+            raise KeyError(name)
+        self[name] = config
+        return config
+
+    def copy(self):
+        # return a plain dict, so that configs missing from the copy are not
+        # fetched by whichever thread is using it
+        return dict(self)
+
+##########################################################################
+
+
 class CameraConfig:
     """
     Storage class for camera configs. These relate to the information returned by Gphoto2 --get-config.
@@ -0,0 +1,156 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The camera_metrics module provides the CameraMetrics class, which records how
+long each phase of a capture cycle (setting configs, capturing, downloading,
+writing info files, resetting the camera etc.) takes, along with counts of
+retries, timeouts and other events. The camera managers use it to make
+cadence regressions visible in production.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from pysces_asi.queue_metrics import Histogram, BUCKETS
+
+
+def timed(phase):
+    """
+    Decorator for camera manager methods, which records the time taken by
+    each call of the method as the named phase in the manager's _metrics
+    attribute.
+    """
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            with self._metrics.timer(phase):
+                return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
+
+##########################################################################
+
+
+class CameraMetrics:
+    """
+    Timing histograms for the phases of a capture cycle and counters for
+    events such as retries and timeouts. All methods are thread safe. If a
+    filename is given, then write_if_due() periodically writes a summary of
+    the metrics to it.
+    """
+
+    def __init__(self, filename=None, interval=300):
+        self.filename = filename
+        self.interval = interval
+        self._phases = {}
+        self._counters = {}
+        self._start_time = time.time()
+        self._last_write = time.time()
+        self._lock = threading.Lock()
+
+    ##########################################################################
+
+    def record(self, phase, duration):
+        """
+        Records that the named phase took duration seconds.
+        """
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = Histogram()
+                self._phases[phase] = histogram
+        histogram.record(duration)
+
+    ##########################################################################
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        Context manager which records the time spent inside it as the named
+        phase. If the block raises an exception, then the "<phase>_failures"
+        counter is also incremented.
+        """
+        start_time = time.time()
+        try:
+            yield
+        except Exception:
+            self.count(phase + "_failures")
+            raise
+        finally:
+            self.record(phase, time.time() - start_time)
+
+    ##########################################################################
+
+    def count(self, name, increment=1):
+        """
+        Increments the named counter (e.g. "retries" or "timeouts").
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+    ##########################################################################
+
+    def summary(self):
+        """
+        Returns a dict {'uptime', 'buckets', 'phases', 'counters'}. The 
+        buckets value is the list of upper bounds of the histogram buckets. The
+        phases value is a dict of {phase:Histogram.summary()}. The counters
+        value is a dict of {name:count}.
+        """
+        with self._lock:
+            phases = list(self._phases.items())
+            counters = dict(self._counters)
+
+        return {'uptime': time.time() - self._start_time,
+                'buckets': list(BUCKETS),
+                'phases': dict([(phase, histogram.summary()) for phase, histogram in phases]),
+                'counters': counters}
+
+    ##########################################################################
+
+    def write(self, filename=None):
+        """
+        Writes the summary() of the metrics to a file (by default the
+        filename given to the constructor) as JSON. The file is replaced
+        atomically, so it can be read at any time.
+        """
+        if filename is None:
+            filename = self.filename
+
+        temp_filename = filename + "-temp"
+        with open(temp_filename, "w") as fp:
+            json.dump(self.summary(), fp, sort_keys=True)
+        os.rename(temp_filename, filename)
+        self._last_write = time.time()
+
+    ##########################################################################
+
+    def write_if_due(self):
+        """
+        Writes the metrics file if a filename was given and at least interval
+        seconds have passed since it was last written.
+        """
+        if not self.filename:
+            return
+        if time.time() - self._last_write >= self.interval:
+            self.write()
+
+    ##########################################################################
+##########################################################################
@@ -0,0 +1,210 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The camera_recovery module provides the RecoveryController class, which
+decides what the camera managers should do after a capture fails. Rather than
+resetting the camera after every failure, failures are classified, further
+attempts are delayed by an exponentially increasing backoff time, and the
+recovery action is escalated from a plain retry, to a gphoto2 --reset, to
+re-enumerating the camera on the USB bus. After a run of failures the
+controller "opens the circuit" and reports the camera as degraded, so that the
+capture loop stops wasting whole capture cycles on a camera that is not there.
+"""
+import time
+
+# recovery actions, in order of escalation
+RETRY = "retry"
+RESET = "reset"
+REENUMERATE = "reenumerate"
+
+# failure classes, and the strings in the gphoto2 error messages that identify
+# them. The classes are checked in this order.
+FAILURE_PATTERNS = (
+    ("config", ("is not a valid config name", "Bad parameters")),
+    ("disconnected", ("No camera detected", "Could not detect any camera",
+                      "No camera found", "Could not find the requested device")),
+    ("busy", ("Device Busy", "Could not claim the USB device",
+              "Camera is already capturing")),
+    ("timeout", ("Timeout", "timed out")),
+    ("capture", ("Could not capture", "Failed to capture",
+                 "capture failed")),
+    ("io", ("I/O problem", "io-library", "Unspecified error",
+            "PTP General Error", "Could not find the image")),
+)
+
+# the recovery actions to use for each class of failure. The first failure in
+# a run uses the first action, the second the next one and so on, with the last
+# action being repeated. Config errors are mistakes in the settings, so they
+# are not escalated (and do not count towards opening the circuit).
+ESCALATION = {
+    "config": (RETRY,),
+    "disconnected": (RETRY,),
+    "busy": (RETRY, RETRY, RESET),
+    "timeout": (RETRY, RESET, REENUMERATE),
+    "capture": (RETRY, RESET, REENUMERATE),
+    "io": (RETRY, RESET, REENUMERATE),
+    "unknown": (RETRY, RESET, REENUMERATE),
+}
+
+
+def classify_failure(error):
+    """
+    Returns the class of failure ("config", "disconnected", "busy",
+    "timeout", "capture", "io" or "unknown") described by an exception (or
+    error message) raised by a camera manager.
+    """
+    if isinstance(error, Exception):
+        message = " ".join([str(arg) for arg in error.args])
+    else:
+        message = str(error)
+
+    for failure_class, patterns in FAILURE_PATTERNS:
+        for pattern in patterns:
+            if message.find(pattern) != -1:
+                return failure_class
+    return "unknown"
+
+##########################################################################
+
+
+class RecoveryController:
+    """
+    State machine which tracks the run of consecutive capture failures of a
+    camera. Call failure() each time a capture fails, to find out which
+    recovery action to take, and success() each time one succeeds. Before
+    attempting a capture, call wait_time() to find out how much longer the
+    camera should be left alone for.
+
+    After breaker_threshold consecutive (non-config) failures the circuit
+    opens and the camera is reported as degraded. While the circuit is open
+    the backoff time is always backoff_max, and a single successful capture
+    closes it again.
+    """
+
+    def __init__(self, backoff_initial=5.0, backoff_max=300.0,
+                 breaker_threshold=6, clock=time.time):
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self._clock = clock
+
+        self.consecutive_failures = 0
+        self.last_failure_class = None
+        self.last_action = None
+        self.degraded = False
+        self._next_attempt = 0.0
+
+    ##########################################################################
+
+    def wait_time(self):
+        """
+        Returns the number of seconds before the camera should next be used,
+        or 0 if it can be used now.
+        """
+        return max(0.0, self._next_attempt - self._clock())
+
+    ##########################################################################
+
+    def failure(self, error):
+        """
+        Records a failed capture and returns a tuple (failure class, action),
+        where action is one of RETRY, RESET or REENUMERATE. The next attempt is
+        delayed by the backoff time. Recovery actions can take a while, so
+        call start_backoff() again once the action has been carried out.
+        """
+        failure_class = classify_failure(error)
+        self.last_failure_class = failure_class
+
+        if failure_class == "config":
+            # retrying won't fix the settings file, but there is no point in
+            # resetting the camera or backing off either
+            self.last_action = RETRY
+            return failure_class, RETRY
+
+        self.consecutive_failures += 1
+
+        actions = ESCALATION[failure_class]
+        action = actions[min(self.consecutive_failures, len(actions)) - 1]
+        self.last_action = action
+
+        if self.consecutive_failures >= self.breaker_threshold:
+            self.degraded = True
+
+        self.start_backoff()
+        return failure_class, action
+
+    ##########################################################################
+
+    def start_backoff(self):
+        """
+        Delays the next attempt until the backoff time from now.
+        """
+        self._next_attempt = self._clock() + self.backoff_time()
+
+    ##########################################################################
+
+    def success(self):
+        """
+        Records a successful capture, closing the circuit and resetting the
+        backoff time. Returns True if the camera was degraded until now.
+        """
+        was_degraded = self.degraded
+        self.consecutive_failures = 0
+        self.last_failure_class = None
+        self.last_action = None
+        self.degraded = False
+        self._next_attempt = 0.0
+        return was_degraded
+
+    ##########################################################################
+
+    def backoff_time(self):
+        """
+        Returns the delay (in seconds) to leave after the current run of
+        failures: backoff_initial after the first failure, doubling after each
+        further one up to backoff_max.
+        """
+        if self.consecutive_failures == 0:
+            return 0.0
+        if self.degraded:
+            return float(self.backoff_max)
+        return float(min(self.backoff_max,
+                         self.backoff_initial * 2 ** (self.consecutive_failures - 1)))
+
+    ##########################################################################
+
+    def state(self):
+        """
+        Returns a dict describing the state of the controller: {'state',
+        'consecutive_failures', 'last_failure', 'last_action', 'wait_time'},
+        where state is "ok", "recovering" or "degraded".
+        """
+        if self.degraded:
+            state = "degraded"
+        elif self.consecutive_failures > 0:
+            state = "recovering"
+        else:
+            state = "ok"
+
+        return {'state': state,
+                'consecutive_failures': self.consecutive_failures,
+                'last_failure': self.last_failure_class,
+                'last_action': self.last_action,
+                'wait_time': self.wait_time()}
+
+    ##########################################################################
+##########################################################################
@@ -24,26 +24,54 @@ OutputTaskHandler for processing.
 
 The CaptureManager also creates a HostManager object and uses this to update the
 folder structure on the host before each image is captured.
+
+Several cameras can be driven by the same CaptureManager (see the cameras
+setting). Each camera has its own camera manager, bound to its own USB port,
+and they all capture at the same time on their own threads. Their outputs are
+stored in a sub-folder for each camera.
+
+The times at which images are captured are worked out by a CadenceScheduler
+(see the cadence module), which keeps them on a fixed grid so that they do
+not drift, and which can lock them to UTC (see the phase_lock capture mode
+setting).
+
+The Scheduler tells the CaptureManager when it expects the capture mode to
+change next. Shortly before then (see the mode_prestage_time setting), once 
+the last image of the old capture mode has been captured, the cameras are set
+up for the new capture mode, and the CaptureManager switches to it at the time
+of the change, rather than waiting for the Scheduler to notice.
+
+If the camera managers can tell when their cameras are unplugged (see the 
+camera_usb_id setting), then capturing pauses while no cameras are plugged in,
+and resumes as soon as one is plugged back in.
 """
 import traceback
 import Queue
 import datetime
-import time
 import os
 
 from pysces_asi import host
 from pysces_asi import output_task_handler
 
-from pysces_asi.multitask import ThreadQueueBase, ThreadTask
+from pysces_asi.multitask import ThreadQueueBase, ThreadTask, TimeoutError
 from pysces_asi.data_storage_classes import CaptureMode
+from pysces_asi.cadence import CadenceScheduler, monotonic
 from pysces_asi.output_task import create_output_tasks
-from pysces_asi.camera import GphotoError
+from pysces_asi.camera import GphotoError, CameraRecoveryError, CameraSettings
+from pysces_asi.settings_manager import get_optional
 from pysces_asi import camera
 
 import logging
 
 log = logging.getLogger("capture")
 
+# put into the task queue to wake up a paused CaptureManager when a camera is
+# plugged back in
+CAMERA_CONNECTED = "camera connected"
+
+# put into the task queue when the scheduler predicts a different change of
+# capture mode, so that the CaptureManager re-calculates how long to wait
+TRANSITION_PREDICTED = "transition predicted"
 
 ##########################################################################
 
@@ -69,8 +97,44 @@ class CaptureManager(ThreadQueueBase):
                 ["camera"])['camera']
             camera.clear_plugins_list()
             camera.load_camera_plugins(cameras_folder)
-            self._camera_manager = camera.cameras[
-                camera_plugin_name](settings_manager)
+
+            # create a camera manager for each camera. If there is only one
+            # camera, then it isn't given a name and uses the default port
+            self._camera_managers = {}
+            cameras = get_optional(settings_manager, "cameras", None)
+            if cameras:
+                for name, definition in sorted(cameras.items()):
+                    plugin_name = definition.get("camera", camera_plugin_name)
+                    self._camera_managers[name] = camera.cameras[plugin_name](
+                        CameraSettings(settings_manager, name, definition.get("port")))
+                self._camera_names = sorted(cameras.keys())
+            else:
+                self._camera_managers[None] = camera.cameras[
+                    camera_plugin_name](settings_manager)
+                self._camera_names = None
+
+            # capturing is paused while none of the cameras are plugged in
+            self._paused = False
+
+            # schedules the captures of the current capture mode
+            self._cadence = None
+            self._cadence_mode = None
+
+            # (time, CaptureMode) of the next change of capture mode predicted
+            # by the Scheduler, and the name of the capture mode that we have
+            # switched to because of it (if any)
+            self._next_transition = (None, None)
+            self._prestaged_name = None
+            self._prestage_time = get_optional(
+                settings_manager, "mode_prestage_time", 10.0)
+
+            # how long to wait for the cameras to capture an image or set a
+            # capture mode before giving up on them
+            self._camera_task_timeout = get_optional(
+                settings_manager, "camera_task_timeout", 600.0)
+            for camera_manager in list(self._camera_managers.values()):
+                camera_manager.add_presence_listener(
+                    self._camera_presence_changed)
 
             self._output_task_handler = output_task_handler.OutputTaskHandler(
                 settings_manager)
@@ -94,11 +158,7 @@ class CaptureManager(ThreadQueueBase):
         this.
         """
         # pull the first capture mode out of the queue
-        capture_mode = self._task_queue.get()
-
-        top_of_min_wait = False
-        if hasattr(capture_mode, "top_of_min"):
-            top_of_min_wait = capture_mode.top_of_min
+        capture_mode = self._wait_for_next_item(None, None)
 
         while self._stay_alive or (not self._task_queue.empty()):
 
@@ -107,111 +167,107 @@ class CaptureManager(ThreadQueueBase):
             # make sure that the exit() method works correctly
             if isinstance(capture_mode, ThreadTask):
                 capture_mode.execute()
-                self._task_queue.task_done()
-            elif capture_mode == None:
+            elif capture_mode == None or capture_mode is CAMERA_CONNECTED:
                 # nothing to do - wait for a real capture mode to come through
                 # the queue
-                self._task_queue.task_done()
+                pass
             elif isinstance(capture_mode, CaptureMode):
                 # The somewhat unstable nature of gphoto makes this loop prone to failure
                 # if the gphoto call fails then we just skip this image and carry on with
                 # the next one
 
-                try:
-                    # set the camera settings to those required by the capture
-                    # mode
-                    self._camera_manager.set_capture_mode(capture_mode)
-
-                    # record the time before we try to take an image
-                    start_time = datetime.datetime.utcnow()
+                # each capture mode gets a new grid of capture times
+                if self._cadence is None or self._cadence_mode is not capture_mode:
+                    self._report_cadence()
+                    self._cadence = CadenceScheduler.for_capture_mode(
+                        capture_mode)
+                    self._cadence_mode = capture_mode
+
+                # wait for the slot of the next image (or for a camera to be
+                # plugged in), unless a new capture mode comes into the queue
+                if self._paused:
+                    if any([camera_manager.is_present() for camera_manager in list(self._camera_managers.values())]):
+                        # plugged in since we looked
+                        self._paused = False
+
+                if self._paused:
+                    wait = None
+                else:
+                    wait = self._cadence.wait_time()
+                    if self._cadence.frames == 0 and wait > 5:
+                        self._settings_manager.set(
+                            {"output": "CaptureManager> Waiting %ds for next capture slot." % wait})
+
+                if wait is None or wait > 0 or self._transition_due(capture_mode):
+                    try:
+                        next_item = self._wait_for_next_item(
+                            wait, capture_mode)
+                        if next_item is not CAMERA_CONNECTED and \
+                                not self._already_switched(next_item, capture_mode):
+                            capture_mode = next_item
+                        continue
+                    except Queue.Empty:
+                        # no new capture modes have come in, so we just
+                        # continue with the one we have got
+                        pass
+
+                jitter = self._cadence.start_frame()
+                log.debug("CaptureManager> capture started %.3fs after its slot" % jitter)
+
+                # set the camera settings to those required by the capture
+                # mode (on all the cameras that are plugged in at once)
+                present = [name for name, camera_manager in list(self._camera_managers.items())
+                           if camera_manager.is_present()]
+                ready = self._run_on_cameras(
+                    "start_set_capture_mode", present, capture_mode)
+
+                if len(present) == 0 and not self._paused:
+                    self._settings_manager.set(
+                        {"output": "CaptureManager> No cameras connected, capture paused"})
+                self._paused = len(present) == 0
 
+                if len(ready) > 0:
                     # update the folders on the host
-                    self._host_manager.update_folders(capture_mode)
+                    self._host_manager.update_folders(
+                        capture_mode, self._camera_names)
 
                     # get the current folder on the host
                     folder_on_host = self._settings_manager.get(
                         ["output folder"])["output folder"]
 
-                    if top_of_min_wait:
-                        now = datetime.datetime.utcnow()
-                        wait = now.replace(
-                            minute=now.minute + 1, second=0, microsecond=0) - now
-                        self._settings_manager.set(
-                            {"output": "CaptureManager> Waiting " + str(wait.seconds) + "s for top of minute."})
-                        time.sleep(
-                            wait.seconds + wait.microseconds / 1000000.0)
-                        start_time = datetime.datetime.utcnow()
+                    # capture images (on all the cameras at once) and produce
+                    # output tasks. Burst capture modes produce several frames
+                    # per camera, otherwise there is a single frame.
+                    if capture_mode.burst > 1:
+                        frames = self._run_on_cameras(
+                            "start_capture_burst", list(ready.keys()), capture_mode.burst)
+                    else:
+                        frames = {}
+                        for name, camera_images in list(self._run_on_cameras(
+                                "start_capture_images", list(ready.keys())).items()):
+                            frames[name] = [camera_images]
+                else:
+                    frames = {}
+
+                for name, camera_frames in sorted(frames.items()):
+                    if name is None:
+                        camera_folder = folder_on_host
+                    else:
+                        camera_folder = os.path.normpath(
+                            folder_on_host + "/" + name)
 
-                    # capture images and produce output tasks
-                    images = self._camera_manager.capture_images()
+                    for camera_images in camera_frames:
+                        if camera_images is None:
+                            continue
 
-                # RuntimeError is raised when gphoto fails in the cameraManager
-                except GphotoError as ex:
-                    log.warning("CaptureManager> gphoto fails: " + ex.args[0])
+                        # create an outputTask object for each image type and
+                        # pass them to the ouputTaskHandler
+                        output_tasks = create_output_tasks(
+                            capture_mode, camera_images, camera_folder, self._settings_manager)
+                        self._commit_output_tasks(output_tasks)
 
-                    self._settings_manager.set(
-                        {"output": "CaptureManager> " + ex.args[0]})
-                    images = None
-                    start_time = datetime.datetime.utcnow()
-
-                if images is not None:
-                    # create an outputTask object for each image type and pass
-                    # them to the ouputTaskHandler
-                    output_tasks = create_output_tasks(
-                        capture_mode, images, folder_on_host, self._settings_manager)
-                    i = 0
-                    flag = True
-                    while i < len(output_tasks):
-                        try:
-
-                            #                             log.info(
-                            #                                 "CaptureManager> Trying to set new OutputTaskHandler")
-                            self._output_task_handler.commit_task(
-                                output_tasks[i])
-                            i += 1
-                        except Queue.Full:
-                            # the outputTaskHandler is busy, wait for a bit and
-                            # then retry
-                            if flag:
-                                log.warn(
-                                    "CaptureManager> Waiting for OutputTaskHandler")
-                                self._settings_manager.set(
-                                    {"output": "CaptureManager> Waiting for OutputTaskHandler"})
-                                flag = False
-                            else:
-                                output_tasks[0].wait(timeout=0.01)
-                                output_tasks[0]._stay_alive=False
-
-                            time.sleep(0.2)
-                        except Exception as ex:
-                            traceback.print_exc()
-                            self.exit()
-                            raise ex
-
-                # wait remaining delay time, unless a new capture mode comes
-                # into the queue
-                try:
-                    # if the delay time has already been exceeded then set remaining delay to 0
-                    # otherwise it will be negative and cause problems
-                    if (datetime.datetime.utcnow() - start_time) > datetime.timedelta(seconds=capture_mode.delay):
-                        remaining_delay_time = 0
-                    else:
-                        remaining_delay_time = (datetime.timedelta(
-                            seconds=capture_mode.delay) - (datetime.datetime.utcnow() - start_time)).seconds
-                    if remaining_delay_time < 0:
-                        remaining_delay_time = 0
-
-                    capture_mode = self._task_queue.get(
-                        timeout=remaining_delay_time)
-                    self._task_queue.task_done()
-                    if hasattr(capture_mode, "top_of_min"):
-                        top_of_min_wait = capture_mode.top_of_min
-                    continue
-                except Queue.Empty:
-                    # no new capture modes have come in, so we just continue
-                    # with the one we have got
-                    top_of_min_wait = False
-                    continue
+                # go round again with the same capture mode
+                continue
 
             else:
                 # if this happens then something has gone seriously wrong!
@@ -224,12 +280,263 @@ class CaptureManager(ThreadQueueBase):
                 break
 
             # sit and wait for the next task or captureMode
-            capture_mode = self._task_queue.get()
+            capture_mode = self._wait_for_next_item(None, None)
 
         self._exit_event.set()
 
     ##########################################################################
 
+    def set_next_transition(self, transition_time, capture_mode):
+        """
+        Called by the Scheduler to say that capture_mode (a CaptureMode 
+        object) should be started at transition_time (a UTC datetime). Both
+        should be None if no change is expected.
+        """
+        if (transition_time, capture_mode) == (None, None) and \
+                self._next_transition == (None, None):
+            return
+        self._next_transition = (transition_time, capture_mode)
+        self._task_queue.put(TRANSITION_PREDICTED)
+
+    ##########################################################################
+
+    def _transition_due(self, capture_mode):
+        """
+        Returns True if a change from capture_mode to a different capture mode
+        is predicted within the next mode_prestage_time seconds.
+        """
+        transition_time, next_mode = self._next_transition
+        if next_mode is None or (capture_mode is not None and
+                                 next_mode.name == capture_mode.name):
+            return False
+        return (transition_time - datetime.datetime.utcnow()).total_seconds() <= self._prestage_time
+
+    ##########################################################################
+
+    def _already_switched(self, next_item, capture_mode):
+        """
+        Returns True if next_item is the Scheduler catching up with a change
+        of capture mode that we have already made, because it was predicted.
+        """
+        if not isinstance(next_item, CaptureMode) or not isinstance(capture_mode, CaptureMode):
+            return False
+        if self._prestaged_name is not None and next_item.name == self._prestaged_name == capture_mode.name:
+            self._prestaged_name = None
+            return True
+        return False
+
+    ##########################################################################
+
+    def _get_item(self, timeout):
+        """
+        Returns the next item in the task queue, waiting up to timeout 
+        seconds for it (forever if timeout is None). Raises Queue.Empty if 
+        there isn't one.
+        """
+        item = self._task_queue.get(timeout=timeout)
+        self._task_queue.task_done()
+        return item
+
+    ##########################################################################
+
+    def _wait_for_next_item(self, timeout, capture_mode):
+        """
+        Returns the next item in the task queue, waiting up to timeout seconds
+        for it (forever if timeout is None). Raises Queue.Empty if there isn't
+        one. If a change from capture_mode to a different capture mode is 
+        predicted before then, the cameras are set up for the new capture mode
+        mode_prestage_time seconds before the change, and the new capture mode
+        is returned at the time of the change (unless something comes through
+        the queue first). A change predicted after the timeout (the slot of
+        the next image of capture_mode) is left until that image has been
+        captured, so the cameras are never set up for the new capture mode
+        while there are still images of the old one to capture.
+        """
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = monotonic() + timeout
+
+        while True:
+            if deadline is None:
+                remaining = None
+            else:
+                remaining = max(0.0, deadline - monotonic())
+
+            transition_time, next_mode = self._next_transition
+            if next_mode is not None and (capture_mode is None or next_mode.name != capture_mode.name):
+                until_transition = (
+                    transition_time - datetime.datetime.utcnow()).total_seconds()
+                until_stage = until_transition - self._prestage_time
+
+                if remaining is None or until_transition <= remaining:
+                    try:
+                        item = self._get_item(max(0.0, until_stage))
+                        if item is TRANSITION_PREDICTED:
+                            continue
+                        return item
+                    except Queue.Empty:
+                        pass
+
+                    self._prestage(next_mode)
+
+                    try:
+                        item = self._get_item(max(0.0, (
+                            transition_time - datetime.datetime.utcnow()).total_seconds()))
+                        if item is TRANSITION_PREDICTED:
+                            continue
+                        return item
+                    except Queue.Empty:
+                        pass
+
+                    self._next_transition = (None, None)
+                    self._prestaged_name = next_mode.name
+                    self._settings_manager.set(
+                        {"output": "CaptureManager> Starting \"" + next_mode.name + "\" capture mode (predicted)",
+                         "current_capture_mode": next_mode.name})
+                    return next_mode
+
+            item = self._get_item(remaining)
+            if item is TRANSITION_PREDICTED:
+                continue
+            return item
+
+    ##########################################################################
+
+    def _prestage(self, capture_mode):
+        """
+        Sets the cameras up for the capture mode, so that its first image can
+        be captured as soon as it starts.
+        """
+        self._settings_manager.set(
+            {"output": "CaptureManager> Preparing cameras for \"" + capture_mode.name + "\" capture mode"})
+        present = [name for name, camera_manager in list(self._camera_managers.items())
+                   if camera_manager.is_present()]
+        self._run_on_cameras("start_set_capture_mode", present, capture_mode)
+
+    ##########################################################################
+
+    def get_cadence_stats(self):
+        """
+        Returns the timing statistics of the current capture mode: the number
+        of frames captured, the number of capture slots missed, and how late
+        (in seconds) the frames were started relative to their slots (see
+        CadenceScheduler.stats()). Returns None if nothing has been captured
+        yet.
+        """
+        cadence = self._cadence
+        if cadence is None:
+            return None
+        return cadence.stats()
+
+    ##########################################################################
+
+    def _report_cadence(self):
+        """
+        Outputs a summary of the capture timing of the capture mode that has
+        just finished.
+        """
+        if self._cadence is None or self._cadence.frames == 0:
+            return
+        stats = self._cadence.stats()
+        self._settings_manager.set(
+            {"output": "CaptureManager> %s: %d frames, jitter mean %.1fms max %.1fms, %d slots missed" %
+             (self._cadence_mode.name, stats['frames'], stats['jitter_mean'] * 1000.0,
+              stats['jitter_max'] * 1000.0, stats['missed_slots'])})
+
+    ##########################################################################
+
+    def _run_on_cameras(self, method_name, names, *args):
+        """
+        Calls the named start_...() method (e.g. "start_capture_images") of the 
+        camera managers with the given names, so that they all work at the same
+        time, and then waits for them all to finish. Returns a dict of 
+        {camera name:result} for the cameras that succeeded. Cameras which 
+        raise a GphotoError are reported and left out of the dict. Cameras
+        which are backing off after earlier failures are left out silently, 
+        since the camera managers report their own recovery. Cameras which
+        have not finished within camera_task_timeout seconds are reported and
+        left out too.
+        """
+        tasks = {}
+        for name in names:
+            tasks[name] = getattr(
+                self._camera_managers[name], method_name)(*args)
+
+        deadline = None
+        if self._camera_task_timeout is not None:
+            timeout = self._camera_task_timeout
+            if method_name == "start_capture_burst":
+                # each frame of a burst may take as long as a single capture
+                timeout *= args[0]
+            deadline = monotonic() + timeout
+
+        results = {}
+        for name in names:
+            try:
+                if deadline is None:
+                    results[name] = tasks[name].result()
+                else:
+                    results[name] = tasks[name].result(
+                        max(0.0, deadline - monotonic()))
+
+            except CameraRecoveryError as ex:
+                log.debug("CaptureManager> skipping camera " + str(name) + ": " + ex.args[0])
+
+            # GphotoError is raised when gphoto fails in the cameraManager
+            except GphotoError as ex:
+                if name is None:
+                    message = ex.args[0]
+                else:
+                    message = "(" + name + ") " + ex.args[0]
+                log.warning("CaptureManager> gphoto fails: " + message)
+
+                self._settings_manager.set(
+                    {"output": "CaptureManager> " + message})
+
+            except TimeoutError:
+                # the camera manager can't be interrupted, but if the task 
+                # hasn't started yet then it won't be run
+                tasks[name].cancel()
+                message = "Camera did not respond within " + \
+                    str(self._camera_task_timeout) + "s"
+                if name is not None:
+                    message = "(" + name + ") " + message
+                log.warning("CaptureManager> " + message)
+                self._settings_manager.set(
+                    {"output": "CaptureManager> " + message})
+        return results
+
+    ##########################################################################
+
+    def _camera_presence_changed(self, camera_name, present):
+        """
+        Called by the camera managers when their cameras are plugged in or 
+        unplugged. If capturing is paused, then it is resumed straight away.
+        """
+        if present and self._paused:
+            self._settings_manager.set(
+                {"output": "CaptureManager> Camera connected, capture resumed"})
+            self._paused = False
+            self._task_queue.put(CAMERA_CONNECTED)
+
+    ##########################################################################
+
+    def _commit_output_tasks(self, output_tasks):
+        """
+        Passes the output tasks to the OutputTaskHandler. If it is busy, then 
+        what happens depends on its output_backpressure policy.
+        """
+        for output_task in output_tasks:
+            try:
+                self._output_task_handler.submit_output_task(output_task)
+            except Exception as ex:
+                traceback.print_exc()
+                self.exit()
+                raise ex
+
+    ##########################################################################
+
     def exit(self):
         """
         Shuts down all the objects that this class created, and then kills its own
@@ -239,7 +546,8 @@ class CaptureManager(ThreadQueueBase):
         ThreadQueueBase.exit(self)
 
         try:
-            self._camera_manager.exit()
+            for camera_manager in list(self._camera_managers.values()):
+                camera_manager.exit()
         except AttributeError:
             pass
 
@@ -0,0 +1,166 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The card_index module provides the CardIndex class, which keeps track of the
+files stored on the camera card. It is used by the GphotoCameraManager to work
+out which files are new after an image has been captured without having to
+compare complete listings of the card, and to delete only the files that
+have been downloaded.
+"""
+
+
+def parse_listing(lines):
+    """
+    Parses the lines output by gphoto2 -L (--list-files) and returns a dict
+    of {folder:[filenames]}, where the filenames are in the order that gphoto2
+    listed (and numbered) them.
+    """
+    folders = {}
+    folder = None
+
+    for line in lines:
+        line = line.strip()
+
+        if line.startswith("There"):
+            # e.g. "There are 2 files in folder '/store_00010001/DCIM/100NIKON'."
+            folder = line.partition("\'")[2].rpartition("\'")[0]
+            folders[folder] = []
+
+        elif line.startswith("#") and folder is not None:
+            # e.g. "#1     DSC_0001.JPG      rd  2915 KB  3872x2592 image/jpeg"
+            words = line.split()
+            if len(words) >= 2:
+                folders[folder].append(words[1])
+
+    return folders
+
+##########################################################################
+
+
+class CardIndex:
+    """
+    Record of the files known to be on the camera card, stored per folder.
+    The index is initialised from a complete listing of the card and after
+    that is updated incrementally as files are added (captured) and removed
+    (deleted).
+    """
+
+    def __init__(self):
+        self.initialised = False
+        self._files = {}  # {folder:[filenames]} in camera order
+        self._known = {}  # {folder:set(filenames)} for fast lookups
+
+    ##########################################################################
+
+    def load_listing(self, listing):
+        """
+        Replaces the contents of the index with the files in a listing of the
+        card, which should be a dict of {folder:[filenames]} (see 
+        parse_listing()).
+        """
+        self._files = {}
+        self._known = {}
+        for folder, filenames in list(listing.items()):
+            self.load_folder(folder, filenames)
+        self.initialised = True
+
+    ##########################################################################
+
+    def load_folder(self, folder, filenames):
+        """
+        Replaces the contents of a single folder in the index.
+        """
+        self._files[folder] = list(filenames)
+        self._known[folder] = set(filenames)
+
+    ##########################################################################
+
+    def new_files(self, listing):
+        """
+        Returns a list of (folder, filename) tuples for the files in the 
+        {folder:[filenames]} listing which are not in the index. The index 
+        itself is not changed.
+        """
+        new_files = []
+        for folder, filenames in list(listing.items()):
+            known = self._known.get(folder, set())
+            for filename in filenames:
+                if filename not in known:
+                    new_files.append((folder, filename))
+        return new_files
+
+    ##########################################################################
+
+    def copy(self):
+        """
+        Returns a copy of the index. This can be used to find the files that
+        have been added to the card since the copy was made, even if the index
+        itself has been updated since.
+        """
+        index = CardIndex()
+        index.initialised = self.initialised
+        for folder, filenames in list(self._files.items()):
+            index.load_folder(folder, filenames)
+        return index
+
+    ##########################################################################
+
+    def add(self, folder, filename):
+        """
+        Adds a file to the index (at the end of its folder).
+        """
+        known = self._known.setdefault(folder, set())
+        if filename not in known:
+            known.add(filename)
+            self._files.setdefault(folder, []).append(filename)
+
+    ##########################################################################
+
+    def remove(self, folder, filename):
+        """
+        Removes a file from the index. Removing a file which is not in the
+        index does nothing.
+        """
+        known = self._known.get(folder, set())
+        if filename in known:
+            known.remove(filename)
+            self._files[folder].remove(filename)
+
+    ##########################################################################
+
+    def clear_folder(self, folder):
+        """
+        Removes all the files in a folder from the index.
+        """
+        self._files.pop(folder, None)
+        self._known.pop(folder, None)
+
+    ##########################################################################
+
+    def file_number(self, folder, filename):
+        """
+        Returns the number that gphoto2 uses to refer to the file within its
+        folder (as used by --get-file and --delete-file). This is only correct
+        if the folder's contents in the index are up to date and in camera
+        order. Raises KeyError if the file is not in the index.
+        """
+        if filename not in self._known.get(folder, set()):
+            raise KeyError(folder + "/" + filename)
+        return self._files[folder].index(filename) + 1
+
+    ##########################################################################
+##########################################################################
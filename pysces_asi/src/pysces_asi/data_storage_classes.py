@@ -17,10 +17,19 @@
 """
 This module defines three classes used for passing settings stored in the 
 settings file around within the program. This is more convenient than using
-nested dicts.
+nested dicts. It also defines the ImageBuffer class, which is used to pass
+images that have been captured into memory to the output pipeline.
 """
 import os
 
+# formats of the time of capture. FILENAME_TIME_FORMAT is used to name the
+# images in the tmp dir (burst capture modes add the milliseconds, see 
+# CaptureMode.is_burst()). CAPTURE_TIME_FORMAT is used for the 'Capture Time'
+# in the header of the PASKIL info dict, which unlike the 'Creation Time' is
+# recorded to the microsecond.
+FILENAME_TIME_FORMAT = "%Y%m%d_%H%M%S"
+CAPTURE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
 
 class CaptureMode:
     """
@@ -35,6 +44,10 @@ class CaptureMode:
     def __init__(self, capture_mode_settings, image_type_settings, output_type_settings):
         self.name = None
         self.delay = None
+        self.burst = 1
+        self.top_of_min = False
+        self.phase_lock = False
+        self.phase_offset = 0.0
         self.outputs = []
         self.camera_settings = {}
 
@@ -45,6 +58,12 @@ class CaptureMode:
                 self.delay = value
             elif name == "top_of_min":
                 self.top_of_min = value
+            elif name == "burst":
+                self.burst = int(value)
+            elif name == "phase_lock":
+                self.phase_lock = value
+            elif name == "phase_offset":
+                self.phase_offset = float(value)
             elif name == "outputs":
                 for output_name in value:
                     self.outputs.append(
@@ -61,6 +80,36 @@ class CaptureMode:
             raise ValueError(
                 "No outputs specified for captureMode. If there really are no outputs, then use outputs = [] in the settings file")
 
+    def camera_hash(self):
+        """
+        Returns a hash of the parts of the capture mode that affect how the 
+        camera is set up, i.e. the camera settings and the image types that 
+        the outputs require. Two capture modes with the same camera_hash need
+        the same camera configs.
+        """
+        settings = tuple(sorted([(name, repr(value)) for name, value in list(self.camera_settings.items())]))
+        image_types = tuple(sorted(set([output.image_type.image_type for output in self.outputs])))
+        return hash((settings, image_types, self.burst))
+
+    def is_burst(self):
+        """
+        Returns True if the capture mode captures images more than once a 
+        second (either with a delay of less than a second, or in bursts).
+        The images from these capture modes are named to the millisecond.
+        """
+        return self.delay < 1 or self.burst > 1
+
+    def timestamp(self, time_of_capture):
+        """
+        Returns the string used to name the image files captured at the given
+        time (a datetime) e.g. "20091019_224510", or "20091019_224510_250" for
+        burst capture modes.
+        """
+        timestamp = time_of_capture.strftime(FILENAME_TIME_FORMAT)
+        if self.is_burst():
+            timestamp += "_%03d" % (time_of_capture.microsecond // 1000)
+        return timestamp
+
 ##########################################################################
 
 
@@ -101,7 +150,11 @@ class OutputType:
 
     def __getattr__(self, name):
         # any additional attributes that are defined in the settings file can be
-        # recovered using this method.
+        # recovered using this method. Special names are not looked up, so that
+        # OutputTypes can be pickled (when unpickling, the settings have not
+        # been restored yet)
+        if name.startswith("__") or name == "_OutputType__output_type_settings":
+            raise AttributeError(name)
         try:
             if type(self.__output_type_settings[name]) is str:
                 return os.path.expandvars(self.__output_type_settings[name])
@@ -112,3 +165,32 @@ class OutputType:
                                  name + ". Check that it has been defined in the settings file")
 
 ##########################################################################
+
+
+class ImageBuffer:
+    """
+    The ImageBuffer class holds an image that has been downloaded from the camera 
+    straight into memory, along with its PASKIL info dict. It is used in place of
+    the (image file, info file) tuple returned by CameraManager.capture_images(),
+    so that the image does not have to be written to and re-read from the tmp dir.
+    The filename attribute is the name the image would have been given in the tmp
+    dir - it is used to name copies of the image and as its PASKIL filename.
+    """
+
+    def __init__(self, data, info, filename):
+        self.data = data
+        self.info = info
+        self.filename = filename
+
+    def save(self, filename=None):
+        """
+        Writes the raw image data to a file (by default the filename that the 
+        image would have had in the tmp dir).
+        """
+        if filename is None:
+            filename = self.filename
+
+        with open(filename, "wb") as fp:
+            fp.write(self.data)
+
+##########################################################################
@@ -0,0 +1,322 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The gphoto_session module provides the GphotoSession class, which keeps a
+single "gphoto2 --shell" process running and streams commands to it. This
+avoids forking a new gphoto2 process (which has to re-enumerate the USB bus
+and re-open the camera) for every camera operation.
+
+The session is not thread safe. It is intended to be owned by a camera
+manager, whose single worker thread is the only thread to access it.
+"""
+import os
+import re
+import time
+import signal
+import logging
+import threading
+
+from subprocess32 import Popen, PIPE, STDOUT
+
+log = logging.getLogger("gphoto_session")
+
+# the gphoto2 shell prompt looks like "gphoto2: {/home/user} /store_0001> "
+DEFAULT_PROMPT = r"gphoto2: \{[^}]*\} [^\n]*> $"
+
+
+def parse_ls(output):
+    """
+    Parses the output of the gphoto2 shell's "ls" command, and returns a tuple
+    of lists (folders, filenames). The shell prints the sub-folders (with a 
+    trailing "/") and then the files, two to a line.
+    """
+    folders = []
+    filenames = []
+    for word in output.split():
+        if word.endswith("/"):
+            folders.append(word.rstrip("/"))
+        else:
+            filenames.append(word)
+    return folders, filenames
+
+##########################################################################
+
+
+class GphotoSessionError(Exception):
+    """
+    Raised when a command sent to the gphoto2 shell fails, times out or when
+    the shell process dies.
+    """
+    pass
+
+
+class GphotoSession:
+    """
+    Wraps a long-lived "gphoto2 --shell" process. Commands are written to the
+    shell's stdin and its output is collected until the next prompt appears.
+    If the shell dies (or is closed) it is restarted automatically the next
+    time a command is run. The time taken by each command is recorded and can
+    be retrieved using get_latencies().
+    """
+
+    def __init__(self, executable="gphoto2", args="", prompt=DEFAULT_PROMPT,
+                 startup_timeout=30):
+        self.executable = executable
+        self.args = args
+        self.reconnects = 0
+        self._prompt = re.compile(prompt)
+        self._startup_timeout = startup_timeout
+        self._process = None
+        self._has_run = False
+        self._reader = None
+        self._buffer = ""
+        self._eof = False
+        self._condition = threading.Condition()
+        self._latencies = {}
+
+    ##########################################################################
+
+    def open(self):
+        """
+        Starts the gphoto2 shell and waits for its first prompt. Any existing
+        shell process is closed first.
+        """
+        self._terminate()
+
+        command = self.executable + " " + self.args + " --shell"
+        self._process = Popen(command, shell=True, stdin=PIPE, stdout=PIPE,
+                              stderr=STDOUT, preexec_fn=os.setsid)
+        self._buffer = ""
+        self._eof = False
+        self._reader = threading.Thread(target=self._read_output)
+        self._reader.setName("GphotoSession reader")
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+        try:
+            self._wait_for_prompt(self._startup_timeout)
+        except GphotoSessionError:
+            self._terminate()
+            raise
+
+    ##########################################################################
+
+    def close(self):
+        """
+        Terminates the gphoto2 shell (if it is running). This releases the
+        camera so that it can be used by other gphoto2 processes. Closing the
+        session deliberately does not count as a reconnect when it is next
+        used.
+        """
+        self._has_run = False
+        self._terminate()
+
+    ##########################################################################
+
+    def _terminate(self):
+        """
+        Stops the shell process, asking it to exit cleanly first.
+        """
+        if self._process is None:
+            return
+
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write(b"exit\n")
+                self._process.stdin.flush()
+            except (IOError, OSError, ValueError):
+                pass
+
+            # give the shell a moment to release the camera cleanly before
+            # killing it
+            deadline = time.time() + 2.0
+            while self._process.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+
+            if self._process.poll() is None:
+                try:
+                    os.killpg(self._process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self._process.wait()
+
+        if self._reader is not None:
+            self._reader.join(1.0)
+
+        for pipe in (self._process.stdin, self._process.stdout):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+        self._process = None
+        self._reader = None
+
+    ##########################################################################
+
+    def is_open(self):
+        """
+        Returns True if the gphoto2 shell process is running, False otherwise.
+        """
+        return self._process is not None and self._process.poll() is None
+
+    ##########################################################################
+
+    def run(self, command, timeout=30):
+        """
+        Sends a single command (e.g. "set-config-value iso 1600") to the
+        gphoto2 shell and returns its output as a string, once the shell has
+        printed its next prompt. If the shell is not running then it is
+        (re)started first. A GphotoSessionError is raised if the command
+        times out, if the shell dies or if gphoto2 reports an error. After a
+        timeout the shell is killed, so that the next command starts afresh.
+        """
+        if not self.is_open():
+            if self._has_run:
+                self.reconnects += 1
+                log.warning("gphoto2 shell is not running - restarting it")
+            self.open()
+        self._has_run = True
+
+        start_time = time.time()
+        with self._condition:
+            self._buffer = ""
+
+        try:
+            self._process.stdin.write((command + "\n").encode("utf-8"))
+            self._process.stdin.flush()
+        except (IOError, OSError) as ex:
+            self._terminate()
+            raise GphotoSessionError(
+                "Failed to send command to gphoto2 shell: " + str(ex) + " \n Command:" + command)
+
+        try:
+            output = self._wait_for_prompt(timeout)
+        except GphotoSessionError as ex:
+            self._record_latency(command, time.time() - start_time)
+            self._terminate()
+            raise GphotoSessionError(ex.args[0] + " \n Command:" + command)
+        self._record_latency(command, time.time() - start_time)
+
+        # some builds of gphoto2 echo the command back when stdin is not a
+        # terminal, so remove it if it is there
+        lines = output.splitlines()
+        if len(lines) > 0 and lines[0].strip() == command.strip():
+            lines.pop(0)
+        output = "\n".join(lines)
+
+        if output.count("*** Error") != 0:
+            raise GphotoSessionError(
+                "gphoto2 shell reported an error: " + output + " \n Command:" + command)
+
+        return output
+
+    ##########################################################################
+
+    def list_files(self, folder="/", recurse=True, timeout=30):
+        """
+        Shell equivalent of "gphoto2 --list-files --folder=folder". Returns a 
+        dict of {folder:[filenames]}, where the filenames are in the order 
+        that the camera listed them. If recurse is True, then the sub-folders
+        are listed as well.
+        """
+        listing = {}
+        folders = [folder]
+        while len(folders) > 0:
+            folder = folders.pop(0)
+            sub_folders, filenames = parse_ls(
+                self.run("ls " + folder, timeout=timeout))
+            listing[folder] = filenames
+            if recurse:
+                folders += [folder.rstrip("/") + "/" + name for name in sub_folders]
+        return listing
+
+    ##########################################################################
+
+    def get_latencies(self):
+        """
+        Returns a dict of {command:{'count','mean','max','last'}} describing
+        the time (in seconds) taken by each type of command sent to the
+        shell. The command is the first word of the command line, e.g.
+        "capture-image".
+        """
+        latencies = {}
+        for name, (count, total, maximum, last) in list(self._latencies.items()):
+            latencies[name] = {'count': count, 'mean': total / count,
+                               'max': maximum, 'last': last}
+        return latencies
+
+    ##########################################################################
+
+    def _record_latency(self, command, duration):
+        words = command.split()
+        if len(words) == 0:
+            return
+        count, total, maximum, last = self._latencies.get(
+            words[0], (0, 0.0, 0.0, 0.0))
+        self._latencies[words[0]] = (count + 1, total + duration,
+                                     max(maximum, duration), duration)
+
+    ##########################################################################
+
+    def _read_output(self):
+        """
+        Run by the reader thread. Copies everything the shell prints into the
+        output buffer until the shell's stdout is closed.
+        """
+        fd = self._process.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                data = b""
+
+            with self._condition:
+                if not data:
+                    self._eof = True
+                    self._condition.notify_all()
+                    return
+                self._buffer += data.decode("utf-8", "replace")
+                self._condition.notify_all()
+
+    ##########################################################################
+
+    def _wait_for_prompt(self, timeout):
+        """
+        Blocks until the shell prints a prompt and returns everything printed
+        before it.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                match = self._prompt.search(self._buffer)
+                if match is not None:
+                    output = self._buffer[:match.start()]
+                    self._buffer = ""
+                    return output
+
+                if self._eof:
+                    raise GphotoSessionError(
+                        "gphoto2 shell exited unexpectedly: " + self._buffer)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise GphotoSessionError("Timeout")
+                self._condition.wait(remaining)
+
+    ##########################################################################
+##########################################################################
@@ -41,11 +41,13 @@ class HostManager:
         
     ############################################################################################## 
              
-    def update_folders(self, capture_mode):
+    def update_folders(self, capture_mode, camera_names=None):
         """
         Creates the folder structure required by the specified CaptureMode object.
         The structure changes between CaptureModes since they may require different 
         outputs. It also changes with time, as the day, month, year folders change.
+        If a list of camera_names is given (because several cameras are in use) then
+        the output folders and the tmp dir are created in a sub-folder for each camera.
         """
         
         #get required global variables
@@ -78,6 +80,18 @@ class HostManager:
             #Maybe due to network latency or something? 
                 pass 
 
+        #each camera has its own folder if there are several of them
+        if camera_names:
+            camera_folders = [os.path.normpath(current_folder + "/" + name) for name in camera_names]
+            for camera_folder in camera_folders:
+                if not os.path.exists(camera_folder):
+                    try:
+                        os.mkdir(camera_folder)
+                    except OSError:
+                        pass
+        else:
+            camera_folders = [current_folder]
+        
         #create sub_directories for the different outputs
         output_folders = set([])
         
@@ -95,20 +109,27 @@ class HostManager:
                 if ((sub_folder == None) or (sub_folder == "")):
                     continue
                 
-                if not os.path.exists(os.path.normpath(current_folder + "/" + sub_folder)):
-                    try:
-                        os.mkdir(os.path.normpath(current_folder + "/" + sub_folder))
-                    except OSError:
-                        pass
+                for camera_folder in camera_folders:
+                    if not os.path.exists(os.path.normpath(camera_folder + "/" + sub_folder)):
+                        try:
+                            os.makedirs(os.path.normpath(camera_folder + "/" + sub_folder))
+                        except OSError:
+                            pass
         #update output folder variable
         self.__settings_manager.set({"output folder":current_folder})
         
         #create tmp dir if it doesn't exist already
-        if not os.path.exists(glob_vars['tmp dir']):
-            try:
-                os.makedirs(glob_vars['tmp dir'])
-            except OSError:
-                pass
+        if camera_names:
+            tmp_dirs = [os.path.normpath(glob_vars['tmp dir'] + "/" + name) for name in camera_names]
+        else:
+            tmp_dirs = [glob_vars['tmp dir']]
+            
+        for tmp_dir in tmp_dirs:
+            if not os.path.exists(tmp_dir):
+                try:
+                    os.makedirs(tmp_dir)
+                except OSError:
+                    pass
         
             
     ##############################################################################################                     
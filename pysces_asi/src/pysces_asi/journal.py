@@ -0,0 +1,274 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The journal module provides the OutputJournal class, a write-ahead log of the
+images that have been captured and of which of their outputs have been
+produced. The OutputTaskHandler records each OutputTask in the journal before
+it is queued, so that if pysces_asi crashes or is restarted, the images left in
+the tmp dir can be matched up with the outputs that still need producing, and
+processed again in the order that they were captured.
+
+The journal is a text file with one JSON record per line. Records are only
+ever appended, apart from when the journal is compacted to remove the records
+of tasks that have finished. Every record is flushed straight away, but only
+the ones which change which files a task needs, or where it is queued, are
+synced to disk (see DURABLE_RECORDS). If one of the others is lost in a crash,
+then an output is produced twice or a finished task is found to have lost its
+image, which the recovery copes with anyway.
+"""
+import os
+import json
+import threading
+import logging
+
+log = logging.getLogger("journal")
+
+# the types of record which are fsync'ed as soon as they are written
+DURABLE_RECORDS = ('capture', 'spilled', 'queued')
+
+##########################################################################
+
+
+class OutputJournal:
+    """
+    Records the progress of OutputTasks in the journal file. Each task is
+    given an id by capture(), and then has output_done() recorded for each of
+    its outputs that is produced successfully and finished() recorded once
+    its temporary files have been dealt with. Tasks which are written to the
+    spill folder are marked with spilled() (and queued() when they are read
+    back in), since they are recovered from there instead.
+
+    The tasks which were not finished when the journal was last closed are
+    loaded when the journal is opened, see pending().
+    """
+
+    def __init__(self, filename, compact_interval=1000):
+        self.filename = filename
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+
+        # {id:record} of the tasks that have not finished
+        self._open_tasks = {}
+        self._next_id = 0
+        self._finished_since_compact = 0
+
+        folder = os.path.dirname(filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self._load()
+        self._pending = [dict(record) for id_, record in sorted(self._open_tasks.items())
+                         if not record.get('spilled', False)]
+
+        self._fp = open(self.filename, "a")
+        self.compact()
+
+    ##########################################################################
+
+    def _load(self):
+        """
+        Reads the existing journal (if there is one) into _open_tasks.
+        """
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, "r") as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line which was only half written when we crashed
+                    log.warning("Ignoring corrupt journal record: " + line.strip())
+                    continue
+                self._apply(record)
+
+    ##########################################################################
+
+    def _apply(self, record):
+        """
+        Updates _open_tasks with a journal record.
+        """
+        type_ = record['type']
+        id_ = record['id']
+        self._next_id = max(self._next_id, id_ + 1)
+
+        if type_ == 'capture':
+            task = dict(record)
+            task['done'] = []
+            self._open_tasks[id_] = task
+            return
+
+        task = self._open_tasks.get(id_)
+        if task is None:
+            return
+
+        if type_ == 'done':
+            task['done'].append(record['output'])
+        elif type_ == 'spilled':
+            task['spilled'] = True
+        elif type_ == 'queued':
+            task['spilled'] = False
+        elif type_ == 'finished':
+            if record.get('kept', False):
+                # the image was left in the tmp dir because some of its
+                # outputs failed, it can be tried again after a restart
+                task['kept'] = True
+                task['image'] = record['image']
+                task['info'] = record['info']
+            else:
+                del self._open_tasks[id_]
+
+    ##########################################################################
+
+    def _write(self, record):
+        """
+        Appends a record to the journal. Records in DURABLE_RECORDS (and the
+        finished records of tasks whose images were kept) are also synced to
+        disk.
+        """
+        with self._lock:
+            self._apply(record)
+            self._fp.write(json.dumps(record) + "\n")
+            self._fp.flush()
+            if record['type'] in DURABLE_RECORDS or record.get('kept', False):
+                os.fsync(self._fp.fileno())
+
+    ##########################################################################
+
+    def pending(self):
+        """
+        Returns a list of the tasks that had not finished (or whose images
+        were kept after their outputs failed) when the journal was opened, in
+        the order they were captured. Each task is a dict of {'id', 'image',
+        'info', 'memory', 'folder', 'outputs', 'done', 'attempt', 'kept'},
+        where image and info are the files in the tmp dir (info is None and
+        memory is True for images that were captured to memory), outputs is a
+        list of the names of the outputs and done a list of the ones which
+        were produced.
+        """
+        return [dict(record) for record in self._pending]
+
+    ##########################################################################
+
+    def capture(self, image, info, memory, folder, outputs, attempt=1):
+        """
+        Records a new task for the image, which should be produced into
+        folder (on the host) with the outputs in the list of output names.
+        Returns the id of the task.
+        """
+        with self._lock:
+            id_ = self._next_id
+            self._next_id += 1
+
+        self._write({'type': 'capture', 'id': id_, 'image': image,
+                     'info': info, 'memory': memory, 'folder': folder,
+                     'outputs': list(outputs), 'attempt': attempt})
+        return id_
+
+    ##########################################################################
+
+    def output_done(self, id_, output):
+        """
+        Records that the named output of the task has been produced.
+        """
+        self._write({'type': 'done', 'id': id_, 'output': output})
+
+    ##########################################################################
+
+    def spilled(self, id_):
+        self._write({'type': 'spilled', 'id': id_})
+
+    ##########################################################################
+
+    def queued(self, id_):
+        self._write({'type': 'queued', 'id': id_})
+
+    ##########################################################################
+
+    def finished(self, id_, kept=False, image=None, info=None):
+        """
+        Records that the task has finished. If kept is True, then its image
+        (now in the files image and info) was left in the tmp dir because
+        some of its outputs failed.
+        """
+        record = {'type': 'finished', 'id': id_, 'kept': kept}
+        if kept:
+            record['image'] = image
+            record['info'] = info
+        self._write(record)
+
+        self._finished_since_compact += 1
+        if self._finished_since_compact >= self.compact_interval:
+            self.compact()
+
+    ##########################################################################
+
+    def compact(self):
+        """
+        Rewrites the journal, keeping only the records of the tasks which have
+        not finished.
+        """
+        with self._lock:
+            temp_filename = self.filename + ".tmp"
+            with open(temp_filename, "w") as fp:
+                for id_, task in sorted(self._open_tasks.items()):
+                    record = dict(task)
+                    done = record.pop('done')
+                    spilled = record.pop('spilled', False)
+                    kept = record.pop('kept', False)
+                    fp.write(json.dumps(record) + "\n")
+                    for output in done:
+                        fp.write(json.dumps(
+                            {'type': 'done', 'id': id_, 'output': output}) + "\n")
+                    if spilled:
+                        fp.write(json.dumps(
+                            {'type': 'spilled', 'id': id_}) + "\n")
+                    if kept:
+                        fp.write(json.dumps({'type': 'finished', 'id': id_, 'kept': True,
+                                             'image': task['image'],
+                                             'info': task['info']}) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            self._fp.close()
+            os.rename(temp_filename, self.filename)
+            self._fp = open(self.filename, "a")
+            self._finished_since_compact = 0
+
+    ##########################################################################
+
+    def get_open_files(self):
+        """
+        Returns a set of the files in the tmp dir which belong to tasks that
+        have not finished.
+        """
+        with self._lock:
+            files = set()
+            for task in list(self._open_tasks.values()):
+                for name in ('image', 'info'):
+                    if task.get(name):
+                        files.add(os.path.normpath(task[name]))
+        return files
+
+    ##########################################################################
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+    ##########################################################################
+##########################################################################
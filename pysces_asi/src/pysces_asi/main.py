@@ -14,6 +14,8 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import signal
 import threading
 import matplotlib
 
@@ -23,6 +25,8 @@ matplotlib.use('Agg')
 
 from pysces_asi import settings_manager
 from pysces_asi import scheduler
+from pysces_asi import queue_metrics
+from pysces_asi import async_runtime
 # from pysces_asi import cron
 
 
@@ -34,6 +38,33 @@ class MainBox:
         # create settings manger object)
         self.__settings_manager = settings_manager.SettingsManager()
 
+        # write the metrics of the task queues to a file periodically, and
+        # whenever we are sent SIGUSR1
+        self.__queue_metrics_writer = None
+        metrics_file = settings_manager.get_optional(
+            self.__settings_manager, "queue_metrics_file", "")
+        if metrics_file:
+            self.__queue_metrics_writer = queue_metrics.QueueMetricsWriter(
+                os.path.expanduser(metrics_file),
+                settings_manager.get_optional(self.__settings_manager, "queue_metrics_interval", 300))
+            try:
+                signal.signal(signal.SIGUSR1, self.__dump_queue_metrics)
+            except ValueError:
+                # signal handlers can only be set from the main thread
+                pass
+
+        # the managers created from here on can share one dispatcher thread
+        # rather than having threads each (the settings manager is already
+        # running)
+        if settings_manager.get_optional(self.__settings_manager, "async_runtime", False):
+            async_runtime.enable(
+                settings_manager.get_optional(
+                    self.__settings_manager, "async_runtime_idle_timeout", 60.0),
+                settings_manager.get_optional(
+                    self.__settings_manager, "async_runtime_max_threads", 16))
+            self.__settings_manager.set(
+                {"output": "MainBox> Using the async runtime"})
+
         # create cron manager and run intialisation tasks
         # self.__cron_manager = cron.CronManager(self.__settings_manager)
         # self.__cron_manager.run_init_tasks()
@@ -45,6 +76,19 @@ class MainBox:
 
     ##########################################################################
 
+    def __dump_queue_metrics(self, signum, frame):
+        self.__queue_metrics_writer.write()
+
+    ##########################################################################
+
+    def get_queue_metrics(self):
+        """
+        Returns the metrics of all the task queues, see queue_metrics.summary().
+        """
+        return queue_metrics.summary()
+
+    ##########################################################################
+
     def start(self):
         if self.__capture_thread == None:
             # create task
@@ -92,6 +136,11 @@ class MainBox:
             # give up updating it.
             print(ex.args[0])
 
+        if self.__queue_metrics_writer is not None:
+            self.__queue_metrics_writer.stop()
+
+        async_runtime.shutdown()
+
     ##########################################################################
 
     def setVar(self, names):
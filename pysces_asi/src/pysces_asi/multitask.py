@@ -23,18 +23,96 @@ interchangable. They have two main purposes. Syncronisation: by setting the
 number of workers to 1, method calls from multiple threads/processes are queued
 and executed sequentially. Parallelisation: by setting the number of workers to
 >1, method calls are processed concurrently by multiple threads or processes.
+
+The task objects returned by create_task() (ThreadTask and ProcessTask) can be
+used in the same way as concurrent.futures.Future objects: as well as 
+result(), they provide done(), exception(), cancel() and add_done_callback(),
+and groups of them can be waited on with the wait() and as_completed() 
+functions in this module. ThreadQueueBase also provides submit() and map() 
+methods, like a concurrent.futures.Executor, so that several requests can be 
+made without waiting for each one in turn.
+
+Every queue records how long its tasks wait and take to run, how deep the
+queue gets and how busy its workers are, see the queue_metrics module.
+
+If the async_runtime has been enabled, then ThreadQueueBase instances which
+use the default _process_tasks() have no threads of their own, their tasks are
+run by the runtime's dispatcher and executor instead (see the async_runtime 
+module).
 """
+import os
 import time
+import types
+import pickle
+import select
+import signal
 import traceback
+import itertools
 import multiprocessing
 import logging
 
-from Queue import Queue
+try:
+    import copy_reg
+except ImportError:
+    import copyreg as copy_reg
+
+from Queue import Queue, PriorityQueue
 from Queue import Empty
-from threading import Event, Thread, currentThread
+from threading import Event, Thread, Condition, Lock, currentThread, local
+
+from pysces_asi import queue_metrics, async_runtime
+
+# use the concurrent.futures exceptions if they are available (Python >= 3.2 or
+# the futures backport) so that callers can catch either
+try:
+    from concurrent.futures import TimeoutError, CancelledError
+except ImportError:
+    class TimeoutError(Exception):
+        pass
+
+    class CancelledError(Exception):
+        pass
+
+# return_when values for wait()
+FIRST_COMPLETED = "FIRST_COMPLETED"
+FIRST_EXCEPTION = "FIRST_EXCEPTION"
+ALL_COMPLETED = "ALL_COMPLETED"
 
 log = logging.getLogger("multitask")
 
+# ids of ProcessTasks, used to match up the results sent back by the workers
+_process_task_ids = itertools.count()
+
+# the task being run by each thread, see cancel_requested()
+_current = local()
+
+# the ids of the task being run by this process (if it is a worker of a
+# ProcessQueueBase) and of the last task that was cancelled
+_worker_state = {"current": None, "cancelled": None}
+
+
+def cancel_requested():
+    """
+    Returns True if cancel() has been called on the task that the calling 
+    thread is running (in a ThreadQueueBase or a worker process of a 
+    ProcessQueueBase) after it started. Tasks cannot be stopped once they 
+    have started, so long-running functions should check this now and again,
+    and return early (or raise CancelledError) if it is True.
+    """
+    task = getattr(_current, "task", None)
+    if task is not None:
+        return task._cancel_requested
+    return _worker_state["current"] is not None and \
+        _worker_state["current"] == _worker_state["cancelled"]
+
+
+def _reduce_method(method):
+    return (getattr, (method.__self__, method.__func__.__name__))
+
+# allow bound methods (e.g. SubTask.execute) to be pickled, so that they can be
+# sent to the worker processes of a ProcessQueueBase
+copy_reg.pickle(types.MethodType, _reduce_method)
+
 
 class RemoteTask:
     """
@@ -52,7 +130,219 @@ class RemoteTask:
 ###########################################################################
 
 
-class ThreadTask:
+class TaskBase:
+    """
+    Base class for ThreadTask and ProcessTask, which provides the methods of a
+    concurrent.futures.Future. Sub-classes call _start() when they start 
+    running, and _finish() with the result (or the exception raised) when they
+    are done.
+
+    If time_limit is set (in seconds) when the task is committed to a 
+    ProcessQueueBase, then the worker process running it is killed if it
+    runs for longer than that, and the task fails with a TimeoutError.
+    """
+
+    def __init__(self):
+        self.time_limit = None
+        self._metrics = None
+        self._enqueue_time = None
+        self._start_time = None
+        self._return_value = None
+        self._exception = None
+        self._running = False
+        self._cancelled = False
+        self._cancel_requested = False
+        self._cancel_hook = None
+        self._callbacks = []
+        self._waiters = []
+        self._state_lock = Lock()
+        self.completed = Event()
+
+    ###########################################################################
+
+    def _start(self):
+        """
+        Marks the task as running. Returns False if it has been cancelled, in 
+        which case it should not be run.
+        """
+        with self._state_lock:
+            if self._cancelled:
+                return False
+            self._running = True
+
+        if self._metrics is not None:
+            self._start_time = time.time()
+            self._metrics.started(self._start_time - self._enqueue_time)
+        return True
+
+    ###########################################################################
+
+    def _queued(self, metrics):
+        """
+        Records that the task is about to be put into the queue whose 
+        QueueMetrics are given.
+        """
+        self._metrics = metrics
+        self._enqueue_time = time.time()
+
+    ###########################################################################
+
+    def _finish(self, return_value=None, exception=None):
+        """
+        Stores the result of the task, marks it as completed and runs the 
+        callbacks.
+        """
+        if self._start_time is not None:
+            self._metrics.finished(time.time() - self._start_time,
+                                   failed=exception is not None)
+
+        with self._state_lock:
+            self._return_value = return_value
+            self._exception = exception
+            self._running = False
+            self.completed.set()
+            callbacks = self._waiters + self._callbacks
+        self._run_callbacks(callbacks)
+
+    ###########################################################################
+
+    def _run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception("Exception in task callback")
+
+    ###########################################################################
+
+    def _add_waiter(self, waiter):
+        """
+        As add_done_callback(), but the waiter can be removed again, see
+        wait() and as_completed().
+        """
+        with self._state_lock:
+            if not self.completed.is_set():
+                self._waiters.append(waiter)
+                return
+        waiter(self)
+
+    ###########################################################################
+
+    def _remove_waiter(self, waiter):
+        with self._state_lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    ###########################################################################
+
+    def cancel(self):
+        """
+        Cancels the task if it has not started running yet. Returns True if 
+        the task is (now) cancelled. If the task is running, then False is 
+        returned, but the function being run will see cancel_requested() 
+        return True.
+        """
+        with self._state_lock:
+            if self._cancelled:
+                return True
+            if self.completed.is_set():
+                return False
+            if self._running:
+                self._cancel_requested = True
+                hook = self._cancel_hook
+            else:
+                hook = None
+        if hook is not None:
+            hook()
+        with self._state_lock:
+            if self._running or self.completed.is_set():
+                return False
+            self._cancelled = True
+            self.completed.set()
+            callbacks = self._waiters + self._callbacks
+        self._run_callbacks(callbacks)
+        return True
+
+    ###########################################################################
+
+    def cancelled(self):
+        return self._cancelled
+
+    ###########################################################################
+
+    def cancel_requested(self):
+        """
+        Returns True if cancel() was called while the task was running.
+        """
+        return self._cancel_requested
+
+    ###########################################################################
+
+    def running(self):
+        return self._running
+
+    ###########################################################################
+
+    def done(self):
+        """
+        Returns True if the task has finished running or was cancelled.
+        """
+        return self.completed.is_set()
+
+    ###########################################################################
+
+    def add_done_callback(self, fn):
+        """
+        Arranges for fn to be called with the task as its only argument when 
+        the task finishes (or is cancelled). The callback is run by the thread
+        that completes the task, or straight away if it is already done.
+        """
+        with self._state_lock:
+            if not self.completed.is_set():
+                self._callbacks.append(fn)
+                return
+        self._run_callbacks([fn])
+
+    ###########################################################################
+
+    def _wait(self, timeout):
+        if not self.completed.wait(timeout):
+            raise TimeoutError()
+        if self._cancelled:
+            raise CancelledError()
+
+    ###########################################################################
+
+    def exception(self, timeout=None):
+        """
+        Blocks until the task is executed (for at most timeout seconds) and 
+        returns the exception it raised, or None if it didn't raise one.
+        """
+        self._wait(timeout)
+        return self._exception
+
+    ###########################################################################
+
+    def result(self, timeout=None):
+        """
+        Blocks until the task is executed and then returns the result. If the
+        target function has no return value then None is returned when the 
+        task is completed. If the target function raised an exception when it
+        was executed, then calling result() will raise the same exception. If
+        timeout is not None and the task has not completed after timeout 
+        seconds, then TimeoutError is raised.
+        """
+        self._wait(timeout)
+        if self._exception is None:
+            return self._return_value
+        else:
+            raise self._exception
+
+    ###########################################################################
+###########################################################################
+
+
+class ThreadTask(TaskBase):
     """
     Represents a task to be executed by a ThreadQueueBase instance. The 
     ThreadTask object provides a method to execute the task, and a method to 
@@ -60,13 +350,10 @@ class ThreadTask:
     """
 
     def __init__(self, func, *args, **kwargs):
+        TaskBase.__init__(self)
         self._function = func
         self._args = args
         self._kwargs = kwargs
-        self._return_value = None
-        self.completed = Event()
-        self._exception = None
-        self._traceback = None
 
     ###########################################################################
 
@@ -74,40 +361,145 @@ class ThreadTask:
         """
         Executes the task.
         """
+        # tasks which have been cancelled are not run
+        if not self._start():
+            return
+
         # try to run the function. If it fails then store the exception object
         # to pass to outside thread
+        _current.task = self
         try:
             #             log.info("Executing task: " + str(currentThread()))
-            self._return_value = self._function(*self._args, **self._kwargs)
+            return_value = self._function(*self._args, **self._kwargs)
 
         # catch any exceptions that were raised during execution so that they
         # can be raised in the calling thread, rather than the worker thread.
         except Exception as xxx_todo_changeme:
-            self._exception = xxx_todo_changeme
             log.warning("\nException in thread: " + str(currentThread()))
             traceback.print_exc()
+            self._finish(exception=xxx_todo_changeme)
+            return
+        finally:
+            _current.task = None
 
         # set the event to true, to show that the task is finished
-        self.completed.set()
+        self._finish(return_value)
 
     ###########################################################################
+###########################################################################
+###########################################################################
+
+
+def wait(tasks, timeout=None, return_when=ALL_COMPLETED):
+    """
+    Waits for the tasks (ThreadTasks or ProcessTasks) to complete, as 
+    concurrent.futures.wait(). return_when may be FIRST_COMPLETED, 
+    FIRST_EXCEPTION or ALL_COMPLETED. Returns a tuple of (done, not_done) sets
+    of tasks.
+    """
+    tasks = set(tasks)
+    event = Event()
+
+    def waiter(task):
+        event.set()
+
+    for task in tasks:
+        task._add_waiter(waiter)
+
+    if timeout is not None:
+        end_time = time.time() + timeout
+    try:
+        while True:
+            event.clear()
+            done = set([t for t in tasks if t.done()])
+            if len(done) == len(tasks):
+                break
+            if return_when == FIRST_COMPLETED and len(done) > 0:
+                break
+            if return_when == FIRST_EXCEPTION and \
+                    any([not t.cancelled() and t._exception is not None for t in done]):
+                break
+
+            if timeout is None:
+                event.wait()
+            else:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                event.wait(remaining)
+    finally:
+        for task in tasks:
+            task._remove_waiter(waiter)
+
+    return done, tasks - done
 
-    def result(self):
+###########################################################################
+
+
+def as_completed(tasks, timeout=None):
+    """
+    Returns an iterator over the tasks (ThreadTasks or ProcessTasks) which 
+    yields them as they complete, as concurrent.futures.as_completed(). If
+    timeout is not None and not all the tasks have completed within timeout 
+    seconds, then TimeoutError is raised.
+    """
+    tasks = set(tasks)
+    finished = Queue()
+    for task in tasks:
+        task._add_waiter(finished.put)
+
+    if timeout is not None:
+        end_time = time.time() + timeout
+    try:
+        for i in range(len(tasks)):
+            if timeout is None:
+                yield finished.get()
+            else:
+                try:
+                    yield finished.get(timeout=max(0, end_time - time.time()))
+                except Empty:
+                    raise TimeoutError(str(len(tasks) - i) + " tasks not completed")
+    finally:
+        for task in tasks:
+            task._remove_waiter(finished.put)
+
+###########################################################################
+
+
+class TaskQueue(Queue):
+    """
+    Queue which allows the items waiting in it to be looked at, and removed
+    without being taken out by get().
+    """
+
+    def snapshot(self):
         """
-        Blocks until the task is executed and then returns the result. If the
-        target function has no return value then None is returned when the 
-        task is completed. If the target function raised an exception when it
-        was executed, then calling result() will raise the same exception.
+        Returns a list of the items in the queue (oldest first).
         """
-        try:
-            self.completed.wait()
-        except Empty:
-            log.warning("Result timed out")
-        if self._exception is None:
-            return self._return_value
-        else:
-            traceback.print_exc()
-            raise self._exception
+        with self.mutex:
+            return list(self.queue)
+
+    ###########################################################################
+
+    def remove_first(self, match):
+        """
+        Removes the first (oldest) item in the queue for which match(item) 
+        returns True, and returns it. The item counts as done (see join()).
+        Returns None if there is no such item.
+        """
+        with self.mutex:
+            for item in self.queue:
+                if match(item):
+                    break
+            else:
+                return None
+
+            self.queue.remove(item)
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+            self.not_full.notify()
+            return item
 
     ###########################################################################
 ###########################################################################
@@ -116,15 +508,30 @@ class ThreadTask:
 class ThreadQueueBase:
     """
     Base class for classes running in separate threads and using a task queue
-    for input.
+    for input. Sub-classes can set queue_class to use a different type of 
+    queue for the tasks.
     """
 
+    queue_class = Queue
+
     def __init__(self, workers=1, maxsize=0, name="Un-named"):
         self._workers = []
-        self._task_queue = Queue(maxsize=maxsize)
+        self._task_queue = self.queue_class(maxsize=maxsize)
         self._stay_alive = True
         self.name = name
         self._exit_event = Event()
+        self._worker_count = workers
+        self._queue_metrics = queue_metrics.register(
+            name, workers, self._task_queue.qsize)
+
+        # queues which process their tasks in the normal way can be run by the
+        # async_runtime rather than by their own threads
+        self._service = None
+        if async_runtime.enabled() and self._default_processing():
+            self._service = async_runtime.QueueService(
+                async_runtime.get_runtime(), self._task_queue, workers, name)
+            return
+
         for i in range(workers):
             self._workers.append(Thread(target=self._process_tasks))
             self._workers[i].setName(self.name + " thread " + str(i))
@@ -132,6 +539,17 @@ class ThreadQueueBase:
 
     ###########################################################################
 
+    def _default_processing(self):
+        """
+        Returns True if the class uses ThreadQueueBase's _process_tasks()
+        method, rather than its own.
+        """
+        method = getattr(self.__class__._process_tasks, "__func__",
+                         self.__class__._process_tasks)
+        return method is _base_process_tasks
+
+    ###########################################################################
+
     def _process_tasks(self):
         """
         Run by the internal worker thread(s), this method pulls tasks out of
@@ -184,7 +602,103 @@ class ThreadQueueBase:
 #                     "### Error! ### Worker thread in " + self.name + " has died!")
 
         if self._stay_alive:
+            # sub-classes may queue other objects (e.g. the CaptureManager is
+            # given CaptureModes), which are counted but not timed
+            if isinstance(task, TaskBase):
+                task._queued(self._queue_metrics)
             self._task_queue.put(task, timeout=timeout)
+            self._queue_metrics.enqueued(self._task_queue.qsize())
+            if self._service is not None:
+                self._service.notify()
+
+    ###########################################################################
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Creates a task to call func(*args, **kwargs) and commits it, returning
+        the task without waiting for it to be executed (like the submit() 
+        method of a concurrent.futures.Executor). Raises RuntimeError if the 
+        worker threads have been told to exit.
+        """
+        if not self._stay_alive:
+            raise RuntimeError("Cannot submit tasks to " + self.name + " after exit")
+        task = self.create_task(func, *args, **kwargs)
+        self.commit_task(task)
+        return task
+
+    ###########################################################################
+
+    def submit_async(self, callback, func, *args, **kwargs):
+        """
+        As submit(), but callback is called with the task once it is done (or
+        cancelled) by the async_runtime's dispatcher thread, rather than by the
+        thread that ran the task. The callbacks run one after another, so a 
+        chain of tasks can be driven from them without any threads waiting for
+        results, and a slow callback does not hold up this queue's workers.
+        """
+        runtime = async_runtime.get_runtime()
+        task = self.submit(func, *args, **kwargs)
+        task.add_done_callback(lambda task: runtime.call_soon(callback, task))
+        return task
+
+    ###########################################################################
+
+    def submit_batch(self, calls):
+        """
+        Submits a task for each of the (func, args, kwargs) tuples in calls 
+        (args and kwargs may be left off), and returns a list of the tasks.
+        """
+        tasks = []
+        for call in calls:
+            func = call[0]
+            args = tuple(call[1]) if len(call) > 1 else ()
+            kwargs = call[2] if len(call) > 2 else {}
+            tasks.append(self.submit(func, *args, **kwargs))
+        return tasks
+
+    ###########################################################################
+
+    def map(self, func, *iterables, **kwargs):
+        """
+        As the built-in map(), but the calls are made by the worker threads.
+        All the calls are submitted straight away and an iterator over their
+        results (in order) is returned. If a call raised an exception, then 
+        the iterator raises it when that result is reached. The timeout 
+        keyword argument limits the total time waited for the results (see
+        concurrent.futures.Executor.map()).
+        """
+        timeout = kwargs.pop("timeout", None)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: " + ", ".join(kwargs))
+
+        if timeout is not None:
+            end_time = time.time() + timeout
+        tasks = self.submit_batch([(func, args) for args in zip(*iterables)])
+
+        def results():
+            try:
+                for task in tasks:
+                    if timeout is None:
+                        yield task.result()
+                    else:
+                        yield task.result(end_time - time.time())
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return results()
+
+    ###########################################################################
+
+    def shutdown(self, wait=True):
+        """
+        Equivalent to exit(), for compatibility with concurrent.futures. If 
+        wait is False, then exit() is run in a separate thread and shutdown()
+        returns straight away.
+        """
+        if wait:
+            self.exit()
+        else:
+            Thread(target=self.exit, name=self.name + " shutdown").start()
 
     ###########################################################################
 
@@ -193,6 +707,14 @@ class ThreadQueueBase:
         Waits for all remaining tasks in the input queue to finish and then
         kills the worker threads.
         """
+        if self._service is not None:
+            # the runtime runs the tasks, so just wait for them to be done
+            self._task_queue.join()
+            self._stay_alive = False
+            self._queue_metrics.remove_workers(
+                self._worker_count, self._task_queue.qsize)
+            return
+
         num_alive = 0
         for t in self._workers:
             if t.is_alive():
@@ -210,6 +732,9 @@ class ThreadQueueBase:
         for thread in self._workers:
             thread.join()
 
+        self._queue_metrics.remove_workers(
+            self._worker_count, self._task_queue.qsize)
+
     ###########################################################################
 
     def _exit(self):
@@ -222,44 +747,297 @@ class ThreadQueueBase:
     ###########################################################################
 ###########################################################################
 
+_base_process_tasks = getattr(ThreadQueueBase._process_tasks, "__func__",
+                              ThreadQueueBase._process_tasks)
+
+###########################################################################
+
+
+class WorkerResource:
+    """
+    Placeholder for one of the objects (e.g. a SettingsManager proxy) that
+    each worker process of a ProcessQueueBase is given when it is started (see
+    the worker_resources argument of ProcessQueueBase). Pass a WorkerResource
+    to a task in place of the object, and the worker running the task 
+    replaces it with its own.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    ###########################################################################
+###########################################################################
+
+
+def _resolve_resource(value, resources):
+    if isinstance(value, WorkerResource):
+        return resources[value.name]
+    return value
+
+###########################################################################
+
+
+def _receive_messages(connection, tasks):
+    """
+    Run by a thread in each worker process of a ProcessQueueBase. Receives 
+    messages from the parent process, putting the tasks into the tasks queue
+    and recording cancellations in _worker_state. Puts None into the queue 
+    when the worker should exit.
+    """
+    parent_pid = os.getppid()
+    while True:
+        try:
+            # the connection is not closed if the parent dies, since the
+            # other workers have inherited copies of it
+            while not connection.poll(1.0):
+                if os.getppid() != parent_pid:
+                    os._exit(1)
+            message = connection.recv()
+        except (EOFError, IOError):
+            message = None
+
+        if message is None:
+            tasks.put(None)
+            return
+        elif message[0] == "cancel":
+            _worker_state["cancelled"] = message[1]
+        else:
+            tasks.put(message[1:])
+
+###########################################################################
+
+
+def _worker_rss():
+    """
+    Returns the resident set size of this process in bytes, or None if it
+    cannot be found.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # only the peak is available, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, AttributeError):
+        return None
+
+###########################################################################
+
+
+def _worker_main(connection, resources):
+    """
+    Run by the worker processes of a ProcessQueueBase. Receives ("task", task
+    id, pickled (function, args, kwargs)) tuples over the connection, runs 
+    them and sends back (task id, result, rss) tuples, where the result is the
+    exception if the function raised one and rss is the resident set size of
+    the worker (in bytes) after running the task. ("cancel", task id) messages make
+    cancel_requested() return True while the task is running. Resources with
+    start() and exit() methods (such as proxies) are started when the worker 
+    starts, and exited when it receives None (or the connection is closed). 
+    If the parent process dies, then the worker exits straight away.
+    """
+    # Ctrl-C is dealt with by the parent process, which then shuts us down,
+    # and SIGUSR1 (which makes it write the queue metrics) is meant for it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    for resource in list(resources.values()):
+        if hasattr(resource, "start"):
+            resource.start()
+
+    # messages are received by a separate thread, so that cancellations can
+    # be received while a task is running
+    tasks = Queue()
+    receiver = Thread(target=_receive_messages, args=(connection, tasks))
+    receiver.setName("Worker receiver thread")
+    receiver.daemon = True
+    receiver.start()
+
+    try:
+        while True:
+            message = tasks.get()
+            if message is None:
+                break
+
+            task_id, payload = message
+            _worker_state["current"] = task_id
+            try:
+                function, args, kwargs = pickle.loads(payload)
+                args = [_resolve_resource(arg, resources) for arg in args]
+                for name in list(kwargs.keys()):
+                    kwargs[name] = _resolve_resource(kwargs[name], resources)
+                result = function(*args, **kwargs)
+            except Exception as ex:
+                traceback.print_exc()
+                result = ex
+            _worker_state["current"] = None
+
+            # drop the task's objects before measuring the memory use
+            payload = function = args = kwargs = None
+            rss = _worker_rss()
+            try:
+                connection.send((task_id, result, rss))
+            except (pickle.PicklingError, TypeError, AttributeError) as ex:
+                connection.send((task_id, RuntimeError(
+                    "Failed to return the result of the task: " + str(ex)), rss))
+            del result
+    finally:
+        for resource in list(resources.values()):
+            if hasattr(resource, "exit"):
+                resource.exit()
+
+###########################################################################
+
+
+class _Worker:
+    """
+    The parent's record of a worker process of a ProcessQueueBase.
+    """
+
+    def __init__(self, process, connection, resources):
+        self.process = process
+        self.connection = connection
+        self.resources = resources
+        self.task = None
+        self.tasks_done = 0
+
+        # when the current task must be finished by (time.time()), and the
+        # exception to fail it with if the worker is killed
+        self.deadline = None
+        self.failure = None
+
+        # the dispatcher and cancel() both send messages to the worker
+        self.send_lock = Lock()
+
+    ###########################################################################
+
+    def send(self, message):
+        with self.send_lock:
+            self.connection.send(message)
+
+    ###########################################################################
+###########################################################################
+
 
 class ProcessQueueBase:
     """
     Base class for running task in separate processes and using a task queue
     for input.
+
+    The tasks are run by a pool of long-lived worker processes, which are
+    started when the ProcessQueueBase is created. Tasks (their function and
+    arguments) are pickled and sent to an idle worker over a pipe, and the 
+    result is sent back the same way. If a worker dies, then the task it was
+    running fails with a RuntimeError and a new worker is started in its 
+    place (if no workers can be started at all, then tasks fail with a 
+    RuntimeError instead of waiting for one). Tasks can be given a time 
+    limit (time_limit, in seconds, sets the default for all tasks). If a 
+    task runs for longer than its time limit, then its worker is killed (and
+    replaced), and the task fails with a TimeoutError. Cancelling a task that
+    is running (see TaskBase.cancel()) makes cancel_requested() return True
+    in its worker.
+
+    Objects which cannot be pickled, such as proxies, can be given to each
+    worker when it is started instead. worker_resources should be a function
+    returning a dict of {name:object}, which is called (in this process) for
+    each new worker, and tasks should use WorkerResource(name) in place of the
+    object. release_worker_resources is called with the dict once the worker
+    has finished with it.
+
+    Workers can be recycled, so that memory leaked by the tasks does not build
+    up: a worker which has run max_tasks_per_worker tasks, or whose resident
+    set size has grown to more than max_worker_rss megabytes after a task, is
+    told to exit once it has returned its result, and a new worker is started
+    in its place (None means no limit).
+
+    Tasks can be given a priority when they are committed. Tasks with a 
+    higher priority are run before those with a lower priority that were
+    committed up to priority_aging seconds (per unit of priority) before them.
+    So low priority tasks still get run eventually, however many high 
+    priority tasks there are. Tasks with the same priority are run in the 
+    order they were committed.
     """
 
-    def __init__(self, workers=1, maxsize=0, name="Un-named"):
-        # create a manager for creating shared objects
-        #self._manager = multiprocessing.Manager()
+    def __init__(self, workers=1, maxsize=0, name="Un-named", priority_aging=60.0,
+                 worker_resources=None, release_worker_resources=None, time_limit=None,
+                 max_tasks_per_worker=None, max_worker_rss=None):
         self.name = name
-        # create an input queue
-        self._input_queue = Queue(maxsize=maxsize)
+        self.priority_aging = priority_aging
+        self.time_limit = time_limit
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_worker_rss = max_worker_rss
+        # create an input queue, of (sort key, sequence number, task) tuples
+        self._input_queue = PriorityQueue(maxsize=maxsize)
+        self._sequence = itertools.count()
 
-        self._process_count = 0
         self._max_process_count = workers
-        self._active_processes = []
+        self._queue_metrics = queue_metrics.register(
+            name, workers, self._input_queue.qsize)
+        self._create_resources = worker_resources
+        self._release_resources = release_worker_resources
         self._stay_alive = True
+        self._closed = False
 
-        # create a thread to read from the input queue and start tasks in their
-        # own process
+        # start the worker processes - _starting is the number of new workers
+        # that are being started to replace ones that have gone
+        self._workers_condition = Condition()
+        self._workers = []
+        self._starting = 0
+        for i in range(workers):
+            self._workers.append(self._start_worker())
+
+        # create a thread to read from the input queue and pass the tasks to
+        # the workers
         self._input_thread = Thread(target=self._process_tasks)
         self._input_thread.setName(self.name + " input thread")
         self._input_thread.start()
 
+        # and one to collect the results from them
+        self._results_thread = Thread(target=self._collect_results)
+        self._results_thread.setName(self.name + " results thread")
+        self._results_thread.start()
+
+    ###########################################################################
+
+    def _start_worker(self):
+        """
+        Starts a new worker process, and returns its _Worker record.
+        """
+        if self._create_resources is None:
+            resources = {}
+        else:
+            resources = self._create_resources()
+
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker_main, args=(
+            child_connection, resources), name=self.name + " worker")
+        process.daemon = True
+        process.start()
+
+        # close our copy of the worker's end, so that we see EOF if it dies
+        child_connection.close()
+        return _Worker(process, parent_connection, resources)
+
     ###########################################################################
 
     def _process_tasks(self):
         """
-        Run by the internal worker thread, this method pulls tasks out of
-        the input queue and creates child processes to execute them. A maximum
-        of 'workers' number of child processes will be allowed to run at any
-        one time.
+        Run by the internal input thread, this method pulls tasks out of
+        the input queue and sends them to the worker processes. A maximum
+        of 'workers' tasks will be run at any one time.
         """
         while self._stay_alive or (not self._input_queue.empty()):
 
+            # wait for a worker to be free before taking a task out of the
+            # queue, so that higher priority tasks committed in the meantime
+            # go first
+            self._get_idle_worker()
+
             try:
-                task = self._input_queue.get()
+                key, sequence, task = self._input_queue.get()
             except Empty:
                 log.warn("Process_tasks get timed out")
                 continue
@@ -269,54 +1047,317 @@ class ProcessQueueBase:
             if task is None:
                 continue
 
-            # Python's popen system is not thread safe, so occasionally it will throw up
-            # a OSError "No child processes" during the following bit of code. This *might*
-            # have been fixed in python2.6, but nobody seems sure, so just in case we wrap it
-            # in a try except block
-#             log.info(
-#                 "Executing worker task (in ProcessQueueBase): ")
+            # tasks which have been cancelled are not run
+            if not task._start():
+                self._input_queue.task_done()
+                continue
+
             try:
-                # otherwise wait for active process count to fall below max
-                # count
-                while self._process_count >= self._max_process_count:
-                    i = 0
-                    while i < len(self._active_processes):
-                        if not self._active_processes[i].is_alive():
-                            self._active_processes[i].join()
-                            self._active_processes.pop(i)
-                            self._input_queue.task_done()
-                            i = i - 1
-                            self._process_count = self._process_count - 1
-
-                        i = i + 1
-                    time.sleep(0.001)
-                    log.warning("Waiting for active processes to finish ")
-            except OSError:
-                log.warning(
-                    "Syncronisation error in ProcessQueueBase! Task has been re-submitted.: ")
-                print(
-                    "Syncronisation error in ProcessQueueBase! Task has been re-submitted.")
-                self._input_queue.put(task)
+                payload = pickle.dumps(
+                    (task._function, task._args, task._kwargs), pickle.HIGHEST_PROTOCOL)
+            except Exception as ex:
+                log.error("Cannot send task to " + self.name + " worker: " + str(ex))
+                task.set_result(ex)
+                self._input_queue.task_done()
                 continue
 
-            not_started = True
-            while not_started:
+            if task.time_limit is None:
+                task.time_limit = self.time_limit
+
+            with self._workers_condition:
+                worker = self._get_idle_worker()
+                if worker is not None:
+                    worker.task = task
+                    if task.time_limit is None:
+                        worker.deadline = None
+                    else:
+                        worker.deadline = time.time() + task.time_limit
+
+            if worker is None:
+                # rather than waiting forever for a worker that may never 
+                # come, fail the task
+                log.error("No " + self.name + " workers could be started")
+                task.set_result(RuntimeError(
+                    "No " + self.name + " worker processes are running"))
+                self._input_queue.task_done()
+                continue
+
+            task._cancel_hook = lambda worker=worker, task=task: self._send_cancel(worker, task)
+
+            try:
+                worker.send(("task", task.id, payload))
+            except (IOError, OSError, EOFError, ValueError):
+                # the worker has died, the results thread will fail the task
+                # and replace the worker
+                log.warning(self.name + " worker died before it could be sent a task")
+
+        self._stop_workers()
+
+    ###########################################################################
+
+    def _send_cancel(self, worker, task):
+        """
+        Tells the worker that the task it is running has been cancelled.
+        """
+        with self._workers_condition:
+            if worker.task is not task:
+                return
+        try:
+            worker.send(("cancel", task.id))
+        except (IOError, OSError, ValueError):
+            pass
+
+    ###########################################################################
+
+    def _get_idle_worker(self):
+        """
+        Waits until one of the workers is not running a task, and returns it.
+        If all the workers have gone and none are being started (because 
+        starting them failed), then another attempt is made to start one, and
+        None is returned if that fails too.
+        """
+        with self._workers_condition:
+            while True:
+                for worker in self._workers:
+                    if worker.task is None:
+                        return worker
+                if len(self._workers) == 0 and self._starting == 0:
+                    break
+                self._workers_condition.wait(1.0)
+            self._starting += 1
+
+        self._replace_worker()
+
+        with self._workers_condition:
+            for worker in self._workers:
+                if worker.task is None:
+                    return worker
+        return None
+
+    ###########################################################################
+
+    def _stop_workers(self):
+        """
+        Waits for the running tasks to finish, then stops the worker 
+        processes.
+        """
+        with self._workers_condition:
+            while self._starting > 0 or \
+                    len([w for w in self._workers if w.task is not None]) > 0:
+                self._workers_condition.wait(1.0)
+            workers = self._workers
+            self._workers = []
+
+        for worker in workers:
+            self._retire_worker(worker)
+
+        self._closed = True
+
+    ###########################################################################
+
+    def _retire_worker(self, worker):
+        """
+        Tells an idle worker to exit, and waits for it to do so.
+        """
+        try:
+            worker.send(None)
+        except (IOError, OSError, ValueError):
+            pass
+        worker.process.join(10)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        worker.connection.close()
+
+        # workers that exit cleanly shut down their own resources
+        if worker.process.exitcode != 0:
+            self._release(worker)
+
+    ###########################################################################
+
+    def _recycle_reason(self, worker, rss):
+        """
+        Returns why the worker should be replaced after its last task, or None
+        if it should not be.
+        """
+        if self.max_tasks_per_worker and worker.tasks_done >= self.max_tasks_per_worker:
+            return "it has run " + str(worker.tasks_done) + " tasks"
+        if self.max_worker_rss and rss is not None and \
+                rss > self.max_worker_rss * 1024 * 1024:
+            return "its RSS is " + str(rss // (1024 * 1024)) + " MB"
+        return None
+
+    ###########################################################################
+
+    def _replace_worker(self):
+        """
+        Starts a new worker in place of one that has been removed from 
+        self._workers (the caller must have incremented self._starting).
+        """
+        try:
+            new_worker = self._start_worker()
+        except Exception:
+            log.exception("Failed to start a new " + self.name + " worker")
+            new_worker = None
+        with self._workers_condition:
+            if new_worker is not None:
+                self._workers.append(new_worker)
+            self._starting -= 1
+            self._workers_condition.notify_all()
+
+    ###########################################################################
+
+    def _collect_results(self):
+        """
+        Run by the internal results thread, this method receives the results
+        of the tasks from the workers and passes them back to the tasks. It 
+        also replaces any workers that die.
+        """
+        while not self._closed:
+            with self._workers_condition:
+                workers = dict([(w.connection.fileno(), w) for w in self._workers
+                                if not w.connection.closed])
+
+            try:
+                readable = select.select(list(workers.keys()), [], [], 0.5)[0]
+            except (select.error, OSError, ValueError):
+                # a worker has been closed while we were waiting
+                continue
+
+            for fd in readable:
+                worker = workers[fd]
                 try:
-                    log.info("Starting process")
-    
-                    task.execute()
-                    
-                    # create a new process to run the task
-                    #p = multiprocessing.Process(target=task.execute)
-                    #self._active_processes.append(p)
-                    #self._process_count = self._process_count + 1
-                    #log.info("Starting process")
-                    #  p.start()
-                    not_started = False
-                except OSError:
-                    log.warning("OSError: ")
-                    #self._active_processes.remove(p)
-                    #self._process_count = self._process_count - 1
+                    task_id, result, rss = worker.connection.recv()
+                except (EOFError, IOError, OSError):
+                    self._worker_died(worker)
+                    continue
+                self._task_finished(worker, task_id, result, rss)
+
+            # catch workers which have died without their pipe being closed
+            for worker in list(workers.values()):
+                if not worker.process.is_alive() and not worker.connection.closed and \
+                        not worker.connection.poll():
+                    self._worker_died(worker)
+
+            # and kill the ones whose task has run for too long
+            now = time.time()
+            for worker in list(workers.values()):
+                if worker.deadline is not None and worker.deadline < now and \
+                        worker.task is not None and not worker.connection.closed:
+                    self._kill_worker(worker, TimeoutError(
+                        "Task exceeded its time limit of " + str(worker.task.time_limit) + "s"))
+
+    ###########################################################################
+
+    def _kill_worker(self, worker, exception):
+        """
+        Kills the worker process, failing the task it was running with the
+        exception. A new worker is started in its place.
+        """
+        log.warning(self.name + " killing worker: " + str(exception))
+        worker.failure = exception
+        worker.process.terminate()
+        self._worker_died(worker)
+
+    ###########################################################################
+
+    def _task_finished(self, worker, task_id, result, rss):
+        """
+        Passes the result to the task that the worker was running, and marks
+        the worker as free (or replaces it, if it is due to be recycled).
+        """
+        with self._workers_condition:
+            task = worker.task
+            worker.task = None
+            worker.deadline = None
+            worker.tasks_done += 1
+
+            recycle = None
+            if self._stay_alive and worker in self._workers:
+                recycle = self._recycle_reason(worker, rss)
+            if recycle is not None:
+                self._workers.remove(worker)
+                self._starting += 1
+            self._workers_condition.notify_all()
+
+        if recycle is not None:
+            log.info("Recycling " + self.name + " worker because " + recycle)
+            self._queue_metrics.worker_recycled()
+            self._replace_worker()
+
+            # the old worker may take a while to shut down its resources
+            retire = Thread(target=self._retire_worker, args=(worker,))
+            retire.setName(self.name + " retire thread")
+            retire.daemon = True
+            retire.start()
+
+        if task is None or task.id != task_id:
+            log.error(self.name + " got the result of an unknown task")
+            return
+        task.set_result(result)
+        self._input_queue.task_done()
+
+    ###########################################################################
+
+    def _worker_died(self, worker):
+        """
+        Fails the task the worker was running (if any) and starts a new 
+        worker in its place.
+        """
+        with self._workers_condition:
+            if worker not in self._workers:
+                # already dealt with, or we are shutting down
+                return
+            self._workers.remove(worker)
+            replace = not self._closed
+            if replace:
+                self._starting += 1
+
+        worker.connection.close()
+        killed = worker.failure is not None
+        if not killed:
+            worker.failure = RuntimeError(
+                self.name + " worker process died while running the task")
+
+        if worker.task is not None:
+            worker.task.set_result(worker.failure)
+            self._input_queue.task_done()
+
+        if replace:
+            self._replace_worker()
+
+        # the process may take a while to go away, which must not hold up
+        # the results of the other workers
+        reap = Thread(target=self._reap_worker, args=(worker, killed))
+        reap.setName(self.name + " reap thread")
+        reap.daemon = True
+        reap.start()
+
+    ###########################################################################
+
+    def _reap_worker(self, worker, killed):
+        """
+        Waits for a worker process which has died (or been told to terminate)
+        to exit, killing it if it does not, and releases its resources.
+        """
+        worker.process.join(5)
+        if worker.process.is_alive():
+            os.kill(worker.process.pid, signal.SIGKILL)
+            worker.process.join()
+        if not killed:
+            log.warning(self.name + " worker died (exit code " +
+                        str(worker.process.exitcode) + "), started a new one")
+        self._release(worker)
+
+    ###########################################################################
+
+    def _release(self, worker):
+        if self._release_resources is not None:
+            try:
+                self._release_resources(worker.resources)
+            except Exception:
+                log.exception("Failed to release " + self.name + " worker resources")
+
     ###########################################################################
 
     def create_task(self, func, *args, **kwargs):
@@ -324,109 +1365,102 @@ class ProcessQueueBase:
         Creates a new task object which can be submitted for execution using 
         the commit_task() method.
         """
-        #n = self._manager.Namespace()
-        q = multiprocessing.Queue()
-        e = multiprocessing.Event()
-        task = ProcessTask(q, e, func, *args, **kwargs)
-        return task
+        return ProcessTask(func, *args, **kwargs)
 
     ###########################################################################
 
-    def commit_task(self, task, timeout=None):
+    def commit_task(self, task, timeout=None, priority=0, time_limit=None):
         """
         Puts the specified task into the input queue where it will be executed
-        in its own process. The task's result() method be used for syncronising 
-        with task completion.
+        by one of the worker processes. The task's result() method be used for
+        syncronising with task completion. Tasks with a higher priority are 
+        executed first (see the class docstring). If time_limit is not None, 
+        then it overrides the time limit of the pool for this task.
         """
+        if time_limit is not None:
+            task.time_limit = time_limit
         if not self._input_thread.isAlive():
             print(
                 "### Error! ### Worker thread in " + self.name + " has died!")
 #             raise RuntimeError(
 #                 "### Error! ### Worker thread in " + self.name + " has died!")
         else:
-            self._input_queue.put(task, timeout=timeout)
+            key = time.time() - priority * self.priority_aging
+            task._queued(self._queue_metrics)
+            self._input_queue.put(
+                (key, next(self._sequence), task), timeout=timeout)
+            self._queue_metrics.enqueued(self._input_queue.qsize())
 
     ###########################################################################
 
     def exit(self):
         """
-        Waits for all the tasks in the input queue to be completed then kills 
-        the internal worker thread and the manager process.
+        Waits for all the tasks in the input queue to be completed then stops
+        the worker processes and the internal threads.
         """
         self._stay_alive = False
-        self._input_queue.put(None)
+        # sorts after all the real tasks
+        self._input_queue.put((float("inf"), next(self._sequence), None))
         self._input_thread.join()
-
-        for process in self._active_processes:
-            process.join()
+        self._results_thread.join()
+        self._queue_metrics.remove_workers(
+            self._max_process_count, self._input_queue.qsize)
 
     ###########################################################################
 ###########################################################################
 
 
-class ProcessTask:
+class ProcessTask(TaskBase):
     """
     Represents a task to be executed by a ProcessQueueBase instance. The 
     ProcessTask object provides a method to execute the task, and a method to 
     retrieve the result when it is ready.
-    """
 
-    def __init__(self, return_queue, shared_event, func, *args, **kwargs):
+    The ProcessTask itself stays in this process - only its function and
+    arguments are sent to the worker, and the result comes back over the 
+    worker's pipe, tagged with the task's id. So unlike the tasks themselves, 
+    the number of pipes (and threads) used for results does not grow with the 
+    number of tasks.
+    """
 
+    def __init__(self, func, *args, **kwargs):
+        TaskBase.__init__(self)
+        self.id = next(_process_task_ids)
         self._function = func
         self._args = args
         self._kwargs = kwargs
-        self.return_queue = return_queue
-        #self.namespace.exception = None
-        self.completed = shared_event
 
     ###########################################################################
 
     def execute(self):
         """
-        Executes the task.
+        Executes the task (in this process).
         """
+        if not self._start():
+            return
+
         # try to run the function. If it fails then store the exception object
         # to pass to outside thread
         try:
-            #             log.info("Execute task in ProcessTask")
-            self.return_queue.put(self._function(*self._args,
-                                                 **self._kwargs))
+            self.set_result(self._function(*self._args, **self._kwargs))
 
         # catch any exceptions that were raised during execution so that they can
         # be raised in the calling thread, rather than the internal worker
         # thread
         except Exception as ex:
-            self.return_queue.put(ex)
-
-        finally:
-            self.completed.set()
+            self.set_result(ex)
 
     ###########################################################################
 
-    def result(self):
+    def set_result(self, value):
         """
-        Blocks until the task is executed and then returns the result. If the 
-        target function has no return value then None is returned when the 
-        task is completed. If the target function raised an exception when it
-        was executed, then calling result() will raise the same exception.
+        Stores the result of the task (or the exception it raised) and marks
+        it as completed.
         """
-        log.info("Waiting for result in ProcessTask")
-        try:
-            self.completed.wait(timeout=10)
-        except Empty:
-            log.warn("Result wait timed out")
-            return None
-        try:
-            return_value = self.return_queue.get()
-        except Empty:
-            log.warn("Result get timed out")
-
-        log.info("Got result in ProcessTask")
-        if isinstance(return_value, Exception):
-            raise return_value
+        if isinstance(value, Exception):
+            self._finish(exception=value)
         else:
-            return return_value
+            self._finish(value)
 
     ###########################################################################
 ###########################################################################
@@ -15,19 +15,29 @@
 # You should have received a copy of the GNU General Public License
 # along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import io
+import pickle
+import tempfile
 import datetime
 import threading
 import traceback
-import gc
 import multiprocessing
 import logging
 import matplotlib._pylab_helpers
+import Image
 from PASKIL import allskyImage
 
+from pysces_asi.data_storage_classes import ImageBuffer, CAPTURE_TIME_FORMAT
+from pysces_asi.multitask import WorkerResource
+
 log = logging.getLogger()
 
 output_functions = {}  # dict to hold all output functions registered
 
+# prefix of the copies of in-memory images that load_image() spills to the tmp
+# dir, so that the ones left behind by a crash can be recognised
+SPILL_PREFIX = "pysces_asi_spill_"
+
 ##########################################################################
 
 
@@ -35,8 +45,8 @@ def create_output_tasks(capture_mode, image_files, folder_on_host, settings_mana
     """
     Returns a list of OutputTask objects, one for each image type. The capture_mode 
     argument should be a CaptureMode object, image_files should be a dict of 
-    {type,(image file, info file)} as returned by the CameraManager.capture_images()
-    method, folder_on_host should be a string containing the folder on the host machine
+    {type,(image file, info file)} or {type,ImageBuffer} as returned by the 
+    CameraManager.capture_images() method, folder_on_host should be a string containing the folder on the host machine
     where the outputs should be stored and settings_manager should be an instance of
     the SettingsManager class.
     """
@@ -56,6 +66,69 @@ def create_output_tasks(capture_mode, image_files, folder_on_host, settings_mana
 ##########################################################################
 
 
+def load_image(image_file):
+    """
+    Returns a tuple (PASKIL allskyImage, list of temporary files) for the 
+    image_file, which should either be an (image file, info file) tuple or an 
+    ImageBuffer. ImageBuffers are decoded from memory, and the raw data is kept 
+    as the raw_buffer attribute of the returned image, so that outputs which 
+    store the raw file (e.g. copy_image) can write it out. Images that PIL cannot
+    decode (e.g. raw formats) are written to temporary files next to where they
+    would have been in the tmp dir and opened using the PASKIL plugins as normal.
+    The temporary files should be removed by the caller once the image is no 
+    longer needed.
+    """
+    if not isinstance(image_file, ImageBuffer):
+        return allskyImage.new(image_file[0], image_file[1]), []
+
+    try:
+        pil_image = Image.open(io.BytesIO(image_file.data))
+        pil_image.load()
+    except IOError:
+        # spill the image to disk so that a PASKIL plugin can open it. Each
+        # sub-task gets its own copy, since they run concurrently
+        folder, filename = os.path.split(image_file.filename)
+        fd, spilled_image = tempfile.mkstemp(
+            suffix=os.path.splitext(filename)[1], prefix=SPILL_PREFIX, dir=folder)
+        os.close(fd)
+        fd, spilled_info = tempfile.mkstemp(
+            suffix=".info", prefix=SPILL_PREFIX, dir=folder)
+        os.close(fd)
+
+        image_file.save(spilled_image)
+        with open(spilled_info, "wb") as fp:
+            pickle.dump(image_file.info, fp)
+
+        image = allskyImage.new(spilled_image, spilled_info)
+        image.raw_buffer = image_file
+        return image, [spilled_image, spilled_info]
+
+    info = dict(image_file.info)
+    try:
+        info['exif'] = pil_image._getexif()
+    except (AttributeError, IOError):
+        pass
+
+    image = allskyImage.allskyImage(pil_image, image_file.filename, info)
+    image.raw_buffer = image_file
+    return image, []
+
+##########################################################################
+
+
+def load_output_task(fp, settings_manager):
+    """
+    Returns the OutputTask pickled into the open file fp by OutputTask.dump().
+    """
+    outputs, image_file, folder_on_host, journal_id = pickle.load(fp)
+    output_task = OutputTask(
+        outputs, image_file, folder_on_host, settings_manager)
+    output_task.journal_id = journal_id
+    return output_task
+
+##########################################################################
+
+
 class SubTask:
     """
     The subTask class is used to represent a single output that must be created for a particular
@@ -78,25 +151,37 @@ class SubTask:
         """
         Runs the function defined in the outputs.py file for this output type
         """
+        temp_files = []
 
+        # start the proxies (unless the worker process running us has already
+        # started them)
+        started_proxies = [p for p in (settings_manager_proxy, network_manager_proxy)
+                           if p is not None and not p.started]
         try:
-            # start the proxies
-            settings_manager_proxy.start()
-            if (network_manager_proxy is not None):
-                network_manager_proxy.start()
+            for proxy in started_proxies:
+                proxy.start()
 
             # load the image using PASKIL
-            self.image = allskyImage.new(self.image[0], self.image[1])
+            self.image, temp_files = load_image(self.image)
+
+            # outputs which don't use filename_format (e.g. copy_image) need to
+            # know where to put their files when there are several cameras
+            self.image.folder_on_host = self._folder_on_host
 
             # work out where the output should be saved
             remove_file_on_host = False
             if self.output.filename_format is not None:
                 # the 'normal' case where we want the output saved on the host
                 # machine
-                capture_time_string = self.image.getInfo()['header'][
-                    'Creation Time']
-                capture_time = datetime.datetime.strptime(
-                    capture_time_string, "%d %b %Y %H:%M:%S %Z")
+                header = self.image.getInfo()['header']
+                if 'Capture Time' in header:
+                    # recorded to the microsecond, so the filename_format can
+                    # use %f for images captured in bursts
+                    capture_time = datetime.datetime.strptime(
+                        header['Capture Time'], CAPTURE_TIME_FORMAT)
+                else:
+                    capture_time = datetime.datetime.strptime(
+                        header['Creation Time'], "%d %b %Y %H:%M:%S %Z")
                 filename = capture_time.strftime(self.output.filename_format)
 
                 if hasattr(self.output, "abs_path_on_host") and self.output.abs_path_on_host:
@@ -143,11 +228,11 @@ class SubTask:
                     output.savefig(self.output_filename)
 
                     # the following seems to be needed to break circular references in
-                    # matplolib and prevent mem leaks
+                    # matplolib and prevent mem leaks (anything that still leaks is
+                    # freed when the worker process is recycled)
                     output.clf()
                     del output
                     matplotlib._pylab_helpers.Gcf().destroy_all()
-                    matplotlib._pylab_helpers.gc.collect()
 
             # copy the output to the server if required
             if ((self.file_on_server is not None) and (network_manager_proxy is not None)):
@@ -166,10 +251,13 @@ class SubTask:
             raise ex
 
         finally:
-            # shutdown the proxies
-            settings_manager_proxy.exit()
-            if (network_manager_proxy is not None):
-                network_manager_proxy.exit()
+            # remove any copies of in-memory images made to open them
+            for temp_file in temp_files:
+                os.remove(temp_file)
+
+            # shutdown the proxies that we started
+            for proxy in started_proxies:
+                proxy.exit()
 
     ##########################################################################
 ##########################################################################
@@ -192,14 +280,110 @@ class OutputTask:
         self._folder_on_host = folder_on_host
         self._settings_manager = settings_manager
         self._running_subtasks = []
+        self._running_outputs = []
         self._running_subtasks_lock = threading.Lock()
         self.__remove_files = True
 
+        # set by the OutputTaskHandler if the progress of the task is being
+        # recorded in an OutputJournal
+        self.journal = None
+        self.journal_id = None
+
+        # when the task was put into the OutputTaskHandler's queue (for the
+        # queue metrics)
+        self.queued_time = None
+
     ##########################################################################
 
     def get_image_filename(self):
+        if isinstance(self._image_file, ImageBuffer):
+            return self._image_file.filename
         return self._image_file[0]
 
+    ##########################################################################
+
+    def get_info_filename(self):
+        """
+        Returns the name of the image's info file in the tmp dir, or None if
+        the image was captured to memory (and hasn't been saved).
+        """
+        if isinstance(self._image_file, ImageBuffer):
+            return None
+        return self._image_file[1]
+
+    ##########################################################################
+
+    def is_in_memory(self):
+        return isinstance(self._image_file, ImageBuffer)
+
+    ##########################################################################
+
+    def get_folder_on_host(self):
+        return self._folder_on_host
+
+    ##########################################################################
+
+    def get_output_names(self):
+        return [output.name for output in self._outputs]
+
+    ##########################################################################
+
+    def temp_files_kept(self):
+        """
+        Returns True if remove_temp_files() left the image in the tmp dir,
+        because some of the outputs failed.
+        """
+        return not self.__remove_files
+
+    ##########################################################################
+
+    def has_outputs(self):
+        """
+        Returns True if there are any outputs left to produce.
+        """
+        return len(self._outputs) > 0
+
+    ##########################################################################
+
+    def shed_outputs(self):
+        """
+        Removes the outputs that are not essential (essential = False in their
+        <output> block), so that the task can be processed more quickly. This
+        must only be called before run_subtasks(). Returns the number of 
+        outputs removed.
+        """
+        essential = [output for output in self._outputs
+                     if getattr(output, "essential", True)]
+        shed = len(self._outputs) - len(essential)
+        self._outputs = essential
+        return shed
+
+    ##########################################################################
+
+    def discard(self):
+        """
+        Abandons the task without producing any of its outputs. As for failed
+        outputs, the image is left in the tmp dir if safe_delete is on, 
+        otherwise it is removed.
+        """
+        safe_delete = self._settings_manager.get(
+            ['safe_delete'])['safe_delete']
+        self.__remove_files = not safe_delete
+        self.remove_temp_files()
+
+    ##########################################################################
+
+    def dump(self, fp):
+        """
+        Pickles the task into the open file fp, so that it can be recreated
+        later (perhaps by a different process) using load_output_task().
+        In-memory images are written into the file along with the task.
+        """
+        pickle.dump((self._outputs, self._image_file,
+                     self._folder_on_host, self.journal_id), fp, 2)
+
+    ##########################################################################
+
     def run_subtasks(self, processing_pool, pipelined_processing_pool, network_manager):
         """
         Runs the pre-processing functions and then submits the sub-tasks to the processing
@@ -216,25 +400,32 @@ class OutputTask:
             sub_task = SubTask(
                 function, self._image_file, output, self._folder_on_host)
 
-            # if we need to copy files to the web-server, then create a proxy
-            # to the NetworkManager
+            # the worker processes of the processing pools each have their
+            # own proxies to the SettingsManager and the NetworkManager (if we
+            # need to copy files to the web-server)
+            settings_manager_proxy = WorkerResource("settings_manager")
             if (network_manager is not None):
-                network_mananger_proxy = network_manager.create_proxy()
+                network_mananger_proxy = WorkerResource("network_manager")
             else:
                 network_mananger_proxy = None
 
-            # submit the sub_task for processing
+            # submit the sub_task for processing. Outputs with a higher
+            # priority (e.g. quicklooks) are processed ahead of the others
+            priority = getattr(output, "priority", 0)
             if output.pipelined:
                 task = pipelined_processing_pool.create_task(
-                    sub_task.execute, self._settings_manager.create_proxy(), network_mananger_proxy)
+                    sub_task.execute, settings_manager_proxy, network_mananger_proxy)
                 self._running_subtasks.append(task)
-                pipelined_processing_pool.commit_task(task, timeout=10)
+                self._running_outputs.append(output)
+                pipelined_processing_pool.commit_task(
+                    task, timeout=10, priority=priority)
 
             else:
                 task = processing_pool.create_task(
-                    sub_task.execute, self._settings_manager.create_proxy(), network_mananger_proxy)
+                    sub_task.execute, settings_manager_proxy, network_mananger_proxy)
                 self._running_subtasks.append(task)
-                processing_pool.commit_task(task)
+                self._running_outputs.append(output)
+                processing_pool.commit_task(task, priority=priority)
 
     ##########################################################################
 
@@ -249,6 +440,9 @@ class OutputTask:
             self._running_subtasks[0].completed.wait(timeout)
             try:
                 self._running_subtasks[0].result()
+                if self.journal is not None:
+                    self.journal.output_done(
+                        self.journal_id, self._running_outputs[0].name)
             except:
                 if safe_delete:
                     self.__remove_files = False
@@ -264,9 +458,8 @@ class OutputTask:
                         {'output': "OutputTask> Safe delete is off, removing temporary files anyway."})
 
             st = self._running_subtasks.pop(0)
+            self._running_outputs.pop(0)
             del st
-        # force garbage collection here. This solves the memory leak problem
-        gc.collect()
 
         # reap zombie processes
         try:
@@ -281,6 +474,20 @@ class OutputTask:
     ##########################################################################
 
     def remove_temp_files(self):
+        if isinstance(self._image_file, ImageBuffer):
+            # the image was never written to the tmp dir. If it is being kept,
+            # then write it out along with its info file, so that it can be
+            # processed again in the same way as the images in the tmp dir
+            if not self.__remove_files:
+                image_filename = self._image_file.filename
+                root, ext = os.path.splitext(image_filename)
+                info_filename = root + "_" + ext.lstrip(".").upper() + ".info"
+                self._image_file.save()
+                with open(info_filename, "wb") as fp:
+                    pickle.dump(self._image_file.info, fp)
+                self._image_file = (image_filename, info_filename)
+            return
+
         if self.__remove_files:
             os.remove(self._image_file[0])
             os.remove(self._image_file[1])
@@ -14,28 +14,61 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
-from Queue import Empty
+from Queue import Empty, Full
 """
 This module provides the OutputTaskHandler class, which is responsible
 for post-processing the images to produce the desired outputs. 
 Multiple processes are used to produce the outputs in parallel and the 
 degree of parallelism will scale automatically with the number of available
 CPUs.
+
+If the outputs cannot be produced as quickly as the images are captured, then
+the queue of OutputTasks fills up. What happens next is controlled by the
+output_backpressure setting (see BACKPRESSURE_POLICIES), so that a slow output
+does not have to hold up image capture.
+
+The progress of each OutputTask is recorded in an OutputJournal (see the
+output_journal setting). When the OutputTaskHandler is started, any tasks
+which were not finished when pysces_asi last stopped are submitted again, in
+the order that their images were captured.
 """
 import multiprocessing
 import logging
 import threading
+import time
+import os
 import os.path
 import imp
+import re
 import glob
+import shutil
 
 from pysces_asi import network
-from pysces_asi.multitask import ThreadQueueBase, ThreadTask, ProcessQueueBase
-from pysces_asi.output_task import OutputTask, output_functions
+from pysces_asi.multitask import ThreadQueueBase, ThreadTask, ProcessQueueBase, TaskQueue
+from pysces_asi.output_task import OutputTask, output_functions, load_output_task, SPILL_PREFIX
+from pysces_asi.data_storage_classes import OutputType
+from pysces_asi.journal import OutputJournal
+from pysces_asi.settings_manager import get_optional
 # from pysces_asi.cron import wait_for_per_image_tasks, submit_image_for_cron
 
 log = logging.getLogger("task_handler")
 
+# What to do with a new OutputTask when the queue is full:
+#  "block" - wait for space in the queue, holding up capture
+#  "drop_oldest" - abandon the oldest task in the queue to make space
+#  "shed" - remove the non-essential outputs (essential = False) from the new
+#           task and the queued ones, then wait for space
+#  "spill" - write the new task to the spill folder on disk, to be processed
+#            once the queue has caught up
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "shed", "spill")
+
+# names of the files that pysces_asi writes to the tmp dir: the images named by
+# their time of capture (see CaptureMode.timestamp()) e.g. "20091019_224510.NEF",
+# their info files e.g. "20091019_224510_NEF.info", and the copies spilled by
+# load_image(). Only these are removed from the tmp dir on recovery.
+TMP_FILE_PATTERN = re.compile(
+    r"^(\d{8}_\d{6}(_\d{3})?(_\w+)?|" + re.escape(SPILL_PREFIX) + r"\w+)\.\w+$")
+
 
 def register(name, plugin):
 
@@ -80,25 +113,37 @@ class OutputTaskHandler(ThreadQueueBase):
     queue as well as ThreadTask objects.
     """
 
+    # the backpressure policies need to get at the tasks waiting in the queue
+    queue_class = TaskQueue
+
     def __init__(self, settings_manager):
 
         self.__pipelined_lock = threading.Lock()
 
+        # how long (in seconds per unit of priority) a low priority output
+        # can be held up by higher priority ones
+        priority_aging = get_optional(
+            settings_manager, "output_priority_aging", 60.0)
+
+        # outputs which take longer than this are abandoned, and the worker
+        # process producing them is replaced
+        time_limit = get_optional(
+            settings_manager, "output_time_limit", 300.0)
+
+        # output functions leak memory, so the worker processes are replaced
+        # after this many outputs, or once they are using this much memory
+        max_tasks_per_worker = get_optional(
+            settings_manager, "output_worker_max_tasks", 500)
+        max_worker_rss = get_optional(
+            settings_manager, "output_worker_max_rss", 1024.0)
+
         ThreadQueueBase.__init__(self, name="OutputTaskHandler", workers=multiprocessing.cpu_count(
         ), maxsize=multiprocessing.cpu_count() + 2)
 
-        # create a processing pool to produce the outputs asyncronously - this
-        # has as many workers as there are CPU cores
-        self._processing_pool = ProcessQueueBase(
-            workers=multiprocessing.cpu_count(), name="Processing Pool")  # multiprocessing.cpu_count()
-
-        # create a processing pool to produce outputs in the order that their respective image types
-        # are recieved from the camera (useful for creating keograms for
-        # example)
-        self._pipelined_processing_pool = ProcessQueueBase(
-            workers=1, name="Pipelined Processing Pool")
+        self._settings_manager = settings_manager
 
-        # load the output creation functions
+        # load the output creation functions - this is done before the
+        # processing pools are created so that their worker processes have them
         home = os.path.expanduser("~")
         clear_plugins_list()
         load_output_functions(os.path.normpath(home + "/.pysces_asi/outputs"))
@@ -116,7 +161,88 @@ class OutputTaskHandler(ThreadQueueBase):
             # webserver
             self._network_manager = network.NetworkManager(settings_manager)
 
-        self._settings_manager = settings_manager
+        # create a processing pool to produce the outputs asyncronously - this
+        # has as many workers as there are CPU cores
+        self._processing_pool = ProcessQueueBase(
+            workers=multiprocessing.cpu_count(), name="Processing Pool",
+            priority_aging=priority_aging, worker_resources=self._create_worker_resources,
+            release_worker_resources=self._release_worker_resources,
+            time_limit=time_limit, max_tasks_per_worker=max_tasks_per_worker,
+            max_worker_rss=max_worker_rss)  # multiprocessing.cpu_count()
+
+        # create a processing pool to produce outputs in the order that their respective image types
+        # are recieved from the camera (useful for creating keograms for
+        # example)
+        self._pipelined_processing_pool = ProcessQueueBase(
+            workers=1, name="Pipelined Processing Pool", priority_aging=priority_aging,
+            worker_resources=self._create_worker_resources,
+            release_worker_resources=self._release_worker_resources,
+            time_limit=time_limit, max_tasks_per_worker=max_tasks_per_worker,
+            max_worker_rss=max_worker_rss)
+
+        # what to do when the queue is full
+        self._backpressure = get_optional(
+            settings_manager, "output_backpressure", "block")
+        if self._backpressure not in BACKPRESSURE_POLICIES:
+            self.exit()
+            raise ValueError("Unknown output_backpressure policy \'" + str(self._backpressure) +
+                             "\', expecting one of " + ", ".join(BACKPRESSURE_POLICIES))
+
+        tmp_dir = settings_manager.get(["tmp dir"])["tmp dir"]
+        self._spill_folder = get_optional(
+            settings_manager, "output_spill_dir", os.path.normpath(tmp_dir + "/spill"))
+        self._spill_lock = threading.Lock()
+        self._backpressure_lock = threading.Lock()
+        self._backpressure_reported = False
+        self._backpressure_counters = {'deferred': 0, 'blocked_time': 0.0,
+                                       'dropped': 0, 'shed_outputs': 0,
+                                       'spilled': 0, 'unspilled': 0}
+
+        # open the journal, and re-submit any tasks that were not finished
+        # when we last stopped
+        journal_filename = get_optional(settings_manager, "output_journal",
+                                        os.path.normpath(tmp_dir + "/output_journal.log"))
+        self._max_attempts = get_optional(
+            settings_manager, "journal_max_attempts", 3)
+        self._failed_folder = os.path.normpath(tmp_dir + "/failed")
+        if journal_filename is None:
+            self._journal = None
+        else:
+            self._journal = OutputJournal(journal_filename)
+            self._recover_from_journal(tmp_dir)
+
+        # tasks spilled before a restart are processed first
+        if self._backpressure == "spill" and len(self._spilled_files()) > 0:
+            self._settings_manager.set(
+                {"output": "OutputTaskHandler> Found " + str(len(self._spilled_files())) +
+                 " spilled output tasks from a previous run"})
+            self._unspill()
+
+    ##########################################################################
+
+    def _create_worker_resources(self):
+        """
+        Returns the proxies that each worker process of the processing pools
+        uses to produce the outputs. See OutputTask.run_subtasks().
+        """
+        resources = {"settings_manager": self._settings_manager.create_proxy(),
+                     "network_manager": None}
+        if self._network_manager is not None:
+            resources["network_manager"] = self._network_manager.create_proxy()
+        return resources
+
+    ##########################################################################
+
+    def _release_worker_resources(self, resources):
+        """
+        Removes the proxies of a worker process which died without shutting
+        them down itself.
+        """
+        self._settings_manager._commit_destroy_proxy(
+            resources["settings_manager"].id)
+        if resources["network_manager"] is not None:
+            self._network_manager._commit_destroy_proxy(
+                resources["network_manager"].id)
 
     ##########################################################################
 
@@ -153,6 +279,11 @@ class OutputTaskHandler(ThreadQueueBase):
                 #                 submit_image_for_cron(
                 # output_task.get_image_filename(), self._settings_manager)
 
+                start_time = time.time()
+                if output_task.queued_time is not None:
+                    self._queue_metrics.started(
+                        start_time - output_task.queued_time)
+
                 # run all the sub tasks in separate processes
                 output_task.run_subtasks(
                     self._processing_pool, self._pipelined_processing_pool, self._network_manager)
@@ -178,12 +309,19 @@ class OutputTaskHandler(ThreadQueueBase):
                 #==============================================================
                 # remove the temporary files
                 output_task.remove_temp_files()
+                self._finish(output_task)
+                self._queue_metrics.finished(time.time() - start_time)
                 del output_task
 
                 # tell the queue that execution is complete
                 self._task_queue.task_done()
                 log.info("Task done")
 
+                # there is space in the queue now, so fetch any tasks that
+                # were spilled to disk
+                if self._backpressure == "spill":
+                    self._unspill()
+
             else:
                 self.__pipelined_lock.release()
                 # if this happens then something has gone seriously wrong!
@@ -221,7 +359,357 @@ class OutputTaskHandler(ThreadQueueBase):
 #                     "### Error! ### Worker thread in " + self.name + " has died!")
 
         if self._stay_alive:
-            self._task_queue.put_nowait(task)
+            self._put(task, block=False)
+
+    ##########################################################################
+
+    def _put(self, task, block=True, timeout=None):
+        """
+        Puts the OutputTask (or ThreadTask) into the queue (see Queue.put()),
+        recording it in the queue metrics.
+        """
+        if isinstance(task, OutputTask):
+            task.queued_time = time.time()
+        else:
+            task._queued(self._queue_metrics)
+        self._task_queue.put(task, block, timeout)
+        self._queue_metrics.enqueued(self._task_queue.qsize())
+
+    ##########################################################################
+
+    def submit_output_task(self, output_task):
+        """
+        Puts the OutputTask into the input queue. If the queue is full, then 
+        the output_backpressure policy is applied. Only the "block" and
+        "shed" policies wait for space in the queue. The task is recorded in
+        the journal before it is queued.
+        """
+        if self._journal is not None and output_task.journal_id is None:
+            output_task.journal = self._journal
+            output_task.journal_id = self._journal.capture(
+                output_task.get_image_filename(), output_task.get_info_filename(),
+                output_task.is_in_memory(), output_task.get_folder_on_host(),
+                output_task.get_output_names())
+
+        # keep spilled tasks in order - new tasks go to the back of the spill
+        # queue while it is being worked through
+        if self._backpressure == "spill" and len(self._spilled_files()) > 0:
+            self._unspill()
+            if len(self._spilled_files()) > 0:
+                self._count('deferred')
+                self._spill(output_task)
+                return
+
+        try:
+            self.commit_task(output_task)
+            self._backpressure_reported = False
+            return
+        except Full:
+            pass
+
+        self._report_backpressure()
+
+        if self._backpressure == "drop_oldest":
+            self._drop_oldest()
+            self._put_waiting(output_task)
+
+        elif self._backpressure == "shed":
+            if not self._shed(output_task):
+                return
+            self._put_waiting(output_task)
+
+        elif self._backpressure == "spill":
+            self._spill(output_task)
+
+        else:
+            self._put_waiting(output_task)
+
+    ##########################################################################
+
+    def get_backpressure_counters(self):
+        """
+        Returns a dict of {'deferred', 'blocked_time', 'dropped', 
+        'shed_outputs', 'spilled', 'unspilled', 'pending_spilled'}. deferred
+        is the number of tasks which could not be queued straight away, 
+        blocked_time the total time (in seconds) that submitting them was held
+        up for, dropped the number of tasks abandoned (including tasks with
+        only non-essential outputs) and shed_outputs the number of outputs 
+        that were removed from tasks.
+        """
+        with self._backpressure_lock:
+            counters = dict(self._backpressure_counters)
+        counters['pending_spilled'] = len(self._spilled_files())
+        return counters
+
+    ##########################################################################
+
+    def _count(self, name, value=1):
+        with self._backpressure_lock:
+            self._backpressure_counters[name] += value
+
+    ##########################################################################
+
+    def _report_backpressure(self):
+        """
+        Counts a deferred task, and reports the first one of a run of them.
+        """
+        self._count('deferred')
+        if not self._backpressure_reported:
+            message = "OutputTaskHandler> Output queue full (" + \
+                self._backpressure + " policy)"
+            log.warn(message)
+            self._settings_manager.set({"output": message})
+            self._backpressure_reported = True
+
+    ##########################################################################
+
+    def _put_waiting(self, output_task):
+        """
+        Puts the task into the queue, waiting for space if necessary. 
+        """
+        start_time = time.time()
+        while self._stay_alive:
+            try:
+                self._put(output_task, timeout=1)
+                break
+            except Full:
+                continue
+        self._count('blocked_time', time.time() - start_time)
+
+    ##########################################################################
+
+    def _drop_oldest(self):
+        """
+        Abandons the oldest OutputTask in the queue.
+        """
+        dropped = self._task_queue.remove_first(
+            lambda item: isinstance(item, OutputTask))
+
+        if dropped is not None:
+            self._count('dropped')
+            log.warn("Dropped outputs of " + dropped.get_image_filename())
+            dropped.discard()
+            self._finish(dropped)
+
+    ##########################################################################
+
+    def _shed(self, output_task):
+        """
+        Removes the non-essential outputs from the new task and those in the
+        queue (which have not been started yet). Returns False if the new task
+        has no outputs left, in which case it has been discarded.
+        """
+        shed = 0
+        for item in self._task_queue.snapshot():
+            if isinstance(item, OutputTask):
+                shed += item.shed_outputs()
+        shed += output_task.shed_outputs()
+        self._count('shed_outputs', shed)
+
+        if not output_task.has_outputs():
+            self._count('dropped')
+            output_task.discard()
+            self._finish(output_task)
+            return False
+        return True
+
+    ##########################################################################
+
+    def _spilled_files(self):
+        """
+        Returns a sorted list of the spilled task files (oldest first).
+        """
+        return sorted(glob.glob(os.path.join(self._spill_folder, "*.spill")))
+
+    ##########################################################################
+
+    def _spill(self, output_task):
+        """
+        Writes the task to the spill folder.
+        """
+        with self._spill_lock:
+            if not os.path.isdir(self._spill_folder):
+                os.makedirs(self._spill_folder)
+
+            spilled = self._spilled_files()
+            if len(spilled) > 0:
+                number = int(os.path.basename(spilled[-1]).split(".")[0]) + 1
+            else:
+                number = 0
+            filename = os.path.join(self._spill_folder, "%012d.spill" % number)
+
+            # write to a temporary file first, so that a crash never leaves a
+            # half written task behind
+            with open(filename + ".part", "wb") as fp:
+                output_task.dump(fp)
+            os.rename(filename + ".part", filename)
+            if self._journal is not None and output_task.journal_id is not None:
+                self._journal.spilled(output_task.journal_id)
+        self._count('spilled')
+
+    ##########################################################################
+
+    def _unspill(self):
+        """
+        Moves spilled tasks back into the queue (oldest first) while there is
+        space for them.
+        """
+        with self._spill_lock:
+            for filename in self._spilled_files():
+                if self._task_queue.full() or not self._stay_alive:
+                    break
+                try:
+                    with open(filename, "rb") as fp:
+                        output_task = load_output_task(
+                            fp, self._settings_manager)
+                except Exception as ex:
+                    log.error("Failed to load spilled output task " + filename + ": " + str(ex))
+                    os.rename(filename, filename + ".bad")
+                    continue
+
+                if self._journal is not None and output_task.journal_id is not None:
+                    output_task.journal = self._journal
+                    self._journal.queued(output_task.journal_id)
+                try:
+                    self._put(output_task, block=False)
+                except Full:
+                    if self._journal is not None and output_task.journal_id is not None:
+                        self._journal.spilled(output_task.journal_id)
+                    break
+                os.remove(filename)
+                self._count('unspilled')
+
+    ##########################################################################
+
+    def _finish(self, output_task):
+        """
+        Records in the journal that the task has finished.
+        """
+        if self._journal is None or output_task.journal_id is None:
+            return
+        if output_task.temp_files_kept():
+            self._journal.finished(output_task.journal_id, kept=True,
+                                   image=output_task.get_image_filename(),
+                                   info=output_task.get_info_filename())
+        else:
+            self._journal.finished(output_task.journal_id)
+
+    ##########################################################################
+
+    def _recover_from_journal(self, tmp_dir):
+        """
+        Re-creates the OutputTasks which were not finished when pysces_asi
+        last stopped (leaving out the outputs which had been produced), and 
+        submits them in the order that their images were captured. Images
+        which have already failed journal_max_attempts times are moved to the
+        failed folder in the tmp dir. Images in the tmp dir which are not in
+        the journal are deleted (see _remove_orphans()).
+        """
+        glob_vars = self._settings_manager.get(["output types", "image types"])
+        recovered = []
+        lost = 0
+        for task in self._journal.pending():
+            if task['info'] is None or not os.path.exists(task['image']) or \
+                    not os.path.exists(task['info']):
+                # captured to memory and lost in the crash (or already removed)
+                self._journal.finished(task['id'])
+                lost += 1
+                continue
+
+            if task['attempt'] >= self._max_attempts:
+                if not os.path.isdir(self._failed_folder):
+                    os.makedirs(self._failed_folder)
+                for filename in (task['image'], task['info']):
+                    shutil.move(filename, self._failed_folder)
+                self._settings_manager.set(
+                    {"output": "OutputTaskHandler> Giving up on " + task['image'] +
+                     " after " + str(task['attempt']) + " attempts, moved to " + self._failed_folder})
+                self._journal.finished(task['id'])
+                continue
+
+            outputs = []
+            for name in task['outputs']:
+                if name in task['done']:
+                    continue
+                try:
+                    outputs.append(OutputType(
+                        glob_vars["output types"][name], glob_vars["image types"]))
+                except KeyError:
+                    log.warning("Output " + name + " no longer exists, skipping it for " + task['image'])
+
+            output_task = OutputTask(outputs, (task['image'], task['info']),
+                                     task['folder'], self._settings_manager)
+            output_task.journal = self._journal
+            output_task.journal_id = self._journal.capture(
+                task['image'], task['info'], False, task['folder'],
+                output_task.get_output_names(), task['attempt'] + 1)
+            self._journal.finished(task['id'])
+            recovered.append(output_task)
+
+        orphans = self._remove_orphans(tmp_dir)
+        self._journal.compact()
+
+        if len(recovered) > 0 or lost > 0 or orphans > 0:
+            self._settings_manager.set(
+                {"output": "OutputTaskHandler> Journal: re-submitting " + str(len(recovered)) +
+                 " unfinished images, " + str(lost) + " lost, removed " + str(orphans) +
+                 " orphaned files from " + tmp_dir})
+
+        if len(recovered) > 0:
+            # submit from a separate thread, so that capturing can start while
+            # the backlog is being worked through
+            recovery_thread = threading.Thread(
+                target=self._resubmit, args=(recovered,), name="Journal recovery")
+            recovery_thread.daemon = True
+            recovery_thread.start()
+
+    ##########################################################################
+
+    def _remove_orphans(self, tmp_dir):
+        """
+        Deletes the images and info files in the tmp dir (and in the tmp dirs
+        of the cameras in the cameras setting) which do not belong to any of the
+        tasks in the journal (images that were captured but never submitted,
+        copies made by load_image() etc.), so that they do not build up over
+        restarts. Only the files named as pysces_asi names them are removed
+        (see TMP_FILE_PATTERN), anything else that has been put in the tmp dir
+        is left alone, as are its other sub-folders. Returns the number
+        of files that were deleted. This must only be called before capturing
+        starts.
+        """
+        keep = self._journal.get_open_files()
+        keep.add(os.path.normpath(self._journal.filename))
+        keep.add(os.path.normpath(self._journal.filename + ".tmp"))
+
+        folders = [tmp_dir]
+        cameras = get_optional(self._settings_manager, "cameras", None)
+        if cameras:
+            folders += [os.path.normpath(tmp_dir + "/" + name) for name in sorted(cameras.keys())]
+
+        removed = 0
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                path = os.path.normpath(os.path.join(folder, filename))
+                if path in keep or not TMP_FILE_PATTERN.match(filename) or \
+                        not os.path.isfile(path):
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError as ex:
+                    log.warning("Failed to remove " + path + ": " + str(ex))
+        return removed
+
+    ##########################################################################
+
+    def _resubmit(self, output_tasks):
+        """
+        Puts the recovered tasks into the queue, in order, waiting for space.
+        """
+        for output_task in output_tasks:
+            self._put_waiting(output_task)
 
     ##########################################################################
 
@@ -245,5 +733,8 @@ class OutputTaskHandler(ThreadQueueBase):
             self._network_manager.exit()
             print("OutputTaskHandler: Killed network manager")
 
+        if getattr(self, "_journal", None) is not None:
+            self._journal.close()
+
     ##########################################################################
 ##########################################################################
@@ -0,0 +1,332 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The queue_metrics module keeps a registry of QueueMetrics objects, one for
+each named task queue (ThreadQueueBase and ProcessQueueBase instances register
+themselves when they are created). For each queue it records how long tasks
+wait between being queued and being started, how long they take to execute,
+the greatest number of tasks waiting in the queue and how busy its workers
+are, so that the stage which is holding up the others can be found.
+
+The metrics of all the queues can be read with summary(), written to a file
+with write(), or written periodically by a QueueMetricsWriter. Queues with
+the same name (e.g. several proxies) share one QueueMetrics object.
+"""
+import os
+import json
+import time
+import threading
+import logging
+
+log = logging.getLogger("queue_metrics")
+
+# upper bounds (in seconds) of the histogram buckets. Durations longer than
+# the last bound are counted in an overflow bucket.
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# {name:QueueMetrics} of all the queues created in this process
+_registry = {}
+_registry_lock = threading.Lock()
+
+##########################################################################
+
+
+class Histogram:
+    """
+    A histogram of durations (in seconds), using the bucket bounds in BUCKETS,
+    along with their count, mean, maximum and the last one recorded. All 
+    methods are thread safe.
+    """
+
+    def __init__(self):
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._last = 0.0
+        self._buckets = [0] * (len(BUCKETS) + 1)
+        self._lock = threading.Lock()
+
+    ##########################################################################
+
+    def record(self, duration):
+        """
+        Adds a duration to the histogram.
+        """
+        with self._lock:
+            self._count += 1
+            self._total += duration
+            self._max = max(self._max, duration)
+            self._last = duration
+
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    self._buckets[i] += 1
+                    break
+            else:
+                self._buckets[-1] += 1
+
+    ##########################################################################
+
+    def summary(self):
+        """
+        Returns a dict of {'count', 'mean', 'max', 'last', 'histogram'}, where
+        histogram is a list of the number of durations in each bucket, 
+        followed by the number longer than the last bound. Returns None if no
+        durations have been recorded.
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            return {'count': self._count,
+                    'mean': self._total / self._count,
+                    'max': self._max,
+                    'last': self._last,
+                    'histogram': list(self._buckets)}
+
+    ##########################################################################
+##########################################################################
+
+
+class QueueMetrics:
+    """
+    Metrics for a named queue. The queue calls enqueued() each time a task is
+    put into it, started() when a worker starts the task and finished() when
+    the task is done. The wait and execution times are kept in Histograms.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._wait = Histogram()
+        self._execution = Histogram()
+        self._lock = threading.Lock()
+        self._failed = 0
+        self._recycled = 0
+        self._depth_functions = []
+        self._depth_high_water = 0
+        self._enqueued = 0
+        self._busy_time = 0.0
+
+        # the number of workers, and the number of worker-seconds that they
+        # have been available for up to _workers_changed
+        self._workers = 0
+        self._worker_time = 0.0
+        self._workers_changed = time.time()
+
+    ##########################################################################
+
+    def _update_worker_time(self, now):
+        self._worker_time += self._workers * (now - self._workers_changed)
+        self._workers_changed = now
+
+    ##########################################################################
+
+    def add_workers(self, workers, depth_function=None):
+        """
+        Records that a queue with this name and the given number of workers
+        has been created. depth_function should return the number of tasks
+        waiting in the queue.
+        """
+        with self._lock:
+            self._update_worker_time(time.time())
+            self._workers += workers
+            if depth_function is not None:
+                self._depth_functions.append(depth_function)
+
+    ##########################################################################
+
+    def remove_workers(self, workers, depth_function=None):
+        """
+        Records that the workers of a queue have exited.
+        """
+        with self._lock:
+            self._update_worker_time(time.time())
+            self._workers = max(0, self._workers - workers)
+            if depth_function in self._depth_functions:
+                self._depth_functions.remove(depth_function)
+
+    ##########################################################################
+
+    def enqueued(self, depth):
+        """
+        Records that a task has been queued, leaving depth tasks waiting in
+        the queue.
+        """
+        with self._lock:
+            self._enqueued += 1
+            if depth > self._depth_high_water:
+                self._depth_high_water = depth
+
+    ##########################################################################
+
+    def started(self, wait):
+        """
+        Records that a task has been started after waiting for wait seconds.
+        """
+        self._wait.record(wait)
+
+    ##########################################################################
+
+    def finished(self, duration, failed=False):
+        """
+        Records that a task has finished after executing for duration seconds.
+        """
+        self._execution.record(duration)
+        with self._lock:
+            self._busy_time += duration
+            if failed:
+                self._failed += 1
+
+    ##########################################################################
+
+    def worker_recycled(self):
+        """
+        Records that a worker process has been replaced to free its memory.
+        """
+        with self._lock:
+            self._recycled += 1
+
+    ##########################################################################
+
+    def summary(self):
+        """
+        Returns a dict of {'workers', 'depth', 'depth_high_water', 'enqueued',
+        'failed', 'recycled', 'busy_time', 'worker_time', 'utilisation', 'wait',
+        'execution'}. busy_time is the total time spent executing tasks and
+        worker_time the total time that the workers have been available for,
+        so utilisation (busy_time / worker_time) is the fraction of the time
+        that the workers were busy. The difference between these in two
+        summaries gives the utilisation over the time between them. wait and
+        execution are the wait and execution time histograms, in the format
+        of Histogram.summary() (None if no tasks have been started).
+        """
+        with self._lock:
+            self._update_worker_time(time.time())
+            depth = 0
+            for depth_function in self._depth_functions:
+                try:
+                    depth += depth_function()
+                except Exception:
+                    pass
+
+            if self._worker_time > 0:
+                utilisation = min(1.0, self._busy_time / self._worker_time)
+            else:
+                utilisation = None
+
+            return {'workers': self._workers,
+                    'depth': depth,
+                    'depth_high_water': self._depth_high_water,
+                    'enqueued': self._enqueued,
+                    'failed': self._failed,
+                    'recycled': self._recycled,
+                    'busy_time': self._busy_time,
+                    'worker_time': self._worker_time,
+                    'utilisation': utilisation,
+                    'wait': self._wait.summary(),
+                    'execution': self._execution.summary()}
+
+    ##########################################################################
+##########################################################################
+
+
+def register(name, workers, depth_function=None):
+    """
+    Returns the QueueMetrics for the named queue (creating it if needed), and
+    adds the workers to it. See QueueMetrics.add_workers().
+    """
+    with _registry_lock:
+        metrics = _registry.get(name)
+        if metrics is None:
+            metrics = QueueMetrics(name)
+            _registry[name] = metrics
+    metrics.add_workers(workers, depth_function)
+    return metrics
+
+##########################################################################
+
+
+def summary():
+    """
+    Returns a dict of {'time', 'buckets', 'queues'}, where queues is a dict of
+    {queue name:QueueMetrics.summary()} and buckets is the list of upper
+    bounds of the histogram buckets.
+    """
+    with _registry_lock:
+        registry = list(_registry.items())
+
+    queues = {}
+    for name, metrics in registry:
+        queues[name] = metrics.summary()
+    return {'time': time.time(), 'buckets': list(BUCKETS), 'queues': queues}
+
+##########################################################################
+
+
+def write(filename):
+    """
+    Writes the summary() of all the queues to a file as JSON. The file is
+    replaced atomically, so it can be read at any time.
+    """
+    temp_filename = filename + "-temp"
+    with open(temp_filename, "w") as fp:
+        json.dump(summary(), fp, sort_keys=True)
+    os.rename(temp_filename, filename)
+
+##########################################################################
+
+
+class QueueMetricsWriter:
+    """
+    Writes the metrics of all the queues to a file every interval seconds
+    (and when it is stopped), using a daemon thread.
+    """
+
+    def __init__(self, filename, interval=300):
+        self.filename = filename
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setName("QueueMetricsWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    ##########################################################################
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    ##########################################################################
+
+    def write(self):
+        try:
+            write(self.filename)
+        except (IOError, OSError) as ex:
+            log.warning("Failed to write queue metrics file: " + str(ex))
+
+    ##########################################################################
+
+    def stop(self):
+        """
+        Stops the thread and writes the file one last time.
+        """
+        self._stop_event.set()
+        self._thread.join()
+        self.write()
+
+    ##########################################################################
+##########################################################################
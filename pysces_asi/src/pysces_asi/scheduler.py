@@ -31,6 +31,10 @@ import ephem
 from pysces_asi import capture
 from pysces_asi.data_storage_classes import CaptureMode
 
+# how often the schedule is evaluated when looking for the next change of
+# capture mode, see Scheduler.predict_future()
+SCHEDULE_SCAN_INTERVAL = datetime.timedelta(minutes=10)
+
 # define the functions used in the settings file
 ##########################################################################
 
@@ -64,7 +68,13 @@ class FutureSchedule:
         self.times = []
         self.sun_angles = []
         self.moon_angles = []
+        # {time:name of the capture mode that should be running}
         self.capture_modes = {}
+        # the time of the next change of capture mode (to within a second)
+        # and the name of the capture mode it changes to, or None if the
+        # capture mode doesn't change in the period predicted
+        self.next_transition_time = None
+        self.next_capture_mode = None
 
 
 class Scheduler:
@@ -88,6 +98,10 @@ class Scheduler:
         self.__current_capture_mode_name = None
         self.__capture_manager = None
 
+        # (time, capture mode name) of the last change of capture mode passed
+        # to the CaptureManager by predict_future()
+        self.__next_transition = (None, None)
+
         # create ephemeris data variables
         try:
             self.__settings_manager.create("sun_angle", "")
@@ -173,10 +187,8 @@ class Scheduler:
                         # note that the captureMode constructor takes care of building outputTypes,
                         # and the outputTypes constructor takes care of
                         # building imageTypes
-                        glob_vars = self.__settings_manager.get(
-                            ["capture modes", "image types", "output types"])
-                        capture_mode_to_run = CaptureMode(glob_vars["capture modes"][
-                                                          capture_mode_to_run_name], glob_vars["image types"], glob_vars["output types"])
+                        capture_mode_to_run = self.__create_capture_mode(
+                            capture_mode_to_run_name)
 
                         # pass capture mode to captureManager
                         self.__capture_manager.commit_task(capture_mode_to_run)
@@ -199,7 +211,10 @@ class Scheduler:
     def predict_future(self):
         """
         Evaluates ephemiris and schedule for the next 12 hours and stores the data
-        into the settings_manager (GUI display is then updated via a callback)
+        into the settings_manager (GUI display is then updated via a callback).
+        The time of the next change of capture mode is passed to the 
+        CaptureManager, so that it can get the cameras ready for it, if it
+        is not the one that was passed last time.
         """
         time_now = datetime.datetime.utcnow()
         end_time = time_now + datetime.timedelta(hours=24)
@@ -219,8 +234,89 @@ class Scheduler:
             future.moon_angles.append(math.degrees(self.__moon.alt))
             current_time += increment
 
+        self.__predict_transition(future, time_now, end_time)
+
         self.__settings_manager.set({'future_schedule': future})
 
+        if future.next_capture_mode is None:
+            transition = (None, None)
+        else:
+            transition = (future.next_transition_time, future.next_capture_mode)
+
+        # the transition time is only found to within a second, so it can
+        # move about a little from one prediction to the next
+        last_time, last_name = self.__next_transition
+        if transition[1] == last_name and (
+                last_time is None or abs((transition[0] - last_time).total_seconds()) <= 1):
+            return
+        self.__next_transition = transition
+
+        if transition[1] is None:
+            self.__capture_manager.set_next_transition(None, None)
+        else:
+            self.__capture_manager.set_next_transition(
+                transition[0], self.__create_capture_mode(transition[1]))
+
+    ##########################################################################
+
+    def __predict_transition(self, future, start_time, end_time):
+        """
+        Fills in the capture_modes, next_transition_time and next_capture_mode
+        of the FutureSchedule. The schedule is only evaluated every 
+        SCHEDULE_SCAN_INTERVAL (so a capture mode which runs for less time than
+        that may be missed), and then bisected where the capture mode changes.
+        """
+        schedule = self.__settings_manager.get(["schedule"])["schedule"]
+
+        current_time = start_time
+        previous_time = None
+
+        while current_time <= end_time:
+            capture_mode_name = self.__evaluate_schedule(
+                current_time, schedule)
+            future.capture_modes[current_time] = capture_mode_name
+
+            if (previous_time is not None and
+                    capture_mode_name != future.capture_modes[previous_time]):
+                future.next_transition_time = self.__find_transition(
+                    previous_time, current_time, schedule)
+                future.next_capture_mode = self.__evaluate_schedule(
+                    future.next_transition_time, schedule)
+                return
+
+            previous_time = current_time
+            current_time += SCHEDULE_SCAN_INTERVAL
+
+    ##########################################################################
+
+    def __find_transition(self, start_time, end_time, schedule):
+        """
+        Returns the first time (to within a second) between start_time and
+        end_time at which the capture mode is the one that should be running
+        at end_time.
+        """
+        end_mode = self.__evaluate_schedule(end_time, schedule)
+        while (end_time - start_time).total_seconds() > 1:
+            middle_time = start_time + (end_time - start_time) / 2
+            if self.__evaluate_schedule(middle_time, schedule) == end_mode:
+                end_time = middle_time
+            else:
+                start_time = middle_time
+        return end_time
+
+    ##########################################################################
+
+    def __create_capture_mode(self, capture_mode_name):
+        """
+        Returns a CaptureMode object for the named capture mode.
+        """
+        # note that the captureMode constructor takes care of building outputTypes,
+        # and the outputTypes constructor takes care of building imageTypes
+        glob_vars = self.__settings_manager.get(
+            ["capture modes", "image types", "output types"])
+        return CaptureMode(glob_vars["capture modes"][capture_mode_name],
+                           glob_vars["image types"], glob_vars["output types"])
+
     ##########################################################################
 
     def exit(self):
@@ -256,14 +352,20 @@ class Scheduler:
 
     ##########################################################################
 
-    def __evaluate_schedule(self):
+    def __evaluate_schedule(self, at_time=None, schedule=None):
         """
         Evaluates the schedule and returns the name of the capture mode that should be currently
-        being run. If no capture mode should be run then it returns None.
+        being run. If no capture mode should be run then it returns None. If at_time 
+        (a UTC datetime) is given, then the capture mode that should be running at that time 
+        is returned instead, and the sun and moon angles in the settings manager are left
+        alone. The schedule is fetched from the settings manager unless it is passed in.
         """
 
         # set date and time to the time now (in UT)
-        now = datetime.datetime.utcnow()
+        if at_time is None:
+            now = datetime.datetime.utcnow()
+        else:
+            now = at_time
         DATE = now.date()  # used in eval() call below
         TIME = now.time()  # used in eval() call below
 
@@ -278,11 +380,13 @@ class Scheduler:
         MOON_PHASE = float(self.__moon.moon_phase * 100.0)
 
         # set the values stored in the settings manager
-        self.__settings_manager.set(
-            {"sun_angle": SUN_ANGLE, "moon_angle": MOON_ANGLE, "moon_phase": MOON_PHASE})
+        if at_time is None:
+            self.__settings_manager.set(
+                {"sun_angle": SUN_ANGLE, "moon_angle": MOON_ANGLE, "moon_phase": MOON_PHASE})
 
         # get the schedule from the global variables
-        schedule = self.__settings_manager.get(["schedule"])["schedule"]
+        if schedule is None:
+            schedule = self.__settings_manager.get(["schedule"])["schedule"]
 
         # evaluate each test in the schedule and return the name of the capture
         # mode that should be run
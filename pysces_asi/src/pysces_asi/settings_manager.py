@@ -34,6 +34,20 @@ import logging
 
 log = logging.getLogger("Settings_manager")
 
+
+def get_optional(settings_manager, name, default):
+    """
+    Returns the value of the variable called name from the settings_manager
+    (or a proxy to it). If the variable does not exist (for example because 
+    it is an optional setting that is missing from an older settings file) 
+    then default is returned instead.
+    """
+    try:
+        return settings_manager.get([name])[name]
+    except KeyError:
+        return default
+
+
 class _SettingsManagerProxy(ThreadQueueBase):
     """
     Proxy class for the SettingsManager class. Proxy objects can be passed to child processes
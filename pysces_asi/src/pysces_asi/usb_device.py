@@ -0,0 +1,271 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The usb_device module provides functions for finding cameras in the Linux
+sysfs USB device tree (normally /sys/bus/usb/devices) and for re-enumerating
+them, i.e. disconnecting and reconnecting them in software, which is often
+the only way to recover a camera whose USB connection has locked up. It also
+provides the PresenceMonitor class, which watches the tree for a camera being
+plugged in or unplugged.
+
+Devices are identified by their gphoto2 port string e.g. "usb:001,005" (bus 1,
+device 5). The device number changes every time that the device is enumerated,
+so the sysfs path of the device (e.g. "1-1.2", which depends only on the
+physical USB port it is plugged into) is used to find it again afterwards.
+"""
+import os
+import time
+import select
+import socket
+import threading
+import logging
+
+log = logging.getLogger("usb_device")
+
+DEFAULT_SYSFS_ROOT = "/sys/bus/usb/devices"
+
+# netlink protocol for kernel uevents (device added/removed etc.)
+NETLINK_KOBJECT_UEVENT = 15
+
+
+class USBDeviceError(Exception):
+    """
+    Raised when a USB device cannot be found or re-enumerated.
+    """
+    pass
+
+##########################################################################
+
+
+def _read_attribute(device_path, name):
+    """
+    Returns the stripped contents of a sysfs attribute file of the device, or
+    None if it doesn't exist.
+    """
+    try:
+        with open(os.path.join(device_path, name), "r") as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return None
+
+##########################################################################
+
+
+def device_port(device_path):
+    """
+    Returns the gphoto2 port string (e.g. "usb:001,005") of the device in the
+    given sysfs directory, or None if the device is not present.
+    """
+    busnum = _read_attribute(device_path, "busnum")
+    devnum = _read_attribute(device_path, "devnum")
+    if busnum is None or devnum is None:
+        return None
+    return "usb:%03d,%03d" % (int(busnum), int(devnum))
+
+##########################################################################
+
+
+def find_device(port, sysfs_root=DEFAULT_SYSFS_ROOT):
+    """
+    Returns the sysfs directory of the device with the given gphoto2 port
+    string, or None if there isn't one.
+    """
+    if not port or not port.startswith("usb:"):
+        return None
+
+    try:
+        names = os.listdir(sysfs_root)
+    except OSError:
+        return None
+
+    for name in sorted(names):
+        # skip the interfaces of the devices e.g. "1-1.2:1.0"
+        if name.count(":") != 0:
+            continue
+        device_path = os.path.join(sysfs_root, name)
+        if device_port(device_path) == port:
+            return device_path
+    return None
+
+##########################################################################
+
+
+def find_devices(vendor_id, product_id, sysfs_root=DEFAULT_SYSFS_ROOT):
+    """
+    Returns a dict of {sysfs name:gphoto2 port} (e.g. {"1-1.2":"usb:001,005"})
+    of the devices with the given vendor and product IDs, which should be 
+    hexadecimal strings e.g. "04b0" and "0412".
+    """
+    vendor_id = vendor_id.lower()
+    product_id = product_id.lower()
+
+    try:
+        names = os.listdir(sysfs_root)
+    except OSError:
+        return {}
+
+    devices = {}
+    for name in names:
+        if name.count(":") != 0:
+            continue
+        device_path = os.path.join(sysfs_root, name)
+        if (_read_attribute(device_path, "idVendor") != vendor_id or
+                _read_attribute(device_path, "idProduct") != product_id):
+            continue
+        port = device_port(device_path)
+        if port is not None:
+            devices[name] = port
+    return devices
+
+##########################################################################
+
+
+def reenumerate(device_path, timeout=30):
+    """
+    Re-enumerates the USB device in the given sysfs directory by
+    de-authorising and then re-authorising it, and waits for it to come back.
+    Returns the new gphoto2 port string of the device. This needs write access
+    to the device's "authorized" file, which normally means running as root
+    (or a udev rule granting access). Raises USBDeviceError on failure.
+    """
+    authorized = os.path.join(device_path, "authorized")
+
+    try:
+        with open(authorized, "w") as fp:
+            fp.write("0")
+        time.sleep(1)
+        with open(authorized, "w") as fp:
+            fp.write("1")
+    except (IOError, OSError) as ex:
+        raise USBDeviceError(
+            "Failed to re-enumerate USB device " + device_path + ": " + str(ex))
+
+    # the device number (and therefore the port) normally changes when the
+    # device is enumerated again. Give the camera a moment to settle before
+    # reading it.
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        time.sleep(0.5)
+        port = device_port(device_path)
+        if port is not None and _read_attribute(device_path, "authorized") == "1":
+            return port
+
+    raise USBDeviceError(
+        "USB device " + device_path + " did not come back after re-enumeration")
+
+##########################################################################
+
+
+class PresenceMonitor:
+    """
+    Watches the sysfs USB device tree for devices with the given vendor and
+    product IDs (hexadecimal strings) being connected or disconnected. Each
+    time the set of matching devices changes, callback is called (from the
+    monitor's own thread) with the new dict of {sysfs name:gphoto2 port}. 
+
+    When watching the real device tree, the monitor listens for kernel
+    uevents, so changes are noticed straight away. The tree is also rescanned
+    every interval seconds, which is all that is done if uevents are not
+    available or a different sysfs_root (e.g. a fake one for testing) is 
+    used.
+    """
+
+    def __init__(self, vendor_id, product_id, callback,
+                 sysfs_root=DEFAULT_SYSFS_ROOT, interval=1.0):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.sysfs_root = sysfs_root
+        self.interval = interval
+        self._callback = callback
+        self._stop_event = threading.Event()
+
+        self.devices = find_devices(vendor_id, product_id, sysfs_root)
+
+        self._uevent_socket = None
+        if sysfs_root == DEFAULT_SYSFS_ROOT:
+            self._uevent_socket = self._open_uevent_socket()
+
+        self._thread = threading.Thread(
+            target=self._run, name="PresenceMonitor")
+        self._thread.daemon = True
+
+    ##########################################################################
+
+    def start(self):
+        self._thread.start()
+
+    ##########################################################################
+
+    def stop(self):
+        """
+        Stops the monitor. The callback will not be called again, although the
+        monitor's thread may take up to interval seconds to finish.
+        """
+        self._stop_event.set()
+
+    ##########################################################################
+
+    def _open_uevent_socket(self):
+        """
+        Returns a socket receiving kernel uevents, or None if this isn't 
+        possible (e.g. not on Linux).
+        """
+        try:
+            uevent_socket = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            uevent_socket.bind((0, 1))
+            return uevent_socket
+        except (AttributeError, socket.error, OSError) as ex:
+            log.info("Kernel uevents not available (" + str(ex) +
+                     "), polling " + self.sysfs_root + " instead")
+            return None
+
+    ##########################################################################
+
+    def _run(self):
+        try:
+            while not self._stop_event.is_set():
+                if self._uevent_socket is not None:
+                    readable = select.select(
+                        [self._uevent_socket], [], [], self.interval)[0]
+                    if readable:
+                        # we don't care what the events were, only what is in
+                        # the tree afterwards
+                        self._uevent_socket.recv(65536)
+                else:
+                    self._stop_event.wait(self.interval)
+
+                if not self._stop_event.is_set():
+                    self._rescan()
+        finally:
+            if self._uevent_socket is not None:
+                self._uevent_socket.close()
+
+    ##########################################################################
+
+    def _rescan(self):
+        devices = find_devices(self.vendor_id, self.product_id,
+                               self.sysfs_root)
+        if devices != self.devices:
+            self.devices = devices
+            try:
+                self._callback(dict(devices))
+            except Exception:
+                log.exception("Error in USB presence callback")
+
+    ##########################################################################
+##########################################################################
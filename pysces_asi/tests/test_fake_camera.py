@@ -0,0 +1,273 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Smoke test which runs a GphotoCameraManager end-to-end against the fake
+gphoto2 in misc/fake_gphoto2.py, using the camera described by
+misc/fake_gphoto2_scenario.json. The commands go through the gphoto2 shell
+session (GphotoSession), and the camera is found in a fake sysfs USB device
+tree (see the usb_device module), which is used to unplug the camera and plug
+it back in while the manager is running.
+
+A second test makes every capture fail, and checks that the recovery is
+escalated and the camera reported as degraded, even though the capture mode
+is set (which the camera is already set up for) between the captures, as the
+CaptureManager does.
+
+Run them from the pysces_asi folder with:
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MISC = os.path.normpath(os.path.join(HERE, "..", "misc"))
+sys.path.insert(0, os.path.normpath(os.path.join(HERE, "..", "src")))
+
+try:
+    from pysces_asi import camera
+    from pysces_asi.data_storage_classes import CaptureMode
+except ImportError as ex:
+    camera = None
+    import_error = str(ex)
+
+FAKE_GPHOTO2 = os.path.join(MISC, "fake_gphoto2.py")
+
+# the USB ID and sysfs name of the fake camera, which is on the port given in
+# the scenario file (usb:001,005)
+USB_ID = "04b0:0412"
+USB_DEVICE = "1-1.2"
+
+##########################################################################
+
+
+class SettingsManager:
+    """
+    Stand-in for the SettingsManager, holding the settings in a dict.
+    """
+
+    def __init__(self, settings):
+        self.settings = dict(settings)
+        self.output = []
+
+    def get(self, names):
+        return dict([(name, self.settings[name]) for name in names])
+
+    def set(self, values):
+        if "output" in values:
+            self.output.append(values["output"])
+        self.settings.update(values)
+
+    def create(self, name, value, persistant=False):
+        if name in self.settings:
+            raise ValueError("A variable called " + name + " already exists")
+        self.settings[name] = value
+
+##########################################################################
+
+
+if camera is not None:
+    class SmokeCameraManager(camera.GphotoCameraManager):
+        """
+        The least that a camera plugin has to do: apply the camera settings
+        of the capture mode and capture a single JPEG for each image.
+        """
+        required_configs = ['imgquality']
+
+        def _set_capture_mode(self, capture_mode):
+            self._set_configs(dict(capture_mode.camera_settings))
+            self.capture_mode = capture_mode
+
+        def _capture_images(self):
+            time_of_capture, images = self._capture_photos(1)
+            tmp_dir = self._settings_manager.get(['tmp dir'])['tmp dir']
+            return {'jpeg': os.path.join(tmp_dir, self._timestamp(time_of_capture) + ".JPG")}
+
+##########################################################################
+
+
+class FakeCameraTest(unittest.TestCase):
+
+    def setUp(self):
+        if camera is None:
+            self.skipTest("cannot import pysces_asi.camera: " + import_error)
+
+        self.folder = tempfile.mkdtemp(prefix="pysces_asi_test_")
+        self.tmp_dir = os.path.join(self.folder, "tmp")
+        os.makedirs(self.tmp_dir)
+
+        # the scenario, without its random capture failures
+        self.scenario_file = os.path.join(self.folder, "scenario.json")
+        self.write_scenario(failure_rate={})
+
+        # the camera config cache is kept in the home directory
+        self.environ = dict(os.environ)
+        os.environ["FAKE_GPHOTO2_SCENARIO"] = self.scenario_file
+        os.environ["HOME"] = self.folder
+
+        self.sysfs_root = os.path.join(self.folder, "sys")
+        self.device_path = os.path.join(self.sysfs_root, USB_DEVICE)
+        self.unplugged_path = os.path.join(self.folder, "unplugged")
+        os.makedirs(self.device_path)
+        vendor_id, product_id = USB_ID.split(":")
+        for name, value in (("idVendor", vendor_id), ("idProduct", product_id),
+                            ("busnum", "1"), ("devnum", "5"), ("authorized", "1")):
+            with open(os.path.join(self.device_path, name), "w") as fp:
+                fp.write(value + "\n")
+
+        self.settings_manager = SettingsManager({
+            'tmp dir': self.tmp_dir,
+            'camera_full_auto_clear': False,
+            'capture modes': {}, 'image types': {}, 'output types': {},
+            'gphoto2_executable': FAKE_GPHOTO2,
+            'gphoto2_session': True,
+            'usb_sysfs_root': self.sysfs_root,
+            'camera_usb_id': USB_ID,
+            'usb_presence_interval': 0.1})
+
+        self.manager = None
+
+    ##########################################################################
+
+    def tearDown(self):
+        if self.manager is not None:
+            self.manager.exit()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.folder)
+
+    ##########################################################################
+
+    def write_scenario(self, **changes):
+        """
+        Writes the scenario file, with the changes made to the example one.
+        """
+        with open(os.path.join(MISC, "fake_gphoto2_scenario.json"), "r") as fp:
+            scenario = json.load(fp)
+        scenario.update(changes)
+        with open(self.scenario_file, "w") as fp:
+            json.dump(scenario, fp)
+
+    ##########################################################################
+
+    def fake_gphoto2(self, *args):
+        """
+        Runs the fake gphoto2 directly, as if someone had changed something on
+        the camera, and returns its output.
+        """
+        return subprocess.check_output(
+            [sys.executable, FAKE_GPHOTO2] + list(args)).decode()
+
+    ##########################################################################
+
+    def wait_for_presence(self, present):
+        timeout = time.time() + 10
+        while self.manager.is_present() != present:
+            self.assertTrue(time.time() < timeout,
+                            "camera presence did not change to " + str(present))
+            time.sleep(0.05)
+
+    ##########################################################################
+
+    def capture(self):
+        image = self.manager.capture_images()['jpeg']
+        self.assertTrue(os.path.exists(image), image + " was not downloaded")
+        return image
+
+    ##########################################################################
+
+    def test_capture_and_reconnect(self):
+        self.manager = SmokeCameraManager(self.settings_manager)
+        self.assertTrue(self.manager.is_present())
+        self.assertTrue(self.manager.is_connected())
+
+        capture_mode = CaptureMode({'name': 'smoke', 'delay': 10, 'outputs': [],
+                                    'iso': '400', 'imgquality': 'JPEG Normal'}, {}, {})
+        self.manager.set_capture_mode(capture_mode)
+        self.assertTrue("Current: 400" in self.fake_gphoto2("--get-config", "iso"))
+
+        first_image = self.capture()
+
+        # unplug the camera, and have it lose its settings while it is away
+        shutil.move(self.device_path, self.unplugged_path)
+        self.wait_for_presence(False)
+        self.fake_gphoto2("--set-config-value", "iso=100")
+        shutil.move(self.unplugged_path, self.device_path)
+        self.wait_for_presence(True)
+
+        # the same capture mode must be applied to the camera again
+        self.manager.set_capture_mode(capture_mode)
+        self.assertTrue("Current: 400" in self.fake_gphoto2("--get-config", "iso"))
+
+        second_image = self.capture()
+        self.assertNotEqual(first_image, second_image)
+
+        # everything went through the shell session
+        self.assertTrue(len(self.manager.get_session_latencies()) > 0)
+        self.assertTrue('session_reconnects' in self.manager.get_metrics()['counters'])
+
+    ##########################################################################
+
+    def test_failures_escalate(self):
+        with open(os.path.join(MISC, "fake_gphoto2_scenario.json"), "r") as fp:
+            latency = json.load(fp)["latency"]
+        latency["reset"] = 0.1
+        self.write_scenario(failure_rate={"capture": 1.0}, latency=latency)
+        self.settings_manager.settings.update({'camera_backoff_initial': 0.1,
+                                               'camera_backoff_max': 0.2,
+                                               'camera_breaker_threshold': 3})
+
+        self.manager = SmokeCameraManager(self.settings_manager)
+        capture_mode = CaptureMode({'name': 'smoke', 'delay': 10, 'outputs': [],
+                                    'imgquality': 'JPEG Normal'}, {}, {})
+
+        failures = 0
+        actions = set()
+        timeout = time.time() + 60
+        while failures < 5:
+            self.assertTrue(time.time() < timeout, "captures did not fail")
+            time.sleep(self.manager.get_recovery_state()['wait_time'])
+            try:
+                self.manager.set_capture_mode(capture_mode)
+                self.manager.capture_images()
+                self.fail("capture succeeded")
+            except camera.CameraRecoveryError:
+                # still backing off after the recovery action
+                continue
+            except camera.GphotoError:
+                failures += 1
+            actions.add(self.manager.get_recovery_state()['last_action'])
+
+        state = self.manager.get_recovery_state()
+        self.assertEqual(state['state'], "degraded")
+        self.assertEqual(state['consecutive_failures'], failures)
+        self.assertEqual(actions, set([camera.RETRY, camera.RESET, camera.REENUMERATE]))
+        self.assertTrue([line for line in self.settings_manager.output
+                         if line.find("Camera degraded") != -1])
+
+    ##########################################################################
+##########################################################################
+
+
+if __name__ == "__main__":
+    unittest.main()
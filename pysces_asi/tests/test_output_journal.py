@@ -0,0 +1,161 @@
+# Copyright (C) Nial Peters 2009
+#
+# This file is part of pysces_asi.
+#
+# pysces_asi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# pysces_asi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pysces_asi.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests the recovery from the output journal when the OutputTaskHandler is
+started: the images that pysces_asi left in the tmp dir (and in the tmp dirs
+of the cameras) which are not in the journal are removed, but any other files
+that have been put there are not.
+
+Run them from the pysces_asi folder with:
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(HERE, "..", "src")))
+
+try:
+    from pysces_asi import output_task_handler
+    from pysces_asi.output_task import SPILL_PREFIX
+except ImportError as ex:
+    output_task_handler = None
+    import_error = str(ex)
+
+##########################################################################
+
+
+class SettingsProxy:
+    """
+    Stand-in for the SettingsManagerProxy given to the worker processes.
+    """
+
+    def __init__(self, id_):
+        self.id = id_
+
+    def get(self, names):
+        raise KeyError(names[0])
+
+    def exit(self):
+        pass
+
+##########################################################################
+
+
+class SettingsManager:
+    """
+    Stand-in for the SettingsManager, holding the settings in a dict.
+    """
+
+    def __init__(self, settings):
+        self.settings = dict(settings)
+        self.output = []
+        self.proxies = 0
+
+    def get(self, names):
+        return dict([(name, self.settings[name]) for name in names])
+
+    def set(self, values):
+        if "output" in values:
+            self.output.append(values["output"])
+        self.settings.update(values)
+
+    def create_proxy(self):
+        self.proxies += 1
+        return SettingsProxy(self.proxies)
+
+    def _commit_destroy_proxy(self, id_):
+        pass
+
+##########################################################################
+
+
+class OutputJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        if output_task_handler is None:
+            self.skipTest("cannot import pysces_asi.output_task_handler: " + import_error)
+
+        self.folder = tempfile.mkdtemp(prefix="pysces_asi_test_")
+        self.tmp_dir = os.path.join(self.folder, "tmp")
+        self.camera_tmp_dir = os.path.join(self.tmp_dir, "camera")
+        os.makedirs(self.camera_tmp_dir)
+
+        # the output plugins are loaded from the home directory
+        self.environ = dict(os.environ)
+        os.environ["HOME"] = self.folder
+
+        self.settings_manager = SettingsManager({
+            'tmp dir': self.tmp_dir, 'output types': {}, 'image types': {},
+            'cameras': {'camera': {'port': 'usb:001,005'}}})
+        self.handler = None
+
+    ##########################################################################
+
+    def tearDown(self):
+        if self.handler is not None:
+            self.handler.exit()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.folder)
+
+    ##########################################################################
+
+    def create_files(self, folder, names):
+        paths = []
+        for name in names:
+            path = os.path.join(folder, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as fp:
+                fp.write("x")
+            paths.append(path)
+        return paths
+
+    ##########################################################################
+
+    def test_foreign_files_survive_recovery(self):
+        orphans = self.create_files(self.tmp_dir, [
+            "20091019_224510.NEF", "20091019_224510_NEF.info",
+            SPILL_PREFIX + "a1b2c3.JPG", SPILL_PREFIX + "d4e5f6.info"])
+        orphans += self.create_files(self.camera_tmp_dir, [
+            "20091019_224510_250.JPG", "20091019_224510_250_JPG.info"])
+
+        foreign = self.create_files(self.tmp_dir, [
+            "notes.txt", "calibration/20091019_224510.JPG"])
+        foreign += self.create_files(self.camera_tmp_dir, [
+            "DSC_0001.JPG", "dark_frame.NEF"])
+
+        self.handler = output_task_handler.OutputTaskHandler(self.settings_manager)
+
+        for path in orphans:
+            self.assertFalse(os.path.exists(path), path + " was not removed")
+        for path in foreign:
+            self.assertTrue(os.path.exists(path), path + " was removed")
+        self.assertTrue([line for line in self.settings_manager.output
+                         if line.find("removed " + str(len(orphans)) + " orphaned files") != -1])
+
+    ##########################################################################
+##########################################################################
+
+
+if __name__ == "__main__":
+    unittest.main()